@@ -0,0 +1,581 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the stages of hotrun.download_process_and_save_m3u (fetch, parse, sort, serialize,
+fingerprint and the whole pipeline) on synthetic playlists and on the real files in best/ and
+specialiptvs/.
+Results are written as JSON to bench_results/ so runs can be compared over time.
+
+    python bench.py                               # synthetic + real playlists
+    python bench.py --channels 30000 --groups 400 --line-ending mixed
+    python bench.py --compare bench_results/bench-20260101-120000.json
+    python bench.py --cpu-scaling                 # process-pool CPU stage at 1..N cores
+    python bench.py --parity                      # byte-identical output vs the reference parser only
+"""
+import os
+import sys
+import io
+import glob
+import json
+import time
+import re
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+import subprocess
+import contextlib
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from typing import List, Optional, Dict, Any, Tuple, Callable
+
+import requests
+import hotrun
+
+# --- Constants ---
+BENCH_RESULTS_DIR = "bench_results" # Where JSON results are written
+REAL_PLAYLIST_GLOBS = ("best/*.m3u", "specialiptvs/*.m3u")
+PARITY_PLAYLIST_GLOBS = ("best/best1.m3u", "specialiptvs/*.m3u") # Checked by --parity
+PARITY_CHUNK_SIZES = (1, 7, 4096) # Smallest random chunk sizes fed to the stream parser by --parity
+LINE_ENDINGS = {"lf": "\n", "crlf": "\r\n", "cr": "\r"} # 'mixed' picks one of these per line
+STAGES = ("fetch", "parse", "stream_parse", "sort", "serialize", "serialize_same", "fingerprint", "pipeline")
+GROUP_WORDS = ("Sport", "News", "Movies", "Kids", "Music", "Documentary", "Series", "Iran", "Persian",
+               "beIN", "DAZN", "Canal+", "Paramount", "UK", "FR", "DE", "TR", "AR", "VIP", "4K")
+ATTRIBUTE_KEYS = ("tvg-id", "tvg-name", "tvg-logo", "tvg-chno", "tvg-shift", "catchup", "catchup-days",
+                  "catchup-source", "tvg-country", "tvg-language")
+
+
+def print_colored(text: str, color: str) -> None:
+    """Prints text in the specified color (same palette as hotrun)."""
+    hotrun.print_colored(text, color)
+
+
+# --- Synthetic Playlist Generator ---
+def generate_playlist(channels: int, groups: int, attributes: int = 3, line_ending: str = "lf",
+                      blank_line_ratio: float = 0.0, seed: int = 0) -> bytes:
+    """
+    Builds a synthetic M3U playlist that looks like a panel export.
+    Args:
+        channels: Number of #EXTINF entries.
+        groups: Number of distinct group titles (one of them is a 'beIN' group so the file is saved).
+        attributes: Attributes per #EXTINF line before group-title.
+        line_ending: 'lf', 'crlf', 'cr' or 'mixed'.
+        blank_line_ratio: Fraction of entries preceded by a blank line.
+        seed: Random seed, the same arguments always give the same bytes.
+    Returns:
+        The playlist as UTF-8 bytes.
+    """
+    rng = random.Random(seed)
+    group_titles = ["beIN SPORTS"] + [
+        f"{rng.choice(GROUP_WORDS)} {rng.choice(GROUP_WORDS)} {index}" for index in range(1, max(groups, 1))]
+    keys = ATTRIBUTE_KEYS[:max(0, min(attributes, len(ATTRIBUTE_KEYS)))]
+    endings = list(LINE_ENDINGS.values())
+
+    def eol() -> str:
+        return rng.choice(endings) if line_ending == "mixed" else LINE_ENDINGS[line_ending]
+
+    parts = ["#EXTM3U", eol()]
+    for index in range(channels):
+        if blank_line_ratio and rng.random() < blank_line_ratio:
+            parts.append(eol())
+        name = f"{rng.choice(GROUP_WORDS)} Channel {index} HD"
+        attribute_parts = []
+        for key in keys:
+            if key == "tvg-name":
+                attribute_parts.append(f'{key}="{name}"')
+            elif key == "tvg-logo":
+                attribute_parts.append(f'{key}="http://logo.example/{index}.png"')
+            else:
+                attribute_parts.append(f'{key}="{rng.randint(0, 999) if rng.random() < 0.5 else ""}"')
+        attribute_parts.append(f'group-title="{group_titles[index % len(group_titles)]}"')
+        parts.append(f"#EXTINF:-1 {' '.join(attribute_parts)},{name}")
+        parts.append(eol())
+        parts.append(f"http://panel{index % 7}.example:8080/live/user/pass/{100000 + index}.ts")
+        parts.append(eol())
+    return "".join(parts).encode("utf-8")
+
+
+# --- Reference Implementation (hotrun.py before the parser and writer rework, frozen) ---
+def reference_sort_groups(group_names: List[str]) -> List[str]:
+    """The original sort_groups: iran -> persian -> ir, then bein -> sport -> spor -> canal+ -> dazn -> paramount, then A-Z."""
+    normalized_map = {str(name).lower(): str(name) for name in group_names if isinstance(name, (str, int, float))}
+    lower_groups_unique = list(normalized_map.keys())
+
+    priority1_lower = []
+    priority2_lower = []
+    processed_lower = set()
+
+    p1_terms = [('iran', lambda g: 'iran' in g),
+                ('persian', lambda g: 'persian' in g),
+                ('ir', lambda g: 'ir' in g and 'iraq' not in g and 'ireland' not in g)]
+
+    p2_terms = [('bein', lambda g: 'bein' in g),
+                ('sport', lambda g: 'sport' in g),
+                ('spor', lambda g: 'spor' in g),
+                ('canal+', lambda g: 'canal+' in g),
+                ('dazn', lambda g: 'dazn' in g),
+                ('paramount', lambda g: 'paramount' in g)]
+
+    for _, condition in p1_terms:
+        for group_lower in list(lower_groups_unique):
+            if condition(group_lower) and group_lower not in processed_lower:
+                priority1_lower.append(group_lower)
+                processed_lower.add(group_lower)
+
+    for _, condition in p2_terms:
+        for group_lower in list(lower_groups_unique):
+            if condition(group_lower) and group_lower not in processed_lower:
+                priority2_lower.append(group_lower)
+                processed_lower.add(group_lower)
+
+    other_groups_lower = sorted([g for g in lower_groups_unique if g not in processed_lower])
+
+    return ([normalized_map[g] for g in priority1_lower] + [normalized_map[g] for g in priority2_lower]
+            + [normalized_map[g] for g in other_groups_lower])
+
+
+def reference_parse_m3u_content(m3u_content: str) -> Tuple[List[Dict[str, Any]], List[str], bool]:
+    """The original parse_m3u_content (line-by-line regexes, one dict per channel), without its warnings."""
+    channels = []
+    group_titles = set()
+    found_bein = False
+    lines = m3u_content.splitlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i].strip()
+        if line.startswith('#EXTINF:'):
+            attributes = {}
+            name = "Unnamed Channel"
+            group_title = "General"
+            duration = -1
+
+            match_extinf = re.match(r'#EXTINF:(?P<duration>-?\d+)(?P<attributes_str>.*?),\s*(?P<name>.*)', line)
+            if match_extinf:
+                try:
+                    duration = int(match_extinf.group('duration'))
+                except ValueError:
+                    duration = -1
+                name = match_extinf.group('name').strip() or name
+                attributes_str = match_extinf.group('attributes_str').strip()
+                for key, val_quoted, val_unquoted in re.findall(r'([a-zA-Z0-9_\-]+)=?(?:"([^"]*)"|([^ ]*))',
+                                                                attributes_str):
+                    attributes[key] = val_quoted if val_quoted else val_unquoted
+                group_title_raw = attributes.get('group-title', "General")
+                group_title = str(group_title_raw) if group_title_raw is not None else "General"
+                if "bein" in group_title.lower():
+                    found_bein = True
+                group_titles.add(group_title)
+
+            url = ""
+            j = i + 1
+            while j < len(lines):
+                next_line = lines[j].strip()
+                if next_line and not next_line.startswith('#'):
+                    url = next_line
+                    i = j
+                    break
+                elif next_line.startswith('#EXTINF:') or next_line.startswith('#EXTM3U') or next_line.startswith('#EXT-X-'):
+                    break
+                j += 1
+
+            if match_extinf:
+                channels.append({'duration': duration, 'name': name, 'attributes': attributes,
+                                 'url': url, 'group_title': group_title})
+        i += 1
+
+    return channels, list(group_titles), found_bein
+
+
+def reference_output(data: bytes) -> Optional[bytes]:
+    """
+    What the original hotrun wrote for a downloaded body (check, parse, 'Bein' filter, sort,
+    one pass over all channels per group), or None if it saved nothing.
+    """
+    text = data.decode('utf-8', errors='ignore')
+    if not text.strip().startswith('#EXTM3U'):
+        return None
+    channels, unique_groups, found_bein = reference_parse_m3u_content(text)
+    if not channels or not found_bein:
+        return None
+    out = [b'#EXTM3U\n']
+    for group_name in reference_sort_groups(unique_groups):
+        for channel in channels:
+            if channel['group_title'] == group_name and channel['url']:
+                extinf_parts = [f"#EXTINF:{channel['duration']}"]
+                attributes = channel['attributes']
+                attributes['group-title'] = group_name
+                for key, value in attributes.items():
+                    extinf_parts.append(f'{key}="{str(value).replace(chr(34), chr(39))}"')
+                extinf_line = " ".join(extinf_parts) + f",{channel['name']}"
+                out.append(extinf_line.encode('utf-8', errors='ignore') + b'\n')
+                out.append(channel['url'].encode('utf-8', errors='ignore') + b'\n')
+    return b''.join(out)
+
+
+def read_output(output_filepath: str, saved: bool) -> Optional[bytes]:
+    """The bytes hotrun saved, or None if it saved nothing."""
+    if not saved:
+        return None
+    with open(output_filepath, "rb") as f:
+        return f.read()
+
+
+def check_reference_parity(paths: List[str], work_dir: str, seed: int = 0) -> int:
+    """
+    Asserts that hotrun saves byte-identical output to reference_output for every playlist in
+    paths, both from the whole body (process_and_save_m3u) and streamed in random-sized chunks
+    (M3UStreamParser + save_parsed_m3u, as the download engines do). Prints each mismatch.
+    Returns:
+        The number of mismatching playlists.
+    """
+    rng = random.Random(seed)
+    output_filepath = os.path.join(work_dir, "parity.m3u")
+    mismatches = 0
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        expected = reference_output(data)
+        with contextlib.redirect_stdout(io.StringIO()):
+            whole = read_output(output_filepath, hotrun.process_and_save_m3u(data, output_filepath))
+            streamed = []
+            for smallest in PARITY_CHUNK_SIZES:
+                parser = hotrun.M3UStreamParser(max_bytes=len(data) + 1)
+                offset = 0
+                while offset < len(data):
+                    size = rng.randint(smallest, smallest * 64)
+                    parser.feed(data[offset:offset + size])
+                    offset += size
+                parser.close()
+                channels, unique_groups, found_bein = parser.result()
+                saved = parser.is_m3u and hotrun.save_parsed_m3u(channels, unique_groups, found_bein, output_filepath)
+                streamed.append(read_output(output_filepath, saved))
+        failed = [name for name, output in [("whole", whole)] + [(f"chunks>={size}", output) for size, output
+                                                                 in zip(PARITY_CHUNK_SIZES, streamed)]
+                  if output != expected]
+        if failed:
+            mismatches += 1
+            print_colored(f"Parity MISMATCH: {path} ({', '.join(failed)})", "red")
+        else:
+            print_colored(f"Parity ok: {path}", "green")
+    return mismatches
+
+
+# --- Local HTTP Server (fetch stage) ---
+class QuietHandler(SimpleHTTPRequestHandler):
+    """Static file handler without per-request logging."""
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+@contextlib.contextmanager
+def serve_directory(directory: str):
+    """Serves directory over HTTP on a free localhost port; yields the base URL."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory=directory))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# --- Timing Helpers ---
+def time_stage(func: Callable[[], Any], repeat: int) -> Tuple[Dict[str, float], Any]:
+    """
+    Runs func `repeat` times with hotrun's logging silenced.
+    Returns:
+        ({'min', 'median', 'mean'} in seconds, result of the last run)
+    """
+    timings = []
+    result = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = func()
+            timings.append(time.perf_counter() - start)
+    return {"min": min(timings), "median": statistics.median(timings), "mean": statistics.mean(timings)}, result
+
+
+def fetch_bytes(session: requests.Session, url: str) -> bytes:
+    """Downloads url the way fetch_and_parse_m3u reads it (streamed, DOWNLOAD_CHUNK_SIZE chunks)."""
+    with session.get(url, timeout=hotrun.DOWNLOAD_TIMEOUT, headers=hotrun.REQUEST_HEADERS, stream=True) as response:
+        response.raise_for_status()
+        return b"".join(response.iter_content(chunk_size=hotrun.DOWNLOAD_CHUNK_SIZE))
+
+
+def stream_parse(data: bytes) -> hotrun.M3UStreamParser:
+    """Feeds data to an M3UStreamParser in download-sized chunks."""
+    parser = hotrun.M3UStreamParser(max_bytes=len(data) + 1)
+    for offset in range(0, len(data), hotrun.DOWNLOAD_CHUNK_SIZE):
+        parser.feed(data[offset:offset + hotrun.DOWNLOAD_CHUNK_SIZE])
+    parser.close()
+    return parser
+
+
+def channel_rows(channels: List[hotrun.Channel]) -> List[Tuple[Any, ...]]:
+    """Comparable view of parsed channels."""
+    return [(ch.duration, ch.name, ch.attributes, ch.url, ch.group_title) for ch in channels]
+
+
+# --- Benchmark One Playlist ---
+def bench_playlist(label: str, filename: str, data: bytes, base_url: Optional[str], work_dir: str,
+                   repeat: int) -> Dict[str, Any]:
+    """
+    Times every stage for one playlist.
+    Args:
+        label: Name used in the report.
+        filename: File name of the playlist under the served directory.
+        data: The playlist bytes.
+        base_url: Base URL of the local server, or None to skip the network stages.
+        work_dir: Scratch directory for serialized output.
+        repeat: Runs per stage (the minimum is the headline number).
+    Returns:
+        Result record with playlist metadata and per-stage timings.
+    """
+    text = data.decode("utf-8", errors="ignore")
+    megabytes = len(data) / 1024 / 1024
+    stages: Dict[str, Dict[str, float]] = {}
+
+    if base_url is not None:
+        url = f"{base_url}/{filename}"
+        session = requests.Session()
+        try:
+            stages["fetch"], _ = time_stage(lambda: fetch_bytes(session, url), repeat)
+        finally:
+            session.close()
+
+    stages["parse"], (channels, unique_groups, found_bein) = time_stage(
+        lambda: hotrun.parse_m3u_content(text), repeat)
+    stages["stream_parse"], parser = time_stage(lambda: stream_parse(data), repeat)
+    stages["sort"], _ = time_stage(lambda: hotrun.sort_groups(unique_groups), repeat)
+
+    output_filepath = os.path.join(work_dir, "out", "bench.m3u")
+
+    def serialize() -> bool:
+        if os.path.exists(output_filepath):
+            os.remove(output_filepath) # Time a real write, not the unchanged-output check
+        return hotrun.save_parsed_m3u(channels, unique_groups, found_bein, output_filepath)
+
+    stages["serialize"], saved = time_stage(serialize, repeat)
+    output_bytes = os.path.getsize(output_filepath) if saved else 0
+    if saved:
+        stages["serialize_same"], _ = time_stage(
+            lambda: hotrun.save_parsed_m3u(channels, unique_groups, found_bein, output_filepath), repeat)
+    stages["fingerprint"], _ = time_stage(lambda: hotrun.fingerprint_channels(channels, 1), repeat)
+
+    if base_url is not None:
+        stages["pipeline"], _ = time_stage(
+            lambda: hotrun.download_process_and_save_m3u(url, 2, os.path.join(work_dir, "out")), repeat)
+
+    for timing in stages.values():
+        timing["mb_per_s"] = megabytes / timing["min"] if timing["min"] > 0 else 0.0
+
+    # The stream parser must see exactly what the whole-text parser sees, and the output must be
+    # byte-identical to the reference implementation's, or the numbers mean nothing
+    stream_channels, stream_groups, stream_bein = parser.result()
+    parity = (channel_rows(stream_channels) == channel_rows(channels)
+              and stream_groups == unique_groups and stream_bein == found_bein
+              and read_output(output_filepath, saved) == reference_output(data))
+
+    return {
+        "label": label,
+        "bytes": len(data),
+        "channels": len(channels),
+        "groups": len(unique_groups),
+        "found_bein": found_bein,
+        "saved": saved,
+        "output_bytes": output_bytes,
+        "parser_parity": parity,
+        "stages": stages,
+    }
+
+
+# --- Inputs ---
+def build_inputs(args: argparse.Namespace) -> List[Tuple[str, bytes]]:
+    """Returns (label, bytes) for every synthetic and real playlist selected on the command line."""
+    inputs = []
+    for channels in args.channels:
+        label = (f"synthetic-{channels}ch-{args.groups}g-{args.attributes}a-{args.line_ending}"
+                 + (f"-blank{args.blank_lines}" if args.blank_lines else ""))
+        inputs.append((label, generate_playlist(channels, args.groups, args.attributes, args.line_ending,
+                                                args.blank_lines, args.seed)))
+    if not args.no_real:
+        for pattern in REAL_PLAYLIST_GLOBS:
+            for path in sorted(glob.glob(pattern)):
+                with open(path, "rb") as f:
+                    inputs.append((path.replace(os.sep, "/"), f.read()))
+    return inputs
+
+
+# --- CPU Stage Scaling ---
+def process_quietly(data: bytes, output_filepath: str) -> bool:
+    """hotrun.process_and_save_m3u with its logging silenced (runs in a worker process)."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return hotrun.process_and_save_m3u(data, output_filepath)
+
+
+def bench_cpu_scaling(inputs: List[Tuple[str, bytes]], work_dir: str, max_workers: int,
+                      copies: int) -> List[Dict[str, float]]:
+    """
+    Times hotrun.process_and_save_m3u (parse, 'Bein' filter, sort, serialize) over every input,
+    `copies` times each, in a ProcessPoolExecutor of 1, 2, 4, ... max_workers processes.
+    Returns:
+        [{'workers', 'seconds', 'speedup'}] with speedup relative to one process.
+    """
+    bodies = [data for _, data in inputs] * copies
+    worker_counts = []
+    workers = 1
+    while workers < max_workers:
+        worker_counts.append(workers)
+        workers *= 2
+    worker_counts.append(max_workers)
+
+    scaling = []
+    for workers in worker_counts:
+        output_folder = os.path.join(work_dir, f"cpu{workers}")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(abs, range(workers))) # Start the workers before timing
+            start = time.perf_counter()
+            list(executor.map(process_quietly, bodies,
+                              [os.path.join(output_folder, f"M3U{i}.m3u") for i in range(1, len(bodies) + 1)]))
+            seconds = time.perf_counter() - start
+        scaling.append({"workers": workers, "seconds": seconds,
+                        "speedup": scaling[0]["seconds"] / seconds if scaling else 1.0})
+        print_colored(f"  cpu stage {workers:>3} processes: {seconds:7.2f} s  ({scaling[-1]['speedup']:.2f}x)", "cyan")
+    return scaling
+
+
+def get_git_commit() -> Optional[str]:
+    """Current commit hash, or None outside a git checkout."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip() or None
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(results: List[Dict[str, Any]], previous: Optional[Dict[str, Any]]) -> None:
+    """Prints the min time per stage, with the change against a previous run when given."""
+    previous_by_label = {r["label"]: r for r in previous["results"]} if previous else {}
+    for result in results:
+        color = "green" if result["parser_parity"] else "red"
+        print_colored(f"{result['label']}: {result['bytes'] / 1024 / 1024:.2f} MB, {result['channels']} channels, "
+                      f"{result['groups']} groups, parity {'ok' if result['parser_parity'] else 'MISMATCH'}", color)
+        old_stages = previous_by_label.get(result["label"], {}).get("stages", {})
+        for stage in STAGES:
+            timing = result["stages"].get(stage)
+            if timing is None:
+                continue
+            line = f"  {stage:<12} {timing['min'] * 1000:9.2f} ms  {timing['mb_per_s']:8.1f} MB/s"
+            old = old_stages.get(stage)
+            if old and timing["min"] > 0:
+                line += f"  ({old['min'] / timing['min']:.2f}x vs previous)"
+            print_colored(line, "cyan")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parses command line options."""
+    parser = argparse.ArgumentParser(description="Benchmark the hotrun fetch/parse/sort/serialize stages.")
+    parser.add_argument("--channels", type=int, nargs="*", default=[1000, 30000],
+                        help="Channel counts of the synthetic playlists (none to skip them).")
+    parser.add_argument("--groups", type=int, default=200, help="Distinct groups per synthetic playlist.")
+    parser.add_argument("--attributes", type=int, default=3, help="Attributes per #EXTINF line besides group-title.")
+    parser.add_argument("--line-ending", choices=sorted(LINE_ENDINGS) + ["mixed"], default="lf",
+                        help="Line endings of the synthetic playlists.")
+    parser.add_argument("--blank-lines", type=float, default=0.0, help="Fraction of entries preceded by a blank line.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic generator.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per stage; the minimum is reported.")
+    parser.add_argument("--no-real", action="store_true", help="Skip the playlists in best/ and specialiptvs/.")
+    parser.add_argument("--no-fetch", action="store_true", help="Skip the local HTTP fetch and pipeline stages.")
+    parser.add_argument("--output-dir", default=BENCH_RESULTS_DIR, help="Directory for the JSON results.")
+    parser.add_argument("--compare", help="Previous JSON result to compare against.")
+    parser.add_argument("--cpu-scaling", action="store_true",
+                        help="Also time the process-pool CPU stage at 1, 2, 4, ... --max-cpu processes.")
+    parser.add_argument("--max-cpu", type=int, default=os.cpu_count() or 1,
+                        help="Largest process count for --cpu-scaling.")
+    parser.add_argument("--cpu-copies", type=int, default=4,
+                        help="How many times each playlist is processed per --cpu-scaling step.")
+    parser.add_argument("--parity", action="store_true",
+                        help="Only check byte-identical output against the reference implementation on "
+                             "best/best1.m3u and specialiptvs/*.m3u (exit code 1 on a mismatch).")
+    return parser.parse_args(argv)
+
+
+# --- Main Function ---
+def main(argv: Optional[List[str]] = None) -> int:
+    """Runs the benchmarks, prints a report and writes the JSON result. Returns the exit code."""
+    args = parse_args(argv)
+    if args.parity:
+        paths = sorted(path for pattern in PARITY_PLAYLIST_GLOBS for path in glob.glob(pattern))
+        if not paths:
+            print_colored("No playlists to check.", "red")
+            return 1
+        work_dir = tempfile.mkdtemp(prefix="m3uparity-")
+        try:
+            mismatches = check_reference_parity(paths, work_dir, args.seed)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        print_colored(f"Reference parity: {len(paths) - mismatches} of {len(paths)} playlists identical.",
+                      "red" if mismatches else "green")
+        return 1 if mismatches else 0
+    previous = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+
+    inputs = build_inputs(args)
+    if not inputs:
+        print_colored("Nothing to benchmark.", "red")
+        return 1
+
+    work_dir = tempfile.mkdtemp(prefix="m3ubench-")
+    results = []
+    cpu_scaling = None
+    try:
+        serve_dir = os.path.join(work_dir, "serve")
+        os.makedirs(serve_dir)
+        filenames = []
+        for index, (_, data) in enumerate(inputs, start=1):
+            filenames.append(f"playlist{index}.m3u")
+            with open(os.path.join(serve_dir, filenames[-1]), "wb") as f:
+                f.write(data)
+
+        server = contextlib.nullcontext(None) if args.no_fetch else serve_directory(serve_dir)
+        with server as base_url:
+            for (label, data), filename in zip(inputs, filenames):
+                print_colored(f"Benchmarking {label}...", "magenta")
+                results.append(bench_playlist(label, filename, data, base_url, work_dir, args.repeat))
+
+        if args.cpu_scaling:
+            print_colored(f"Benchmarking CPU stage scaling (up to {args.max_cpu} processes)...", "magenta")
+            cpu_scaling = bench_cpu_scaling(inputs, work_dir, max(1, args.max_cpu), max(1, args.cpu_copies))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    run = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "cpu_count": os.cpu_count(),
+        "results": results,
+        "cpu_scaling": cpu_scaling,
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_path = os.path.join(args.output_dir, f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(run, f, indent=2)
+
+    print_report(results, previous)
+    print_colored(f"Results written to {output_path}", "green")
+    return 0 if all(r["parser_parity"] for r in results) else 1
+
+
+# --- Entry Point ---
+if __name__ == "__main__":
+    sys.exit(main())
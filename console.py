@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+Colored console output shared by hotrun.py and its helper modules (dnscache, journal), so the
+helpers can warn in the same colors without importing hotrun.
+"""
+import os
+import sys
+
+
+# --- Helper Function for Colored Output ---
+def print_colored(text: str, color: str) -> None:
+    """Prints colored text to the console."""
+    colors = {
+        "green": "\033[92m", "red": "\033[91m", "yellow": "\033[93m",
+        "cyan": "\033[96m", "magenta": "\033[95m", "white": "\033[97m"
+    }
+    # Check if output is a TTY (terminal)
+    if sys.stdout.isatty() and os.name != 'nt': # Basic check, might need refinement for Windows
+        try:
+            print(f"{colors.get(color.lower(), '')}{text}\033[0m")
+        except Exception:
+            print(text) # Fallback if encoding fails
+    else:
+        print(text) # Print without color if not a TTY or on Windows without specific support
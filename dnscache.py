@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Up-front DNS resolution shared by hotrun.py, toptv.py and pipeline.py.
+
+The playlist and stream URLs of a run point at a few hundred distinct hosts, but every request
+would otherwise ask the blocking system resolver again. DNSCache resolves all hosts of a run
+concurrently with dnspython before the workers start, remembers the addresses for their TTL
+(and dead names for DNS_NEGATIVE_TTL_SEC) in .m3ucache/dns.json between runs, and hands the
+cached addresses to aiohttp (CachedResolver) and to the requests sessions that mount a
+CachedHTTPAdapter (urllib3 itself is not patched, other sessions resolve as usual).
+URLs on names that do not resolve are skipped before any worker is spent on them.
+"""
+import os
+import json
+import time
+import socket
+import asyncio
+import ipaddress
+from typing import List, Optional, Dict, Any, Iterable, Tuple, Callable
+from urllib.parse import urlparse
+
+import aiohttp
+import aiohttp.abc
+import requests.adapters
+import urllib3
+import urllib3.connection
+import urllib3.connectionpool
+
+import metrics
+from console import print_colored
+
+try:
+    import dns.asyncresolver # dnspython (optional: without it every lookup goes to the system resolver)
+    import dns.exception
+    import dns.resolver
+except ImportError:
+    dns = None
+
+# --- Constants ---
+DNS_CACHE_FILE = os.path.join('.m3ucache', 'dns.json') # Cached between workflow runs
+DNS_CONCURRENCY = 100 # Lookups in flight
+DNS_TIMEOUT = 5.0 # Seconds per lookup (all nameservers and retries)
+DNS_MIN_TTL_SEC = 60 # Addresses are kept at least this long, whatever the record TTL
+DNS_MAX_TTL_SEC = 6 * 3600
+DNS_NEGATIVE_TTL_SEC = 30 * 60 # NXDOMAIN / no address records
+DNS_FAILURE_TTL_SEC = 5 * 60 # SERVFAIL and other nameserver failures, often transient
+
+
+def get_hostname(url: str) -> Optional[str]:
+    """Lowercased hostname of a URL (no port), or None."""
+    try:
+        return urlparse(url).hostname
+    except ValueError:
+        return None
+
+
+def is_dns_name(host: Optional[str]) -> bool:
+    """
+    True for names this module resolves. IP literals need no lookup, and single-label names
+    (localhost, LAN or /etc/hosts names) are left to the system resolver.
+    """
+    if not host or '.' not in host:
+        return False
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return True
+    return False
+
+
+class DNSCache:
+    """
+    Hostname -> addresses with expiry, including negative entries for names that do not
+    resolve. resolve() looks up every given name without a fresh entry, concurrently;
+    lookup() and dead_reason() only read the cache, so they are cheap enough for every request.
+    Persisted as {host: [expires_at, [addresses], error or null]}.
+    """
+
+    def __init__(self, path: Optional[str] = DNS_CACHE_FILE) -> None:
+        self.path = path
+        self._entries: Dict[str, Tuple[float, List[str], Optional[str]]] = {}
+        self._pending: Dict[str, asyncio.Future] = {}
+        self.resolved = 0 # Lookups done by this process
+        self.available = dns is not None
+        self._load()
+
+    def _load(self) -> None:
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print_colored(f"Warning: Could not read DNS cache '{self.path}': {e}", "yellow")
+            return
+        now = time.time()
+        for host, entry in saved.items():
+            if isinstance(entry, list) and len(entry) == 3 and entry[0] > now:
+                self._entries[host] = (entry[0], list(entry[1]), entry[2])
+
+    def save(self) -> None:
+        """Writes the unexpired entries atomically."""
+        if not self.path:
+            return
+        temp_path = self.path + f".{os.getpid()}.tmp"
+        now = time.time()
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            data = {host: list(entry) for host, entry in self._entries.items() if entry[0] > now}
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print_colored(f"Warning: Could not save DNS cache '{self.path}': {e}", "yellow")
+
+    def _fresh(self, host: Optional[str]) -> Optional[Tuple[float, List[str], Optional[str]]]:
+        entry = self._entries.get(host) if host else None
+        if entry is not None and entry[0] <= time.time():
+            return None
+        return entry
+
+    def lookup(self, host: Optional[str]) -> Optional[List[str]]:
+        """Fresh cached addresses of host, or None (unknown, expired or dead)."""
+        entry = self._fresh(host)
+        return entry[1] if entry is not None and entry[1] else None
+
+    def dead_reason(self, host: Optional[str]) -> Optional[str]:
+        """'nxdomain', 'no_address' or 'servfail' if host is cached as not resolving, else None."""
+        entry = self._fresh(host)
+        return entry[2] if entry is not None else None
+
+    def url_dead_reason(self, url: str) -> Optional[str]:
+        return self.dead_reason(get_hostname(url))
+
+    async def resolve(self, hosts: Iterable[Optional[str]]) -> int:
+        """
+        Resolves every DNS name among hosts that has no fresh entry, DNS_CONCURRENCY at a time.
+        Names already being resolved (by a concurrent call) are waited on, not looked up twice.
+        Returns:
+            The number of names looked up by this call.
+        """
+        if dns is None:
+            return 0
+        semaphore = asyncio.Semaphore(DNS_CONCURRENCY)
+        tasks = []
+        started = 0
+        for host in set(hosts):
+            if not is_dns_name(host) or self._fresh(host) is not None:
+                continue
+            task = self._pending.get(host)
+            if task is None:
+                task = self._pending[host] = asyncio.ensure_future(self._resolve_one(host, semaphore))
+                task.add_done_callback(lambda _, host=host: self._pending.pop(host, None))
+                started += 1
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+        return started
+
+    def resolve_blocking(self, hosts: Iterable[Optional[str]]) -> int:
+        """resolve() for callers without an event loop."""
+        return asyncio.run(self.resolve(hosts))
+
+    async def _resolve_one(self, host: str, semaphore: asyncio.Semaphore) -> None:
+        async with semaphore:
+            with metrics.trace_url(host, 'dns'), metrics.stage('resolve'):
+                try:
+                    resolver = dns.asyncresolver.get_default_resolver()
+                    try:
+                        answer = await resolver.resolve(host, 'A', lifetime=DNS_TIMEOUT)
+                    except dns.resolver.NoAnswer:
+                        answer = await resolver.resolve(host, 'AAAA', lifetime=DNS_TIMEOUT)
+                except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as e:
+                    error = 'nxdomain' if isinstance(e, dns.resolver.NXDOMAIN) else 'no_address'
+                    self._entries[host] = (time.time() + DNS_NEGATIVE_TTL_SEC, [], error)
+                    metrics.set_outcome(error)
+                    return
+                except dns.resolver.NoNameservers:
+                    self._entries[host] = (time.time() + DNS_FAILURE_TTL_SEC, [], 'servfail')
+                    metrics.set_outcome('servfail')
+                    return
+                except (dns.exception.DNSException, OSError) as e:
+                    # Unknown (timeout, no resolver configuration...): left to the system resolver
+                    metrics.set_outcome('timeout' if isinstance(e, dns.exception.Timeout) else 'error')
+                    return
+                finally:
+                    self.resolved += 1
+                addresses = [record.to_text() for record in answer]
+                ttl = min(max(answer.rrset.ttl, DNS_MIN_TTL_SEC), DNS_MAX_TTL_SEC)
+                self._entries[host] = (time.time() + ttl, addresses, None)
+                metrics.set_outcome('resolved')
+
+    def summary(self, hosts: Iterable[Optional[str]]) -> Tuple[int, int]:
+        """(names with cached addresses, names cached as dead) among hosts."""
+        names = {host for host in hosts if is_dns_name(host)}
+        return (sum(1 for host in names if self.lookup(host)),
+                sum(1 for host in names if self.dead_reason(host)))
+
+    def aiohttp_resolver(self) -> 'CachedResolver':
+        """A resolver for aiohttp.TCPConnector(resolver=...); create it inside the running loop."""
+        return CachedResolver(self)
+
+
+# --- HTTP Layers ---
+class CachedResolver(aiohttp.abc.AbstractResolver):
+    """aiohttp resolver answering from a DNSCache, falling back to the threaded system resolver."""
+
+    def __init__(self, cache: DNSCache) -> None:
+        self.cache = cache
+        self._fallback = aiohttp.ThreadedResolver()
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET) -> List[Dict[str, Any]]:
+        addresses = self.cache.lookup(host)
+        if addresses is None:
+            return await self._fallback.resolve(host, port, family)
+        infos = []
+        for address in addresses:
+            address_family = socket.AF_INET6 if ':' in address else socket.AF_INET
+            if family in (socket.AF_UNSPEC, address_family):
+                infos.append({'hostname': host, 'host': address, 'port': port, 'family': address_family,
+                              'proto': 0, 'flags': socket.AI_NUMERICHOST | socket.AI_NUMERICSERV})
+        return infos or await self._fallback.resolve(host, port, family)
+
+    async def close(self) -> None:
+        await self._fallback.close()
+
+
+class CachedConnectionMixin(metrics.TimedConnectionMixin):
+    """
+    urllib3 connection that connects to the cached addresses of its host, trying them in
+    order, instead of asking the system resolver (hosts without a cached entry resolve as
+    before). TLS still verifies against, and sends SNI for, the hostname. The lookup and the
+    connection setup are timed as 'dns' and 'connect' (see metrics.TimedConnectionMixin). Once
+    connected, the socket (TLS-wrapped for HTTPS) is handed to on_connect, e.g. to abort the
+    request later.
+    """
+    dns_cache: Optional[DNSCache] = None
+    on_connect: Optional[Callable[[socket.socket], None]] = None
+
+    def connect(self) -> None:
+        super().connect()
+        if self.on_connect is not None and self.sock is not None:
+            self.on_connect(self.sock)
+
+    def lookup_addresses(self) -> List[str]:
+        """Cached addresses of the host, else the system resolver's."""
+        addresses = self.dns_cache.lookup(self._dns_host) if self.dns_cache is not None else None
+        return addresses or super().lookup_addresses()
+
+
+class CachedHTTPConnection(CachedConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+
+class CachedHTTPSConnection(CachedConnectionMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+
+class CachedPoolMixin:
+    """Connection pool handing its DNSCache and on_connect hook to every connection it creates."""
+    dns_cache: Optional[DNSCache] = None
+    on_connect: Optional[Callable[[socket.socket], None]] = None
+
+    def _new_conn(self) -> Any:
+        connection = super()._new_conn()
+        connection.dns_cache = self.dns_cache
+        connection.on_connect = self.on_connect
+        return connection
+
+
+class CachedHTTPConnectionPool(CachedPoolMixin, urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = CachedHTTPConnection
+
+
+class CachedHTTPSConnectionPool(CachedPoolMixin, urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = CachedHTTPSConnection
+
+
+class CachedPoolManager(urllib3.PoolManager):
+    """PoolManager whose pools connect through a DNSCache and report their sockets (see CachedConnectionMixin)."""
+
+    def __init__(self, dns_cache: Optional[DNSCache], on_connect: Optional[Callable[[socket.socket], None]] = None,
+                 **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.dns_cache = dns_cache
+        self.on_connect = on_connect
+        self.pool_classes_by_scheme = {'http': CachedHTTPConnectionPool, 'https': CachedHTTPSConnectionPool}
+
+    def _new_pool(self, scheme: str, host: str, port: int, request_context: Optional[Dict[str, Any]] = None) -> Any:
+        pool = super()._new_pool(scheme, host, port, request_context)
+        pool.dns_cache = self.dns_cache
+        pool.on_connect = self.on_connect
+        return pool
+
+
+class CachedHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    requests adapter whose connections use the cached addresses of a DNSCache (None: the system
+    resolver), record their dns/connect times and hand every new socket to on_connect. Mount it
+    on the sessions that should use them; the rest of the process (other sessions, other
+    libraries) is not affected. Requests through a proxy do not go through it (the proxy resolves).
+    """
+
+    def __init__(self, dns_cache: Optional[DNSCache] = None,
+                 on_connect: Optional[Callable[[socket.socket], None]] = None, **kwargs: Any) -> None:
+        self.dns_cache = dns_cache # Set before HTTPAdapter.__init__ builds the pool manager
+        self.on_connect = on_connect
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections: int, maxsize: int, block: bool = requests.adapters.DEFAULT_POOLBLOCK,
+                         **pool_kwargs: Any) -> None:
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = CachedPoolManager(self.dns_cache, self.on_connect, num_pools=connections, maxsize=maxsize,
+                                             block=block, **pool_kwargs)
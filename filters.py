@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Channel filter and group ordering rules shared by hotrun.py, toptv.py, pipeline.py and master.py.
+
+A rule file (JSON, FILTER_RULES_FILE by default) replaces the hardcoded 'Bein' requirement
+and the sort_groups priority terms:
+
+    {
+      "description": "'Bein' group",
+      "require": {"group": ["bein"]},
+      "include": {},
+      "exclude": {"name": ["xxx"], "url": ["/movie/"]},
+      "tiers": [
+        {"name": "iran", "group": ["iran", "persian", {"contains": "ir", "unless": ["iraq", "ireland"]}]},
+        {"name": "sports", "group": ["bein", "sport", "spor", "canal+", "dazn", "paramount"]}
+      ]
+    }
+
+A condition set maps a field ('group', 'name', 'url' or an attribute key such as 'tvg-id')
+to patterns; a channel matches it if any pattern is a case-insensitive substring of that
+field. A pattern may carry "unless" substrings that void it. 'exclude' drops channels,
+a non-empty 'include' keeps only matching channels, and a playlist is saved only if one
+kept channel matches 'require' (every playlist with channels if it is empty). Groups are
+ordered by the first tier term they match (tiers in order, terms in order), then
+alphabetically.
+
+Rules compile once: all group patterns go into one Aho-Corasick automaton, run once per
+distinct group title and memoized, and the name, url and attribute patterns of each
+condition set become one combined regex per field, so a channel costs a dict lookup plus
+at most a few regex searches however many rules there are.
+"""
+import os
+import re
+import json
+import hashlib
+from collections import deque
+from typing import List, Optional, Dict, Any, Tuple, Callable
+
+# --- Constants ---
+FILTER_RULES_FILE = "filter_rules.json" # Optional; the built-in DEFAULT_RULES apply without it
+GROUP_FIELD = 'group'
+CHANNEL_FIELDS = ('name', 'url') # Everything else is an attribute key
+CONDITION_SETS = ('require', 'include', 'exclude')
+GROUP_CACHE_MAX = 200000 # Memoized group titles before the memo is cleared
+DEFAULT_RULES: Dict[str, Any] = {
+    "description": "'Bein' group",
+    "require": {"group": ["bein"]},
+    "include": {},
+    "exclude": {},
+    "tiers": [
+        {"name": "iran", "group": ["iran", "persian", {"contains": "ir", "unless": ["iraq", "ireland"]}]},
+        {"name": "sports", "group": ["bein", "sport", "spor", "canal+", "dazn", "paramount"]},
+    ],
+}
+
+
+# --- Multi-Pattern Matcher ---
+class AhoCorasick:
+    """
+    Aho-Corasick automaton over lowercase literals: find() reports every pattern occurring
+    in a text in one left-to-right pass, however many patterns there are.
+    """
+
+    def __init__(self, patterns: List[str]) -> None:
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Tuple[int, ...]] = [()]
+        for pattern_id, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = self._goto[state][char] = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                state = next_state
+            self._out[state] += (pattern_id,)
+
+        # Breadth-first, so the failure state (a shorter suffix) is always complete before it is used
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._out[next_state] += self._out[self._fail[next_state]]
+
+    def find(self, text: str) -> set:
+        """Ids of the patterns occurring in text (which must already be lowercase)."""
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+# --- Rule Compilation ---
+def parse_pattern(pattern: Any) -> Tuple[str, Tuple[str, ...]]:
+    """Returns (literal, unless literals), lowercased, of a pattern string or {"contains", "unless"} object."""
+    if isinstance(pattern, str):
+        literal, unless = pattern, []
+    elif isinstance(pattern, dict) and isinstance(pattern.get('contains'), str):
+        literal, unless = pattern['contains'], pattern.get('unless', [])
+        if not isinstance(unless, list) or not all(isinstance(u, str) and u for u in unless):
+            raise ValueError(f"'unless' of pattern {pattern!r} must be a list of non-empty strings")
+    else:
+        raise ValueError(f"Invalid pattern {pattern!r}: expected a string or {{\"contains\": ..., \"unless\": [...]}}")
+    if not literal:
+        raise ValueError("Empty pattern")
+    return literal.lower(), tuple(u.lower() for u in unless)
+
+
+def compile_field_regex(field: str, patterns: List[Tuple[str, Tuple[str, ...]]]) -> 're.Pattern':
+    """
+    One case-insensitive regex matching any of the patterns. For 'name' and 'url' it is
+    searched in the field value, for an attribute key in the raw #EXTINF attribute string
+    (key="...pattern...").
+    """
+    fragments = []
+    for literal, unless in patterns:
+        unless_re = "|".join(re.escape(u) for u in unless)
+        if field in CHANNEL_FIELDS:
+            fragment = f"^(?!.*(?:{unless_re})).*?{re.escape(literal)}" if unless else re.escape(literal)
+        else:
+            value_guard = f'(?![^"]*(?:{unless_re}))' if unless else ''
+            fragment = f'(?<![\\w-]){re.escape(field)}="{value_guard}[^"]*?{re.escape(literal)}'
+        fragments.append(f"(?:{fragment})")
+    return re.compile("|".join(fragments), re.IGNORECASE | re.DOTALL)
+
+
+class GroupMatch:
+    """What the group-level rules say about one group title (memoized per title)."""
+    __slots__ = ('keep', 'required', 'excluded', 'included', 'rank')
+
+    def __init__(self, keep: bool, required: bool, excluded: bool, included: bool, rank: int) -> None:
+        self.keep = keep
+        self.required = required
+        self.excluded = excluded
+        self.included = included
+        self.rank = rank
+
+
+class FilterRules:
+    """
+    A compiled rule set (see the module docstring for the format). match_group() and
+    check_channel are used by hotrun.M3UStreamParser for every channel; sort_groups(),
+    group_rank() and group_priority() order groups for the writers and samplers.
+    Pickles as its spec, so it can be handed to worker processes.
+    """
+
+    def __init__(self, spec: Dict[str, Any], source: str = "built-in") -> None:
+        if not isinstance(spec, dict):
+            raise ValueError("Filter rules must be a JSON object")
+        unknown = set(spec) - {'description', 'tiers', *CONDITION_SETS}
+        if unknown:
+            raise ValueError(f"Unknown filter rule keys: {', '.join(sorted(unknown))}")
+        self.spec = spec
+        self.source = source
+        self.digest = hashlib.sha1(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        self.description = str(spec.get('description') or "required rules")
+
+        group_literals: List[str] = []
+        literal_ids: Dict[str, int] = {}
+
+        def literal_id(literal: str) -> int:
+            if literal not in literal_ids:
+                literal_ids[literal] = len(group_literals)
+                group_literals.append(literal)
+            return literal_ids[literal]
+
+        def compile_group_terms(patterns: List[Tuple[str, Tuple[str, ...]]]) -> List[Tuple[int, Tuple[int, ...]]]:
+            return [(literal_id(literal), tuple(literal_id(u) for u in unless)) for literal, unless in patterns]
+
+        # Condition sets: group terms for the automaton, a combined regex per channel field
+        self._group_terms: Dict[str, List[Tuple[int, Tuple[int, ...]]]] = {}
+        self._channel_checks: Dict[str, Optional[Callable[[str, str, str], bool]]] = {}
+        for set_name in CONDITION_SETS:
+            conditions = spec.get(set_name) or {}
+            if not isinstance(conditions, dict):
+                raise ValueError(f"'{set_name}' must map fields to pattern lists")
+            group_patterns: List[Tuple[str, Tuple[str, ...]]] = []
+            field_regexes = []
+            for field, patterns in conditions.items():
+                if not isinstance(patterns, list):
+                    raise ValueError(f"'{set_name}.{field}' must be a list of patterns")
+                parsed = [parse_pattern(pattern) for pattern in patterns]
+                if not parsed:
+                    continue
+                if field == GROUP_FIELD:
+                    group_patterns.extend(parsed)
+                else:
+                    field_regexes.append((field, compile_field_regex(field, parsed)))
+            self._group_terms[set_name] = compile_group_terms(group_patterns)
+            self._channel_checks[set_name] = self._make_channel_check(field_regexes) if field_regexes else None
+        self.has_include = bool(self._group_terms['include'] or self._channel_checks['include'])
+        self.has_require = bool(self._group_terms['require'] or self._channel_checks['require'])
+
+        # Priority tiers: terms numbered across tiers in order (the rank of a group is its first matching term)
+        tiers = spec.get('tiers') or []
+        if not isinstance(tiers, list):
+            raise ValueError("'tiers' must be a list")
+        self.tier_names: List[str] = []
+        self._tier_of_rank: List[int] = []
+        tier_patterns: List[Tuple[str, Tuple[str, ...]]] = []
+        for tier_index, tier in enumerate(tiers):
+            if not isinstance(tier, dict) or not isinstance(tier.get(GROUP_FIELD), list):
+                raise ValueError(f"Tier {tier_index + 1} must be an object with a 'group' pattern list")
+            self.tier_names.append(str(tier.get('name') or f"tier{tier_index + 1}"))
+            for pattern in tier[GROUP_FIELD]:
+                tier_patterns.append(parse_pattern(pattern))
+                self._tier_of_rank.append(tier_index)
+        self._tier_terms = compile_group_terms(tier_patterns)
+        self.other_rank = len(self._tier_terms)
+
+        self._matcher = AhoCorasick(group_literals)
+        self._groups: Dict[str, GroupMatch] = {}
+        self.check_channel = self._check_channel if any(self._channel_checks.values()) else None
+
+    def __reduce__(self) -> Tuple[Any, Tuple[Dict[str, Any], str]]:
+        return FilterRules, (self.spec, self.source)
+
+    @staticmethod
+    def _make_channel_check(field_regexes: List[Tuple[str, 're.Pattern']]) -> Callable[[str, str, str], bool]:
+        checks = []
+        for field, regex in field_regexes:
+            index = {'name': 0, 'url': 2}.get(field, 1) # Attribute regexes search the attribute string
+            checks.append((index, regex.search))
+
+        def check(name: str, attributes_str: str, url: str) -> bool:
+            values = (name, attributes_str, url)
+            return any(search(values[index]) for index, search in checks)
+        return check
+
+    def match_group(self, group_title: str) -> GroupMatch:
+        """Group-level verdict for group_title, from one automaton pass (memoized)."""
+        match = self._groups.get(group_title)
+        if match is not None:
+            return match
+        found = self._matcher.find(group_title.lower())
+
+        def any_term(terms: List[Tuple[int, Tuple[int, ...]]]) -> bool:
+            return any(term in found and not found.intersection(unless) for term, unless in terms)
+
+        excluded = any_term(self._group_terms['exclude'])
+        included = any_term(self._group_terms['include'])
+        required = any_term(self._group_terms['require']) if self.has_require else True
+        rank = self.other_rank
+        for term_rank, (term, unless) in enumerate(self._tier_terms):
+            if term in found and not found.intersection(unless):
+                rank = term_rank
+                break
+        keep = not excluded and (included or not self.has_include)
+        match = GroupMatch(keep, required and keep, excluded, included, rank)
+        if len(self._groups) >= GROUP_CACHE_MAX:
+            self._groups.clear()
+        self._groups[group_title] = match
+        return match
+
+    def _check_channel(self, match: GroupMatch, name: str, attributes_str: str, url: str) -> Tuple[bool, bool]:
+        """(keep, matches 'require') of one channel when name, url or attribute rules exist."""
+        checks = self._channel_checks
+        if match.excluded or (checks['exclude'] is not None and checks['exclude'](name, attributes_str, url)):
+            return False, False
+        if self.has_include and not match.included:
+            if checks['include'] is None or not checks['include'](name, attributes_str, url):
+                return False, False
+        if match.required or not self.has_require:
+            return True, True
+        return True, checks['require'] is not None and checks['require'](name, attributes_str, url)
+
+    def group_rank(self, group_title: str) -> int:
+        """Position of the first tier term matching group_title, or other_rank if none does."""
+        return self.match_group(str(group_title)).rank
+
+    def group_priority(self, group_title: str) -> int:
+        """Tier index of group_title (0 = first tier), or the number of tiers for other groups."""
+        rank = self.group_rank(group_title)
+        return self._tier_of_rank[rank] if rank < self.other_rank else len(self.tier_names)
+
+    def sort_groups(self, group_names: List[Any]) -> List[str]:
+        """
+        Tier groups first, by the rank of the first term they match and then in input order;
+        all other groups alphabetically. Names are compared case-insensitively, and case
+        variants collapse into one entry (the last spelling, at the first one's position).
+        """
+        normalized_map = {str(name).lower(): str(name) for name in group_names if isinstance(name, (str, int, float))}
+        ranked = []
+        others = []
+        for position, (group_lower, group_name) in enumerate(normalized_map.items()):
+            rank = self.group_rank(group_lower)
+            if rank < self.other_rank:
+                ranked.append((rank, position, group_name))
+            else:
+                others.append((group_lower, group_name))
+        ranked.sort()
+        others.sort()
+        return [group_name for _, _, group_name in ranked] + [group_name for _, group_name in others]
+
+    def summary(self) -> str:
+        """One line for the run header."""
+        tiers = " > ".join(self.tier_names) or "none"
+        return f"{self.source} (required: {self.description}; tiers: {tiers}; digest {self.digest})"
+
+
+# --- Loading ---
+def load_rules(path: Optional[str] = FILTER_RULES_FILE) -> FilterRules:
+    """
+    Compiles the rule file at path, or DEFAULT_RULES if path is empty or the file does not exist.
+    Raises ValueError if the file cannot be read or is not a valid rule set.
+    """
+    if not path or not os.path.exists(path):
+        return FilterRules(DEFAULT_RULES)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            spec = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"Could not read filter rules '{path}': {e}") from e
+    try:
+        return FilterRules(spec, path)
+    except ValueError as e:
+        raise ValueError(f"Invalid filter rules '{path}': {e}") from e
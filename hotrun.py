@@ -5,31 +5,79 @@ import os
 import shutil
 import re # Import regular expressions for parsing
 import io  # Import for handling bytes in memory
-from typing import List, Optional, Dict, Any, Tuple
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import codecs # Incremental decoding for the streaming parser
+import collections # Waiter queue of the async adaptive limiter
+from typing import List, Optional, Dict, Any, Tuple, Iterator, AsyncIterator, Callable, Set, Iterable
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
 import sys # Import sys for version check and exit
 import traceback # For detailed error logging
-import signal # For Ctrl+C handling
+import hashlib # Content hashes for the playlist cache, stable output names
+import filecmp # Skip restoring cached outputs that are already in place
+import heapq # Bottom-k MinHash sketches for near-duplicate clustering
+import json # Playlist cache index
+import mmap # Random access to saved playlists (PlaylistReader)
+import struct # Header length of the playlist index
+from array import array # Packed record offsets of the playlist index
+import signal # For Ctrl+C / SIGTERM handling
+import socket # Aborting in-flight downloads on cancellation
+import weakref # Connections of in-flight downloads
+import argparse # Command line options (engine selection, worker count)
+import asyncio # Event loop for the async download engine
+import threading # Shutdown event shared between engines
+import aiohttp # Async HTTP client for the async download engine
+import contextvars # Carries the per-URL metrics trace into executor threads
+import metrics # Per-URL stage timings and outcomes
+import dnscache # Up-front concurrent DNS resolution shared with the HTTP layers
+import filters # Compiled include/exclude/require rules and group priority tiers
+from console import print_colored # Colored output, shared with dnscache and journal
+import journal # Per-URL progress journal for resumable runs
+from contextlib import contextmanager, asynccontextmanager # Per-host slots
+from urllib.parse import urlparse # Host extraction for per-host scheduling
+try:
+    import resource # Peak RSS reporting (not available on Windows)
+except ImportError:
+    resource = None
 
 # --- Constants ---
 MAX_SIZE_MB = 30 # Maximum file size in Megabytes to process
 MAX_SIZE_BYTES = MAX_SIZE_MB * 1024 * 1024 # Convert MB to Bytes
-
-# --- Helper Function for Colored Output ---
-def print_colored(text: str, color: str) -> None:
-    """Prints colored text to the console."""
-    colors = {
-        "green": "\033[92m", "red": "\033[91m", "yellow": "\033[93m",
-        "cyan": "\033[96m", "magenta": "\033[95m", "white": "\033[97m"
-    }
-    # Check if output is a TTY (terminal)
-    if sys.stdout.isatty() and os.name != 'nt': # Basic check, might need refinement for Windows
-        try:
-            print(f"{colors.get(color.lower(), '')}{text}\033[0m")
-        except Exception:
-            print(text) # Fallback if encoding fails
-    else:
-        print(text) # Print without color if not a TTY or on Windows without specific support
+DOWNLOAD_TIMEOUT = 30 # Seconds, used as connect/read timeout by both engines
+DOWNLOAD_CHUNK_SIZE = 65536 # Larger chunk size for potentially faster downloads
+REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36',
+    'Accept': '*/*', # Be more lenient with accept header
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive'
+}
+ENGINES = ("thread", "async")
+LINE_BREAK_CHARS = "\r\n\v\f\x1c\x1d\x1e\x85\u2028\u2029" # Everything str.splitlines() splits on
+PER_HOST_LIMIT = 6 # Max in-flight requests per panel host
+HOST_BACKOFF_STATUSES = (403, 429, 500, 502, 503, 504) # Statuses that slow a host down
+HOST_BACKOFF_BASE = 1.0 # Seconds, first backoff step
+HOST_BACKOFF_MAX = 60.0 # Seconds, backoff ceiling
+CACHE_DIR = ".m3ucache" # Persistent conditional-GET / content-hash cache
+CACHE_MAX_AGE_DAYS = 7 # Evict cache entries unused for longer than this
+CACHE_MAX_TOTAL_MB = 500 # Evict least recently used entries beyond this total size
+SAVE_BUFFER_SIZE = 1024 * 1024 # Write buffer for reconstructed playlists
+DEDUPE_SIMILARITY = 0.9 # Estimated Jaccard similarity at which two saved playlists are the same backend
+MINHASH_SKETCH_SIZE = 128 # Bottom-k sketch size (estimate error is roughly 1/sqrt(k))
+CLUSTERS_MANIFEST = "clusters.json" # Representative -> fallback sources, written to the output folder
+INDEX_DIR = os.path.join(CACHE_DIR, "indexes") # Byte-offset indexes of saved playlists, <sha1 of the playlist>.idx
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b'M3UIDX1\n' # First bytes of a playlist index (format version 1)
+INDEX_CHECK_BYTES = 4096 # Bytes hashed at each end of a playlist to tie its index to it
+JOURNAL_FILE = "hotrun.journal" # Per-URL progress of an unfinished run, in the cache directory
+CANCEL_DRAIN_SEC = 5.0 # Seconds a cancelled run waits for aborted downloads before it stops waiting
+CANCEL_POLL_SEC = 0.5 # How often waiting loops check the shutdown event
+AIMD_START = 32 # Concurrency an adaptive limit starts from (doubles per window until the first sign of trouble)
+AIMD_INCREASE = 1 # Slots added per healthy window after that
+AIMD_BACKOFF = 0.5 # Factor the limit is cut by when timeouts, resets and 5xx rise
+AIMD_MIN_WINDOW = 50 # Results per decision at least (a window is max(limit, this) results)
+AIMD_ERROR_MARGIN = 0.15 # Window congestion rate this far above the baseline cuts the limit
+AIMD_LATENCY_TOLERANCE = 2.0 # Window mean TTFB above this multiple of the baseline holds the limit
+AIMD_BASELINE_WEIGHT = 0.2 # EWMA weight of the newest window in the baselines
+CONGESTION_OUTCOMES = ('timeout', 'reset', 'disconnected', 'proxy_timeout', 'proxy_error', 'connect_error',
+                       'http_429') # Plus every http_5xx
 
 # --- Function to Read M3U URLs from File ---
 def get_m3u_urls_from_file(file_path: str) -> List[str]:
@@ -56,171 +104,1508 @@ def get_m3u_urls_from_file(file_path: str) -> List[str]:
         print_colored(f"Error reading file '{file_path}': {e}", "red")
     return m3u_urls
 
-# --- Group Sorting Function ---
+# --- Filter Rules and Group Sorting ---
+# Active rule set: filters.DEFAULT_RULES (a 'Bein' group is required; Iran/Persian, then sports
+# groups first) unless main() loads a rule file with set_filter_rules
+FILTER_RULES = filters.FilterRules(filters.DEFAULT_RULES)
+
+
+def set_filter_rules(rules: filters.FilterRules) -> None:
+    """Makes rules the active rule set of this process (also the CpuStage worker initializer)."""
+    global FILTER_RULES
+    FILTER_RULES = rules
+
+
+def load_filter_rules(path: Optional[str]) -> filters.FilterRules:
+    """Loads and activates the rule file at path (built-in rules if it does not exist); exits if it is invalid."""
+    try:
+        rules = filters.load_rules(path)
+    except ValueError as e:
+        print_colored(f"Fatal Error: {e}", "red")
+        sys.exit(1)
+    set_filter_rules(rules)
+    return rules
+
+
+def get_group_priority(group_name: str) -> int:
+    """Returns the priority tier of a group: 0 for the first tier (Iran/Persian by default), 1 for the next (sports), ..., the number of tiers otherwise."""
+    return FILTER_RULES.group_priority(group_name)
+
+
+def get_group_rank(group_name: str) -> int:
+    """Returns the position of the first tier term matching a group (sort_groups order), or FILTER_RULES.other_rank."""
+    return FILTER_RULES.group_rank(group_name)
+
+
 def sort_groups(group_names: List[str]) -> List[str]:
     """
-    Sort groups based on specific priority rules:
+    Sort groups based on the priority tiers of the active filter rules (by default):
     1. First priority (exact order): iran -> persian -> ir (specific)
     2. Second priority (exact order): bein -> sport -> spor -> canal+ -> dazn -> paramount
     3. All other groups alphabetically.
+    Each group's rank comes from one memoized multi-pattern match instead of a scan per term.
     Args:
         group_names: List of group names to sort
     Returns:
         Sorted list of group names
     """
-    normalized_map = {str(name).lower(): str(name) for name in group_names if isinstance(name, (str, int, float))} # Handle simple types
-    lower_groups_unique = list(normalized_map.keys())
+    return FILTER_RULES.sort_groups(group_names)
+
+
+# --- Precompiled M3U Patterns ---
+# One #EXTINF line followed directly by its URL line; used with finditer over whole blocks of text
+EXTINF_PAIR_RE = re.compile(r'#EXTINF:(-?\d+)([^,\n]*),([^\n]*)\n[^\S\n]*([^#\s][^\n]*)')
+EXTINF_LINE_RE = re.compile(r'#EXTINF:(?P<duration>-?\d+)(?P<attributes_str>.*?),\s*(?P<name>.*)')
+# Regex to capture key="value" or key=value
+ATTRIBUTE_RE = re.compile(r'([a-zA-Z0-9_\-]+)=?(?:"([^"]*)"|([^ ]*))')
+# Attribute strings made only of key="value" pairs ending in group-title (the usual layout)
+CANONICAL_GROUP_ATTRIBUTES_RE = re.compile(r'(?:[a-zA-Z0-9_\-]+="[^"]*" )*group-title="([^"]*)"')
+# Keys of a canonical attribute string
+CANONICAL_ATTRIBUTE_KEY_RE = re.compile(r'([a-zA-Z0-9_\-]+)="[^"]*"')
+
+
+def has_unusual_line_breaks(text: str) -> bool:
+    """
+    True if text has line breaks other than LF / CRLF (a trailing CR is fine, it may pair
+    with an LF in the next chunk). Such text takes the line-by-line path.
+    """
+    for char in '\v\f\x1c\x1d\x1e\x85\u2028\u2029':
+        if char in text:
+            return True
+    if '\r' in text:
+        return text.count('\r') != text.count('\r\n') + text.endswith('\r')
+    return False
+
+
+def parse_attributes(attributes_str: str) -> Tuple[Tuple[str, str], ...]:
+    """Parses an #EXTINF attribute string into (key, value) pairs; a repeated key keeps its first position and last value."""
+    attributes = {}
+    for key, val_quoted, val_unquoted in ATTRIBUTE_RE.findall(attributes_str):
+        attributes[key] = val_quoted if val_quoted else val_unquoted
+    return tuple((sys.intern(key), value) for key, value in attributes.items())
+
+
+def extract_group_title(attributes_str: str) -> str:
+    """Returns the (interned) group-title of an attribute string, 'General' if it has none."""
+    if 'group-title' not in attributes_str:
+        return "General"
+    canonical = CANONICAL_GROUP_ATTRIBUTES_RE.fullmatch(attributes_str)
+    if canonical is not None:
+        return sys.intern(canonical.group(1))
+    group_title = "General"
+    for key, val_quoted, val_unquoted in ATTRIBUTE_RE.findall(attributes_str):
+        if key == 'group-title':
+            group_title = val_quoted if val_quoted else val_unquoted
+    return sys.intern(group_title)
+
+
+# --- Compact Channel Record ---
+class Channel:
+    """
+    One playlist entry. Uses __slots__ and keeps the attributes as the raw attribute string
+    (tokenized on demand by the writer), with interned group titles, so a 30k-entry playlist
+    does not allocate a dict per channel plus one per attribute set.
+    """
+    __slots__ = ('duration', 'name', 'attributes_str', 'url', 'group_title')
+
+    def __init__(self, duration: int, name: str, attributes_str: str, url: str, group_title: str) -> None:
+        self.duration = duration
+        self.name = name
+        self.attributes_str = attributes_str
+        self.url = url
+        self.group_title = group_title
+
+    @property
+    def attributes(self) -> Tuple[Tuple[str, str], ...]:
+        """Attributes as (key, value) pairs, parsed from attributes_str."""
+        return parse_attributes(self.attributes_str)
+
+    def get_attribute(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        for attr_key, value in self.attributes:
+            if attr_key == key:
+                return value
+        return default
+
+    def __repr__(self) -> str:
+        return f"Channel({self.name!r}, group={self.group_title!r}, url={self.url!r})"
+
+
+# --- EXTINF Line Parser ---
+def parse_extinf_line(line: str) -> Optional[Tuple[int, str, str, str]]:
+    """
+    Parses one stripped '#EXTINF:' line.
+    Returns:
+        (duration, name, attributes_str, group_title), or None if the line is malformed.
+    """
+    match_extinf = EXTINF_LINE_RE.match(line)
+    if not match_extinf:
+        return None
 
-    priority1_lower = []
-    priority2_lower = []
-    processed_lower = set()
+    try:
+        duration = int(match_extinf.group('duration'))
+    except ValueError:
+        duration = -1
+    name = match_extinf.group('name').strip() or "Unnamed Channel" # Use default if name is empty
+    attributes_str = match_extinf.group('attributes_str').strip()
+    return duration, name, attributes_str, extract_group_title(attributes_str)
 
-    p1_terms = [('iran', lambda g: 'iran' in g),
-                ('persian', lambda g: 'persian' in g),
-                ('ir', lambda g: 'ir' in g and 'iraq' not in g and 'ireland' not in g)]
 
-    p2_terms = [('bein', lambda g: 'bein' in g),
-                ('sport', lambda g: 'sport' in g),
-                ('spor', lambda g: 'spor' in g),
-                ('canal+', lambda g: 'canal+' in g),
-                ('dazn', lambda g: 'dazn' in g),
-                ('paramount', lambda g: 'paramount' in g)]
+# --- Streaming M3U Parser ---
+_UNPARSED_EXTINF = object() # Pending marker for a malformed #EXTINF (its URL is consumed, no channel emitted)
 
-    for _, condition in p1_terms:
-        for group_lower in list(lower_groups_unique):
-            if condition(group_lower) and group_lower not in processed_lower:
-                priority1_lower.append(group_lower)
-                processed_lower.add(group_lower)
 
-    for _, condition in p2_terms:
-        for group_lower in list(lower_groups_unique):
-            if condition(group_lower) and group_lower not in processed_lower:
-                priority2_lower.append(group_lower)
-                processed_lower.add(group_lower)
+class M3UStreamParser:
+    """
+    Push-style incremental M3U parser. Feed it raw chunks as they arrive (feed) or decoded
+    text (feed_text); it decodes incrementally, keeps at most one partial line buffered,
+    and emits each channel as soon as its #EXTINF / URL pair is complete, so the body is
+    never held as bytes, text and split lines at the same time.
+    Complete lines are tokenized in one pass: EXTINF_PAIR_RE.finditer picks up every
+    #EXTINF line that is directly followed by its URL, and only the text between those
+    matches that still contains an #EXTINF (comments before the URL, missing URLs,
+    malformed lines) goes through the line-by-line state machine.
+    Each channel is checked against the filter rules as it is emitted (excluded channels are
+    dropped), which also sets found_bein when one matches the 'require' rules (by default:
+    its group contains 'Bein').
+    Also tracks the #EXTM3U header check, the byte count (for the size limit) and a
+    SHA-256 of the raw bytes (for the playlist cache).
+    """
 
-    other_groups_lower = sorted([
-        g for g in lower_groups_unique if g not in processed_lower
-    ])
+    def __init__(self, max_bytes: Optional[int] = MAX_SIZE_BYTES,
+                 on_channel: Optional[Callable[[Channel], None]] = None,
+                 rules: Optional[filters.FilterRules] = None) -> None:
+        self.max_bytes = max_bytes
+        self.on_channel = on_channel # None: collect into self.channels
+        self.rules = rules if rules is not None else FILTER_RULES
+        self.channels: List[Channel] = []
+        self.group_titles: set = set() # Groups of the channels kept
+        self._dropped_groups: set = set() # Groups the filter rules exclude
+        self.found_bein = False
+        self.is_m3u: Optional[bool] = None # None until enough of the stream is seen
+        self.bytes_fed = 0
+        self.size_exceeded = False
+        self._sha256 = hashlib.sha256()
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self._head = "" # First non-whitespace characters, for the #EXTM3U check
+        self._partial = "" # Trailing text not yet terminated by a line break
+        self._pending: Optional[Any] = None # Parsed #EXTINF waiting for its URL
+        self._closed = False
+
+    def feed(self, chunk: bytes) -> bool:
+        """
+        Feeds raw bytes. Returns False once the stream should be abandoned
+        (size limit exceeded or the body does not start with #EXTM3U).
+        """
+        self.bytes_fed += len(chunk)
+        if self.max_bytes is not None and self.bytes_fed > self.max_bytes:
+            self.size_exceeded = True
+            return False
+        self._sha256.update(chunk)
+        self.feed_text(self._decoder.decode(chunk))
+        return self.is_m3u is not False
+
+    def feed_text(self, text: str) -> None:
+        """Feeds decoded text."""
+        if not text:
+            return
+        if self.is_m3u is None:
+            head_text = text if self._head else text.lstrip()
+            self._head += head_text[:7 - len(self._head)]
+            if len(self._head) >= 7:
+                self.is_m3u = self._head == '#EXTM3U'
+
+        if self._partial:
+            text = self._partial + text
+        if not has_unusual_line_breaks(text):
+            # Only '\n' (or '\r\n') line breaks: tokenize up to the last one, keep the rest
+            end = text.rfind('\n') + 1
+            self._partial = text[end:]
+            if end:
+                self._tokenize(text, end)
+            return
+
+        lines = text.splitlines(keepends=True)
+        last_line = lines[-1]
+        # Hold back an unterminated last line, and a trailing '\r' that may pair with a '\n'
+        if last_line.rstrip(LINE_BREAK_CHARS) == last_line or last_line.endswith('\r'):
+            self._partial = lines.pop()
+        else:
+            self._partial = ""
+        for line in lines:
+            self._process_line(line.strip())
+
+    def close(self) -> None:
+        """Flushes the decoder, the last partial line and any channel still waiting for a URL."""
+        if self._closed:
+            return
+        self._closed = True
+        self.feed_text(self._decoder.decode(b'', final=True))
+        if self._partial:
+            self._process_line(self._partial.strip())
+            self._partial = ""
+        if self.is_m3u is None:
+            self.is_m3u = False # Shorter than '#EXTM3U'
+        self._emit_pending("")
+
+    def hexdigest(self) -> str:
+        """SHA-256 of all raw bytes fed so far."""
+        return self._sha256.hexdigest()
+
+    def result(self) -> Tuple[List[Channel], List[str], bool]:
+        """Returns (channels, unique group titles, found_bein) like parse_m3u_content."""
+        return self.channels, list(self.group_titles), self.found_bein
+
+    def _tokenize(self, text: str, end: int) -> None:
+        """Tokenizes text[:end], which holds complete LF-terminated lines only."""
+        group_titles = self.group_titles
+        emit = self.on_channel if self.on_channel is not None else self.channels.append
+        canonical_group = CANONICAL_GROUP_ATTRIBUTES_RE.fullmatch
+        dropped_groups = self._dropped_groups
+        match_group = self.rules.match_group
+        check_channel = self.rules.check_channel # None unless name/url/attribute rules exist
+        position = 0
+        for match in EXTINF_PAIR_RE.finditer(text, 0, end):
+            start = match.start()
+            if start and text[start - 1] != '\n' and text[text.rfind('\n', 0, start) + 1:start].strip():
+                continue # '#EXTINF:' in the middle of a line; left to the line-by-line path
+            if self._pending is not None or text.find('#EXTINF:', position, start) != -1:
+                self._process_gap(text[position:start])
+                self._emit_pending("") # An #EXTINF line ends any channel still waiting for a URL
+
+            duration, attributes_str, name, url = match.groups()
+            attributes_str = attributes_str.strip()
+            if 'group-title' not in attributes_str:
+                group_title = "General"
+            else:
+                canonical = canonical_group(attributes_str)
+                group_title = sys.intern(canonical.group(1)) if canonical is not None else extract_group_title(attributes_str)
+            position = match.end()
+            name = name.strip() or "Unnamed Channel"
+            url = url.rstrip()
+            if check_channel is None:
+                # Group rules only: decided once per group title
+                if group_title not in group_titles:
+                    if group_title in dropped_groups:
+                        continue
+                    group_match = match_group(group_title)
+                    if not group_match.keep:
+                        dropped_groups.add(group_title)
+                        continue
+                    group_titles.add(group_title)
+                    if group_match.required:
+                        self.found_bein = True
+            else:
+                keep, required = check_channel(match_group(group_title), name, attributes_str, url)
+                if not keep:
+                    continue
+                if required:
+                    self.found_bein = True
+                group_titles.add(group_title)
+            emit(Channel(int(duration), name, attributes_str, url, group_title))
+
+        if self._pending is not None or text.find('#EXTINF:', position, end) != -1:
+            self._process_gap(text[position:end])
+
+    def _process_gap(self, gap: str) -> None:
+        for line in gap.split('\n'):
+            self._process_line(line.strip())
 
-    priority1_original = [normalized_map[g] for g in priority1_lower]
-    priority2_original = [normalized_map[g] for g in priority2_lower]
-    other_groups_original = [normalized_map[g] for g in other_groups_lower]
+    def _process_line(self, line: str) -> None:
+        if self._pending is not None:
+            if line and not line.startswith('#'):
+                self._emit_pending(line)
+                return
+            elif line.startswith('#EXTINF:') or line.startswith('#EXTM3U') or line.startswith('#EXT-X-'):
+                self._emit_pending("")
+            else:
+                return # Comment or blank line between #EXTINF and its URL
 
-    return priority1_original + priority2_original + other_groups_original
+        if line.startswith('#EXTINF:'):
+            parsed = parse_extinf_line(line)
+            self._pending = _UNPARSED_EXTINF if parsed is None else parsed
+
+    def _emit_pending(self, url: str) -> None:
+        if self._pending is None:
+            return
+        parsed = self._pending
+        self._pending = None
+        if parsed is _UNPARSED_EXTINF: # Only add channel if EXTINF was parsed
+            return
+        duration, name, attributes_str, group_title = parsed
+        group_match = self.rules.match_group(group_title)
+        if self.rules.check_channel is None:
+            keep, required = group_match.keep, group_match.required
+        else:
+            keep, required = self.rules.check_channel(group_match, name, attributes_str, url)
+        if not keep:
+            return
+        if required:
+            self.found_bein = True
+        self.group_titles.add(group_title)
+        channel = Channel(duration, name, attributes_str, url, group_title)
+        if self.on_channel is not None:
+            self.on_channel(channel)
+        else:
+            self.channels.append(channel)
+        # Reduce verbosity: only warn if URL is missing AND name is not default
+        if not url and name != "Unnamed Channel":
+             print_colored(f"Warning: No URL found for '{name}'", "yellow")
 
 
 # --- Function to Parse M3U Content ---
-def parse_m3u_content(m3u_content: str) -> Tuple[List[Dict[str, Any]], List[str], bool]:
+def parse_m3u_content(m3u_content: str) -> Tuple[List[Channel], List[str], bool]:
     """
-    Parses M3U content into a list of channel dictionaries and checks for 'Bein'.
+    Parses M3U content into a list of Channel records (minus those the filter rules exclude)
+    and checks the 'require' rules (by default: a 'Bein' group).
     Args:
         m3u_content: The M3U content as a string.
     Returns:
         A tuple containing:
-        - List of channel dictionaries
+        - List of Channel records
         - List of all unique group titles found.
-        - Boolean indicating if a 'Bein' group was found.
-    """
-    channels = []
-    group_titles = set()
-    found_bein = False
-    lines = m3u_content.splitlines()
-    i = 0
-    while i < len(lines):
-        line = lines[i].strip()
-        if line.startswith('#EXTINF:'):
-            raw_extinf = line
-            attributes = {}
-            name = "Unnamed Channel" # Default name
-            group_title = "General"
-            duration = -1
-
-            match_extinf = re.match(r'#EXTINF:(?P<duration>-?\d+)(?P<attributes_str>.*?),\s*(?P<name>.*)', line)
-            if match_extinf:
-                try:
-                    duration = int(match_extinf.group('duration'))
-                except ValueError:
-                    duration = -1
-                name = match_extinf.group('name').strip() or name # Use default if name is empty
-                attributes_str = match_extinf.group('attributes_str').strip()
+        - Boolean indicating if a channel matched the 'require' rules.
+    """
+    parser = M3UStreamParser(max_bytes=None)
+    parser.feed_text(m3u_content)
+    parser.close()
+    return parser.result()
 
-                try:
-                    # Regex to capture key="value" or key=value
-                    attr_matches = re.findall(r'([a-zA-Z0-9_\-]+)=?(?:"([^"]*)"|([^ ]*))', attributes_str)
-                    for key, val_quoted, val_unquoted in attr_matches:
-                        attributes[key] = val_quoted if val_quoted else val_unquoted
-                except Exception:
-                     pass # Ignore attribute parsing errors silently? Or log?
 
-                group_title_raw = attributes.get('group-title', "General")
-                group_title = str(group_title_raw) if group_title_raw is not None else "General"
+# --- Raw Body Buffer (downloads for the process-pool CPU stage) ---
+class M3UBodyBuffer:
+    """
+    Download-side stand-in for M3UStreamParser when parsing runs in a worker process:
+    same feed/close/hexdigest interface and the same size limit, #EXTM3U header check
+    and SHA-256, but it only collects the raw chunks. getvalue() returns the body.
+    """
 
-                if "bein" in group_title.lower():
-                    found_bein = True
+    def __init__(self, max_bytes: Optional[int] = MAX_SIZE_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.is_m3u: Optional[bool] = None
+        self.bytes_fed = 0
+        self.size_exceeded = False
+        self._chunks: List[bytes] = []
+        self._sha256 = hashlib.sha256()
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self._head = ""
+
+    def feed(self, chunk: bytes) -> bool:
+        """Feeds raw bytes. Returns False once the stream should be abandoned (like M3UStreamParser.feed)."""
+        self.bytes_fed += len(chunk)
+        if self.max_bytes is not None and self.bytes_fed > self.max_bytes:
+            self.size_exceeded = True
+            return False
+        self._sha256.update(chunk)
+        self._chunks.append(chunk)
+        if self.is_m3u is None:
+            self._check_head(self._decoder.decode(chunk))
+        return self.is_m3u is not False
+
+    def _check_head(self, text: str) -> None:
+        head_text = text if self._head else text.lstrip()
+        self._head += head_text[:7 - len(self._head)]
+        if len(self._head) >= 7:
+            self.is_m3u = self._head == '#EXTM3U'
+
+    def close(self) -> None:
+        if self.is_m3u is None:
+            self._check_head(self._decoder.decode(b'', final=True))
+            if self.is_m3u is None:
+                self.is_m3u = False # Shorter than '#EXTM3U'
+
+    def hexdigest(self) -> str:
+        """SHA-256 of all raw bytes fed so far."""
+        return self._sha256.hexdigest()
+
+    def getvalue(self) -> bytes:
+        """The downloaded body."""
+        return b''.join(self._chunks)
+
+
+# --- Download Error Logging (shared by both engines) ---
+def print_download_error(status_code: Any, error_name: str) -> None:
+    """Logs common informative HTTP errors for a failed download."""
+    metrics.set_outcome(metrics.http_outcome(status_code))
+    if status_code == 404:
+         print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error: Not Found (404).", "red")
+    elif status_code == 403:
+         print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error: Forbidden (403). Check UA/Headers/IP?", "red")
+    elif status_code in [500, 502, 503, 504]:
+         print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error: Server Error ({status_code}).", "red")
+    else:
+         print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error Download: {error_name} (Status: {status_code})", "red")
 
-                group_titles.add(group_title)
 
-            url = ""
-            j = i + 1
-            while j < len(lines):
-                next_line = lines[j].strip()
-                if next_line and not next_line.startswith('#'):
-                    url = next_line
-                    i = j
+# --- Output Naming ---
+def get_output_name(m3u_url: str) -> str:
+    """
+    Stable file name of the playlist from m3u_url (M3U_ + 12 hex digits of its SHA-1), so a
+    playlist keeps its file when lines are added to or removed from the input.
+    """
+    return f"M3U_{hashlib.sha1(m3u_url.encode('utf-8')).hexdigest()[:12]}.m3u"
+
+
+def get_output_filepath(output_folder: str, m3u_url: str) -> str:
+    """Returns the path the playlist from m3u_url is saved to."""
+    return os.path.join(output_folder, get_output_name(m3u_url))
+
+
+def output_matches(output_filepath: str, chunks: List[bytes]) -> bool:
+    """True if output_filepath already holds exactly the concatenated chunks."""
+    try:
+        if os.path.getsize(output_filepath) != sum(len(chunk) for chunk in chunks):
+            return False
+        with open(output_filepath, 'rb') as f:
+            return all(f.read(len(chunk)) == chunk for chunk in chunks)
+    except OSError:
+        return False
+
+
+def write_if_changed(output_filepath: str, chunks: List[bytes]) -> bool:
+    """
+    Writes the chunks to output_filepath atomically (temp file + os.replace) unless the file
+    already holds exactly these bytes, so unchanged playlists cost a read, not a write (and no git diff).
+    Returns True if the file was written. Raises OSError if writing failed.
+    """
+    if output_matches(output_filepath, chunks):
+        return False
+    temp_filepath = output_filepath + f".{os.getpid()}.{threading.get_ident()}.tmp" # Unique per writer
+    try:
+        os.makedirs(os.path.dirname(output_filepath) or ".", exist_ok=True)
+        with open(temp_filepath, 'wb', buffering=SAVE_BUFFER_SIZE) as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(temp_filepath, output_filepath)
+    finally:
+        if os.path.exists(temp_filepath):
+            try:
+                os.remove(temp_filepath)
+            except OSError:
+                pass
+    return True
+
+
+def discard_output(output_filepath: str) -> None:
+    """Removes the output of a playlist that is no longer saved (failed or filtered out this run)."""
+    try:
+        os.remove(output_filepath)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print_colored(f"  Warning: Could not remove stale output '{output_filepath}': {e}", "yellow")
+
+
+def get_cache_validators(headers: Any) -> Dict[str, str]:
+    """Extracts ETag / Last-Modified from response headers (requests or aiohttp)."""
+    validators = {}
+    if headers.get('ETag'):
+        validators['etag'] = headers['ETag']
+    if headers.get('Last-Modified'):
+        validators['last_modified'] = headers['Last-Modified']
+    return validators
+
+
+# --- Playlist Index ---
+# Indexes live in INDEX_DIR under the SHA-1 of the playlist's bytes, so they survive in the
+# cache directory (restored by both workflows) while the checkout only holds the playlists.
+# Layout of <sha1>.idx: INDEX_MAGIC, a little-endian uint32 header length, a JSON header
+# {"size", "check", "channels", "groups": [[group_title, first_record, count, start_byte, end_byte], ...]}
+# and then one little-endian uint32 byte offset per record (its '#EXTINF:' line).
+# Records are found after an LF (a literal prefix search, much faster than '^' in MULTILINE mode);
+# a record at byte 0 is checked separately
+RECORD_START_RE = re.compile(rb'\n#EXTINF:')
+RECORD_ATTRIBUTES_RE = re.compile(rb'\n#EXTINF:-?\d+([^,\n]*)')
+
+
+def get_index_path(digest: str, index_dir: str = INDEX_DIR) -> str:
+    """Returns the path of the index of the playlist whose bytes hash to digest (SHA-1 hex)."""
+    return os.path.join(index_dir, digest + INDEX_SUFFIX)
+
+
+def get_chunks_digest(chunks: List[bytes]) -> str:
+    """SHA-1 hex digest of the concatenated chunks (the key of their playlist index)."""
+    digest = hashlib.sha1()
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_edge_check(head: bytes, tail: bytes) -> str:
+    """Short hash of the first and last INDEX_CHECK_BYTES of a playlist (catches an index left from other contents)."""
+    return hashlib.sha1(head + b'\0' + tail).hexdigest()[:16]
+
+
+def get_chunk_edges(chunks: List[bytes]) -> Tuple[bytes, bytes]:
+    """First and last INDEX_CHECK_BYTES of the concatenated chunks, without joining them."""
+    head_parts, tail_parts = [], []
+    needed = INDEX_CHECK_BYTES
+    for chunk in chunks:
+        if needed <= 0:
+            break
+        head_parts.append(chunk[:needed])
+        needed -= len(head_parts[-1])
+    needed = INDEX_CHECK_BYTES
+    for chunk in reversed(chunks):
+        if needed <= 0:
+            break
+        tail_parts.append(chunk[-needed:])
+        needed -= len(tail_parts[-1])
+    return b''.join(head_parts), b''.join(reversed(tail_parts))
+
+
+def pack_playlist_index(size: int, check: str, offsets: array, groups: List[list]) -> bytes:
+    """Serializes a playlist index (see the layout above)."""
+    header = json.dumps({'size': size, 'check': check, 'channels': len(offsets), 'groups': groups},
+                        ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if sys.byteorder == 'big':
+        offsets = array('I', offsets)
+        offsets.byteswap()
+    return INDEX_MAGIC + struct.pack('<I', len(header)) + header + offsets.tobytes()
+
+
+def unpack_playlist_index(data: bytes) -> Optional[Tuple[Dict[str, Any], array]]:
+    """Parses a playlist index. Returns (header, offsets), or None if data is not a valid index."""
+    start = len(INDEX_MAGIC) + 4
+    if not data.startswith(INDEX_MAGIC) or len(data) < start:
+        return None
+    header_end = start + struct.unpack_from('<I', data, len(INDEX_MAGIC))[0]
+    try:
+        header = json.loads(data[start:header_end].decode('utf-8'))
+    except ValueError:
+        return None
+    if not isinstance(header, dict) or (len(data) - header_end) != 4 * header.get('channels', -1):
+        return None
+    offsets = array('I')
+    offsets.frombytes(data[header_end:])
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+    return header, offsets
+
+
+def build_playlist_index(chunks: List[bytes], group_names: List[str]) -> bytes:
+    """
+    Builds the index of a playlist written by save_parsed_m3u.
+    Args:
+        chunks: The written chunks: the '#EXTM3U' header, then one chunk per group.
+        group_names: Group title of each chunk after the header.
+    Returns:
+        The serialized index.
+    """
+    offsets = array('I')
+    groups = []
+    position = len(chunks[0])
+    for group_name, chunk in zip(group_names, chunks[1:]):
+        first_record = len(offsets)
+        if chunk.startswith(b'#EXTINF:'):
+            offsets.append(position)
+        offsets.extend(position + match.start() + 1 for match in RECORD_START_RE.finditer(chunk))
+        groups.append([group_name, first_record, len(offsets) - first_record, position, position + len(chunk)])
+        position += len(chunk)
+    head, tail = get_chunk_edges(chunks)
+    return pack_playlist_index(position, get_edge_check(head, tail), offsets, groups)
+
+
+def iter_record_attributes(data: Any) -> Iterator[Tuple[int, bytes]]:
+    """(byte offset, raw attribute string) of every '#EXTINF:' record of data (bytes or mmap)."""
+    if data[:8] == b'#EXTINF:':
+        line_end = data.find(b'\n')
+        first = RECORD_ATTRIBUTES_RE.match(b'\n' + data[:line_end if line_end >= 0 else len(data)])
+        if first is not None:
+            yield 0, first.group(1)
+    for match in RECORD_ATTRIBUTES_RE.finditer(data):
+        yield match.start() + 1, match.group(1)
+
+
+def scan_playlist_index(data: Any) -> Tuple[array, List[list]]:
+    """
+    Finds the records of a playlist without an index (any M3U file) with one regex scan.
+    Groups are contiguous runs of records; a group that is split up in the file has several runs.
+    Returns:
+        (offsets, groups) in the layout of the playlist index.
+    """
+    offsets = array('I')
+    groups = []
+    for start, attributes in iter_record_attributes(data):
+        group_title = extract_group_title(attributes.decode('utf-8', errors='ignore').strip())
+        if groups and groups[-1][0] == group_title:
+            groups[-1][2] += 1
+        else:
+            if groups:
+                groups[-1][4] = start
+            groups.append([group_title, len(offsets), 1, start, None])
+        offsets.append(start)
+    if groups:
+        groups[-1][4] = len(data)
+    return offsets, groups
+
+
+class PlaylistReader:
+    """
+    Random access to the records of a saved playlist through a read-only mmap. With an
+    index for its contents in index_dir opening costs a hash of the mapping and one small
+    read; without one the records are found by a single scan (see save_index).
+    Usage:
+        with PlaylistReader(path) as reader:
+            channel = reader.record(6)
+    Raises OSError if the playlist cannot be opened.
+    """
+
+    def __init__(self, playlist_path: str, index_dir: str = INDEX_DIR) -> None:
+        self.path = playlist_path
+        with open(playlist_path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        self.check = get_edge_check(self._data[:INDEX_CHECK_BYTES], self._data[-INDEX_CHECK_BYTES:])
+        self.index_path = get_index_path(hashlib.sha1(self._data).hexdigest(), index_dir)
+        loaded = self._load_index()
+        self.indexed = loaded is not None
+        self._offsets, self._groups = loaded if loaded is not None else scan_playlist_index(self._data)
+
+    def _load_index(self) -> Optional[Tuple[array, List[list]]]:
+        try:
+            with open(self.index_path, 'rb') as f:
+                unpacked = unpack_playlist_index(f.read())
+            os.utime(self.index_path) # Still in use (see prune_playlist_indexes)
+        except OSError:
+            return None
+        if unpacked is None:
+            return None
+        header, offsets = unpacked
+        if header.get('size') != self.size or header.get('check') != self.check:
+            return None # Corrupt
+        return offsets, header.get('groups', [])
+
+    def __enter__(self) -> 'PlaylistReader':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def groups(self) -> List[Tuple[str, int, int]]:
+        """(group_title, first_record, count) per group, in file order."""
+        return [(group[0], group[1], group[2]) for group in self._groups]
+
+    def index_bytes(self) -> bytes:
+        """The serialized index of the playlist as currently read."""
+        return pack_playlist_index(self.size, self.check, self._offsets, self._groups)
+
+    def save_index(self) -> bool:
+        """Writes the index of a playlist that had none, for the next reader. Returns True if it was written."""
+        if self.indexed:
+            return False
+        try:
+            self.indexed = write_if_changed(self.index_path, [self.index_bytes()])
+        except OSError as e:
+            print_colored(f"  Warning: Could not save the index of '{self.path}': {e}", "yellow")
+        return self.indexed
+
+    def record_bytes(self, n: int) -> bytes:
+        """Raw bytes of record n (its '#EXTINF:' line up to the next record)."""
+        start = self._offsets[n]
+        end = self._offsets[n + 1] if n + 1 < len(self._offsets) else self.size
+        return self._data[start:end]
+
+    def record(self, n: int) -> Optional[Channel]:
+        """Parses record n. Returns None if it is malformed. Raises IndexError if n is out of range."""
+        lines = self.record_bytes(n).decode('utf-8', errors='ignore').split('\n')
+        parsed = parse_extinf_line(lines[0].strip())
+        if parsed is None:
+            return None
+        url = ""
+        for line in lines[1:]:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                url = line
+                break
+        duration, name, attributes_str, group_title = parsed
+        return Channel(duration, name, attributes_str, url, group_title)
+
+    def records(self) -> Iterator[Channel]:
+        """All well-formed records in file order."""
+        for n in range(len(self._offsets)):
+            channel = self.record(n)
+            if channel is not None:
+                yield channel
+
+    def group_records(self, group_title: str) -> Iterator[Channel]:
+        """The well-formed records of group_title, reading only that group's byte ranges."""
+        for name, first_record, count, _, _ in self._groups:
+            if name != group_title:
+                continue
+            for n in range(first_record, first_record + count):
+                channel = self.record(n)
+                if channel is not None:
+                    yield channel
+
+
+def ensure_playlist_index(playlist_path: str) -> bool:
+    """
+    Writes the index of playlist_path if there is none for its contents (e.g. after a cache
+    restore or for a file written elsewhere). Returns True if it was written.
+    """
+    try:
+        with PlaylistReader(playlist_path) as reader:
+            return reader.save_index()
+    except OSError as e:
+        print_colored(f"  Warning: Could not index '{playlist_path}': {e}", "yellow")
+        return False
+
+
+def prune_playlist_indexes(index_dir: str = INDEX_DIR, max_age_days: float = CACHE_MAX_AGE_DAYS) -> int:
+    """Removes indexes not written or read for max_age_days (their playlists changed). Returns how many."""
+    cutoff = time.time() - max_age_days * 86400
+    removed = 0
+    try:
+        entries = list(os.scandir(index_dir))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.name.endswith(INDEX_SUFFIX) and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+# --- Host-Aware Scheduling ---
+def get_url_host(url: str) -> str:
+    """Returns the lowercased host[:port] of a URL, used to group URLs by panel."""
+    try:
+        return urlparse(url).netloc.lower()
+    except ValueError:
+        return ""
+
+
+def interleave_by_host(m3u_urls: List[str]) -> List[Tuple[int, str]]:
+    """
+    Groups URLs by host and returns (file_index, url) pairs in round-robin host order,
+    so workers spread over all panels instead of queueing behind the biggest one.
+    File indices are the 1-based positions in m3u_urls, exactly as before.
+    """
+    by_host: Dict[str, List[Tuple[int, str]]] = {}
+    for idx, m3u_url in enumerate(m3u_urls, start=1):
+        by_host.setdefault(get_url_host(m3u_url), []).append((idx, m3u_url))
+
+    ordered = []
+    buckets = list(by_host.values())
+    for position in range(max((len(b) for b in buckets), default=0)):
+        for bucket in buckets:
+            if position < len(bucket):
+                ordered.append(bucket[position])
+    return ordered
+
+
+def skip_unresolvable(m3u_url: str, dns_cache: Optional[dnscache.DNSCache]) -> bool:
+    """True (after logging it with outcome 'dns_error') if the URL's host is cached as not resolving."""
+    reason = dns_cache.url_dead_reason(m3u_url) if dns_cache is not None else None
+    if reason is None:
+        return False
+    print_colored(f"https://www.ibm.com/support/pages/node/520321/stub Skipping: {dnscache.get_hostname(m3u_url)} does not resolve ({reason}): {m3u_url}", "red")
+    with metrics.trace_url(m3u_url):
+        metrics.set_outcome('dns_error')
+    return True
+
+
+def log_dns_stage(dns_cache: dnscache.DNSCache, hosts: List[Optional[str]], looked_up: int, seconds: float) -> None:
+    """Logs the outcome of an up-front DNS stage over hosts."""
+    if not dns_cache.available:
+        print_colored("dnspython is not installed: hosts are resolved per request by the system resolver.", "yellow")
+    resolved, dead = dns_cache.summary(hosts)
+    print_colored(f"DNS: {len(set(hosts))} hosts, {looked_up} looked up in {seconds:.2f}s "
+                  f"({len(set(hosts)) - looked_up} cached or not needed); {resolved} resolved, {dead} dead.", "cyan")
+
+
+class HostBackoff:
+    """
+    Adaptive per-host delay. Doubles (up to HOST_BACKOFF_MAX) every time the host answers
+    with 403/429/5xx and halves on every success, so a panel that starts refusing us
+    gets breathing room instead of hundreds of retries in parallel.
+    """
+
+    def __init__(self) -> None:
+        self.delay = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, status_code: Optional[int]) -> None:
+        with self._lock:
+            if status_code in HOST_BACKOFF_STATUSES:
+                self.delay = min(max(self.delay * 2, HOST_BACKOFF_BASE), HOST_BACKOFF_MAX)
+            elif status_code is not None and 200 <= status_code < 400:
+                self.delay = self.delay / 2 if self.delay > HOST_BACKOFF_BASE else 0.0
+
+
+class HostScheduler:
+    """
+    Per-host concurrency budget for the thread engine: at most per_host_limit requests
+    in flight per host, an adaptive HostBackoff per host, and one pooled requests.Session
+    per host shared by all URLs on that panel (connecting to the dns_cache addresses, if given,
+    and handing each new socket to on_connect). Reports also feed the optional run-wide
+    AIMDLimit (see AdaptiveLimiter). Backoff waits end early (RunCancelled) once cancel_event is set.
+    """
+
+    def __init__(self, per_host_limit: int = PER_HOST_LIMIT, limit: Optional['AIMDLimit'] = None,
+                 cancel_event: Optional[threading.Event] = None,
+                 dns_cache: Optional[dnscache.DNSCache] = None,
+                 on_connect: Optional[Callable[[socket.socket], None]] = None) -> None:
+        self.per_host_limit = max(1, per_host_limit)
+        self.limit = limit
+        self.cancel_event = cancel_event
+        self.dns_cache = dns_cache
+        self.on_connect = on_connect
+        self._lock = threading.Lock()
+        self._semaphores: Dict[str, threading.Semaphore] = {}
+        self._backoffs: Dict[str, HostBackoff] = {}
+        self._sessions: Dict[str, requests.Session] = {}
+
+    def _host_state(self, host: str) -> Tuple[threading.Semaphore, HostBackoff]:
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.Semaphore(self.per_host_limit)
+                self._backoffs[host] = HostBackoff()
+            return self._semaphores[host], self._backoffs[host]
+
+    def session_for(self, host: str) -> requests.Session:
+        """Returns the pooled session for host, creating it on first use."""
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = dnscache.CachedHTTPAdapter(self.dns_cache, self.on_connect, pool_connections=1,
+                                                     pool_maxsize=self.per_host_limit)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+            return session
+
+    @contextmanager
+    def slot(self, host: str) -> Iterator[None]:
+        """Holds one of the host's in-flight slots, waiting out its current backoff first."""
+        semaphore, backoff = self._host_state(host)
+        if self.cancel_event is None:
+            semaphore.acquire()
+        else:
+            while not semaphore.acquire(timeout=CANCEL_POLL_SEC):
+                if self.cancel_event.is_set():
+                    raise RunCancelled()
+        try:
+            if backoff.delay:
+                if self.cancel_event is None:
+                    time.sleep(backoff.delay)
+                elif self.cancel_event.wait(backoff.delay):
+                    raise RunCancelled()
+            yield
+        finally:
+            semaphore.release()
+
+    def report(self, host: str, status_code: Optional[int]) -> None:
+        """Feeds a response status (or None for no response) into the host's backoff, and the current trace into the limit."""
+        self._host_state(host)[1].record(status_code)
+        if self.limit is not None:
+            self.limit.record_current_trace()
+
+    def close(self) -> None:
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+class AsyncHostScheduler:
+    """Async counterpart of HostScheduler (the aiohttp connector already pools per host)."""
+
+    def __init__(self, per_host_limit: int = PER_HOST_LIMIT, limit: Optional['AIMDLimit'] = None) -> None:
+        self.per_host_limit = max(1, per_host_limit)
+        self.limit = limit
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._backoffs: Dict[str, HostBackoff] = {}
+
+    def _host_state(self, host: str) -> Tuple[asyncio.Semaphore, HostBackoff]:
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.per_host_limit)
+            self._backoffs[host] = HostBackoff()
+        return self._semaphores[host], self._backoffs[host]
+
+    @asynccontextmanager
+    async def slot(self, host: str) -> AsyncIterator[None]:
+        semaphore, backoff = self._host_state(host)
+        async with semaphore:
+            if backoff.delay:
+                await asyncio.sleep(backoff.delay)
+            yield
+
+    def report(self, host: str, status_code: Optional[int]) -> None:
+        self._host_state(host)[1].record(status_code)
+        if self.limit is not None:
+            self.limit.record_current_trace()
+
+
+# --- Adaptive Concurrency (AIMD) ---
+def is_congestion_outcome(outcome: Optional[str]) -> bool:
+    """True for metrics outcomes that suggest overload (timeouts, resets, proxy failures, 429, 5xx), not a bad URL."""
+    return outcome in CONGESTION_OUTCOMES or (outcome or '').startswith('http_5')
+
+
+def is_connection_reset(error: BaseException) -> bool:
+    """True if a requests/aiohttp error was caused by the peer resetting or dropping the connection."""
+    pending = [error]
+    seen = set()
+    while pending:
+        error = pending.pop()
+        if error is None or id(error) in seen:
+            continue
+        seen.add(id(error))
+        if isinstance(error, (ConnectionResetError, BrokenPipeError, aiohttp.ServerDisconnectedError,
+                              requests.exceptions.ChunkedEncodingError)):
+            return True
+        pending += [error.__cause__, error.__context__]
+        pending += [arg for arg in getattr(error, 'args', ()) if isinstance(arg, BaseException)]
+    return False
+
+
+class AIMDLimit:
+    """
+    Additive-increase/multiplicative-decrease concurrency limit, the congestion-window rule of TCP.
+    Results are judged per window of max(limit, AIMD_MIN_WINDOW) requests (about one round trip):
+    - congestion rate (see is_congestion_outcome) AIMD_ERROR_MARGIN above the baseline: cut by AIMD_BACKOFF;
+    - mean TTFB above AIMD_LATENCY_TOLERANCE times the baseline: hold;
+    - otherwise grow: double until the first cut or hold (slow start), then +AIMD_INCREASE.
+    The baselines are moving averages over the windows, so panels that always time out raise
+    the baseline instead of pinning the limit down. Thread-safe. Every change of the limit is
+    recorded in the metrics report under `name`.
+    """
+
+    def __init__(self, name: str, maximum: int, start: int = AIMD_START, minimum: int = 1) -> None:
+        self.name = name
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = max(self.minimum, min(start, self.maximum))
+        self.peak = self.limit
+        self.slow_start = True
+        self.baseline_congestion: Optional[float] = None
+        self.baseline_latency: Optional[float] = None
+        self._results = 0
+        self._congested = 0
+        self._latency_total = 0.0
+        self._latency_count = 0
+        self._lock = threading.Lock()
+        metrics.recorder.record_limit(name, self.limit)
+
+    def current(self) -> int:
+        return self.limit
+
+    def record(self, congested: bool, latency: Optional[float] = None) -> None:
+        """Feeds one finished request into the current window."""
+        with self._lock:
+            self._results += 1
+            self._congested += congested
+            if latency is not None:
+                self._latency_total += latency
+                self._latency_count += 1
+            if self._results < max(self.limit, AIMD_MIN_WINDOW):
+                return
+            before = self.limit
+            self._close_window()
+            after = self.limit
+        if after != before:
+            metrics.recorder.record_limit(self.name, after)
+
+    def _close_window(self) -> None:
+        congestion = self._congested / self._results
+        latency = self._latency_total / self._latency_count if self._latency_count else None
+        self._results = self._congested = self._latency_count = 0
+        self._latency_total = 0.0
+
+        if self.baseline_congestion is not None and congestion > self.baseline_congestion + AIMD_ERROR_MARGIN:
+            self.limit = max(self.minimum, int(self.limit * AIMD_BACKOFF))
+            self.slow_start = False
+        elif latency is not None and self.baseline_latency is not None and latency > AIMD_LATENCY_TOLERANCE * self.baseline_latency:
+            self.slow_start = False # Queues are building somewhere: hold
+        else:
+            self.limit = min(self.maximum, self.limit * 2 if self.slow_start else self.limit + AIMD_INCREASE)
+        self.peak = max(self.peak, self.limit)
+
+        if self.baseline_congestion is None:
+            self.baseline_congestion = congestion
+        else:
+            self.baseline_congestion += AIMD_BASELINE_WEIGHT * (congestion - self.baseline_congestion)
+        if latency is not None:
+            if self.baseline_latency is None:
+                self.baseline_latency = latency
+            else:
+                self.baseline_latency += AIMD_BASELINE_WEIGHT * (latency - self.baseline_latency)
+
+    def record_current_trace(self) -> None:
+        """Feeds the outcome and TTFB of the current metrics trace into the limit."""
+        trace = metrics.current_trace()
+        if trace is not None:
+            self.record(is_congestion_outcome(trace.outcome), trace.stages.get('ttfb'))
+
+
+class AdaptiveLimiter:
+    """Slots for the thread engines: acquire() blocks while AIMDLimit.current() requests are in flight."""
+
+    def __init__(self, limit: AIMDLimit) -> None:
+        self.limit = limit
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, shutdown_event: Optional[threading.Event] = None) -> bool:
+        """Waits for a free slot. Returns False (without a slot) if shutdown_event is set meanwhile."""
+        with self._condition:
+            while self.in_flight >= self.limit.current():
+                if shutdown_event is not None and shutdown_event.is_set():
+                    return False
+                self._condition.wait(0.5) # Re-check the limit and shutdown flag periodically
+            self.in_flight += 1
+            return True
+
+    def release(self) -> None:
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+
+class AsyncAdaptiveLimiter:
+    """Async counterpart of AdaptiveLimiter, for use on one event loop."""
+
+    def __init__(self, limit: AIMDLimit) -> None:
+        self.limit = limit
+        self.in_flight = 0
+        self._waiters: collections.deque = collections.deque()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        while self.in_flight >= self.limit.current():
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._wake() # Pass the wake-up on
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._wake()
+
+    def _wake(self) -> None:
+        """Wakes as many waiters as there are free slots."""
+        free = self.limit.current() - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+# --- Conditional-GET / Content-Hash Cache ---
+class PlaylistCache:
+    """
+    Persistent on-disk cache keyed by source URL. For every URL it remembers the ETag /
+    Last-Modified validators, the SHA-256 of the last body, whether that body was saved,
+    and (if it was) a copy of the saved output. When the server answers 304, or sends
+    the same bytes again, the cached output is restored instead of re-parsing, re-sorting
+    and re-serializing the playlist.
+    Layout: <cache_dir>/index.json plus one <sha1(url)>.m3u per saved playlist.
+    Entries remember the digest of the filter rules they were produced with; entries of
+    other rules are not reused (the same bytes may filter differently).
+    URLs in known_duplicates (fallbacks of the last dedupe) are not restored while their output
+    is absent; they are collected in skipped_duplicates for dedupe_saved_playlists instead.
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, rules_digest: Optional[str] = None) -> None:
+        self.cache_dir = cache_dir
+        self.rules_digest = rules_digest
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.known_duplicates: Set[str] = set()
+        self.skipped_duplicates: Set[str] = set()
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print_colored(f"Warning: Could not read cache index '{self.index_path}': {e}. Starting empty.", "yellow")
+
+    def _output_copy_path(self, m3u_url: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha1(m3u_url.encode('utf-8')).hexdigest() + ".m3u")
+
+    def _usable_entry(self, m3u_url: str) -> Optional[Dict[str, Any]]:
+        """Returns the entry for m3u_url if its result can be restored without the body."""
+        with self._lock:
+            entry = self._entries.get(m3u_url)
+        if entry is None:
+            return None
+        if self.rules_digest is not None and entry.get('rules') != self.rules_digest:
+            return None
+        if entry.get('saved') and not os.path.exists(self._output_copy_path(m3u_url)):
+            return None
+        return entry
+
+    def conditional_headers(self, m3u_url: str) -> Dict[str, str]:
+        """Returns If-None-Match / If-Modified-Since headers for a usable entry, else {}."""
+        entry = self._usable_entry(m3u_url)
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def is_unchanged(self, m3u_url: str, digest: str) -> bool:
+        entry = self._usable_entry(m3u_url)
+        return entry is not None and entry.get('sha256') == digest
+
+    def restore(self, m3u_url: str, output_filepath: str) -> bool:
+        """
+        Re-applies the cached result for m3u_url: copies the cached output to output_filepath
+        if the playlist was saved last time. Returns True if a file was restored (or, for a
+        known duplicate, left out).
+        """
+        entry = self._usable_entry(m3u_url)
+        if entry is None:
+            return False
+        with self._lock:
+            entry['last_used'] = time.time()
+        if not entry.get('saved'):
+            return False
+        if m3u_url in self.known_duplicates and not os.path.exists(output_filepath):
+            with self._lock:
+                self.skipped_duplicates.add(m3u_url) # Removed by the last dedupe and unchanged: not written again
+            return True
+        cached_filepath = self._output_copy_path(m3u_url)
+        if os.path.exists(output_filepath) and filecmp.cmp(cached_filepath, output_filepath, shallow=False):
+            ensure_playlist_index(output_filepath)
+            return True # Already in place (outputs persist between runs)
+        temp_filepath = output_filepath + f".{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(output_filepath) or ".", exist_ok=True)
+            shutil.copyfile(cached_filepath, temp_filepath)
+            os.replace(temp_filepath, output_filepath)
+            ensure_playlist_index(output_filepath)
+            return True
+        except OSError as e:
+            print_colored(f"  Warning: Could not restore cached output for {m3u_url}: {e}", "yellow")
+            if os.path.exists(temp_filepath):
+                try:
+                    os.remove(temp_filepath)
+                except OSError:
+                    pass
+            return False
+
+    def skipped_copy(self, m3u_url: str) -> Optional[str]:
+        """The cached output of a duplicate restore() left out this run, or None."""
+        return self._output_copy_path(m3u_url) if m3u_url in self.skipped_duplicates else None
+
+    def restore_skipped(self, m3u_url: str, output_filepath: str) -> bool:
+        """Writes out a duplicate restore() left out (it represents its cluster now). Returns True on success."""
+        with self._lock:
+            self.known_duplicates.discard(m3u_url)
+            self.skipped_duplicates.discard(m3u_url)
+        return self.restore(m3u_url, output_filepath)
+
+    def store(self, m3u_url: str, digest: str, validators: Dict[str, str], output_filepath: Optional[str]) -> None:
+        """Records a freshly processed body; output_filepath is None if it was not saved."""
+        size = 0
+        if output_filepath is not None:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                shutil.copyfile(output_filepath, self._output_copy_path(m3u_url))
+                size = os.path.getsize(output_filepath)
+            except OSError as e:
+                print_colored(f"  Warning: Could not cache output for {m3u_url}: {e}", "yellow")
+                return
+        with self._lock:
+            self._entries[m3u_url] = {
+                'etag': validators.get('etag'), 'last_modified': validators.get('last_modified'),
+                'sha256': digest, 'saved': output_filepath is not None, 'size': size,
+                'last_used': time.time(), 'rules': self.rules_digest,
+            }
+
+    def evict(self, max_age_days: float = CACHE_MAX_AGE_DAYS, max_total_mb: float = CACHE_MAX_TOTAL_MB) -> int:
+        """
+        Drops entries unused for more than max_age_days, then least recently used entries
+        until the cached outputs fit in max_total_mb. Returns the number of entries evicted.
+        """
+        cutoff = time.time() - max_age_days * 86400
+        max_total_bytes = max_total_mb * 1024 * 1024
+        with self._lock:
+            by_age = sorted(self._entries.items(), key=lambda item: item[1].get('last_used', 0))
+            total_size = sum(entry.get('size', 0) for _, entry in by_age)
+            evicted = []
+            for m3u_url, entry in by_age:
+                if entry.get('last_used', 0) >= cutoff and total_size <= max_total_bytes:
                     break
-                elif next_line.startswith('#EXTINF:') or next_line.startswith('#EXTM3U') or next_line.startswith('#EXT-X-'):
-                     break
-                j += 1
+                evicted.append(m3u_url)
+                total_size -= entry.get('size', 0)
+            for m3u_url in evicted:
+                del self._entries[m3u_url]
+        for m3u_url in evicted:
+            try:
+                os.remove(self._output_copy_path(m3u_url))
+            except OSError:
+                pass
+        return len(evicted)
 
-            if match_extinf: # Only add channel if EXTINF was parsed
-                channels.append({
-                    'duration': duration, 'name': name, 'attributes': attributes,
-                    'url': url, 'group_title': group_title, 'raw_extinf': raw_extinf
-                })
-                # Reduce verbosity: only warn if URL is missing AND name is not default
-                if not url and name != "Unnamed Channel":
-                     print_colored(f"Warning: No URL found for '{name}'", "yellow")
+    def save(self) -> None:
+        """Writes the index atomically."""
+        temp_path = self.index_path + f".{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with self._lock:
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self._entries, f)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            print_colored(f"Warning: Could not save cache index '{self.index_path}': {e}", "yellow")
+
+
+# --- Process-Pool CPU Stage ---
+class CpuStage:
+    """
+    Runs the CPU-heavy part (parse, 'Bein' filter, sort, serialize) in a ProcessPoolExecutor
+    sized to the cores, so the download workers only move bytes and never hold the GIL for
+    a 30 MB parse. At most max_pending bodies are queued or running in the pool; a download
+    worker that finishes while the pool is full blocks in run() until a slot frees up, so
+    fetched bodies cannot pile up faster than the cores consume them.
+    """
 
-        i += 1
+    def __init__(self, workers: int, max_pending: Optional[int] = None) -> None:
+        self.workers = max(1, workers)
+        self.max_pending = max_pending or 2 * self.workers
+        # Workers get this process's filter rules (a rule file loaded by main is not re-read there)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=set_filter_rules,
+                                            initargs=(FILTER_RULES,))
+        self._slots = threading.BoundedSemaphore(self.max_pending)
 
-    return channels, list(group_titles), found_bein
+    def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Runs func(*args) in a worker process and waits for its result."""
+        with self._slots:
+            return self.executor.submit(func, *args).result()
 
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
 
-# --- Download/Process Function with Size Limit ---
-def download_process_and_save_m3u(m3u_url: str, file_index: int, output_folder: str) -> bool:
+
+def get_cpu_workers(requested: Optional[int]) -> int:
     """
-    Downloads (with size limit), parses, saves an M3U file ONLY IF it contains 'Bein',
-    and sorts groups before saving. Skips files > MAX_SIZE_BYTES.
+    Resolves --cpu-workers: None means one process per core, or 0 (parse in the download
+    workers) on a single core, where a process pool only adds pickling overhead.
+    """
+    if requested is not None:
+        return max(0, requested)
+    cores = os.cpu_count() or 1
+    return cores if cores > 1 else 0
+
+
+# --- Cancellation ---
+class RunCancelled(Exception):
+    """Raised by a download aborted because the run is being cancelled (its previous output is kept)."""
+
+
+class InFlightRequests:
+    """
+    Sockets opened by the thread engine's sessions, so cancel() can abort every request
+    mid-flight (waiting for headers or reading the body) instead of leaving each worker to its
+    next DOWNLOAD_TIMEOUT: shutting a socket down wakes the thread blocked on it, and the
+    download then raises RunCancelled. The sessions report their sockets through track() (the
+    on_connect hook of dnscache.CachedHTTPAdapter, TLS-wrapped for HTTPS); they are held weakly,
+    so closed ones drop out. Downloads also call check() before the request and between chunks.
+    """
+
+    def __init__(self, cancel_event: threading.Event) -> None:
+        self.cancel_event = cancel_event
+        self._lock = threading.Lock()
+        self._sockets: weakref.WeakSet = weakref.WeakSet()
+
+    def track(self, sock: socket.socket) -> None:
+        """Registers a newly connected socket."""
+        with self._lock:
+            self._sockets.add(sock)
+
+    def check(self) -> None:
+        """Raises RunCancelled if the run is being cancelled."""
+        if self.cancel_event.is_set():
+            raise RunCancelled()
+
+    def cancel(self) -> int:
+        """Sets the cancel event and shuts down every open socket. Returns how many were open."""
+        self.cancel_event.set()
+        with self._lock:
+            sockets = list(self._sockets)
+        aborted = 0
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+                aborted += 1
+            except OSError:
+                pass # Already closed
+        return aborted
+
+
+def check_cancelled(in_flight: Optional[InFlightRequests]) -> None:
+    """in_flight.check() if there is one; a failed read of an aborted download is a cancellation, not an error."""
+    if in_flight is not None:
+        in_flight.check()
+
+
+def shutdown_executor(executor: ThreadPoolExecutor, wait: bool, futures: Iterable[Future] = ()) -> None:
+    """
+    Shuts a worker pool down, cancelling the given futures and (on Python 3.9+, which added
+    cancel_futures) any other queued work first, so a cancelled run doesn't start them.
+
+    Args:
+        executor: The pool to shut down.
+        wait: Whether to wait for the running workers.
+        futures: Futures to cancel explicitly; the ones already running are unaffected.
+    """
+    for future in futures:
+        future.cancel()
+    if sys.version_info >= (3, 9):
+        executor.shutdown(wait=wait, cancel_futures=True)
+    else:
+        executor.shutdown(wait=wait)
+
+
+# --- Shutdown Handling ---
+class ShutdownControl:
+    """
+    Turns SIGINT and SIGTERM (Actions sends both when it cancels a job) and an optional time
+    budget into one shutdown event, so a run aborts its requests, drains and records its progress
+    instead of being killed. A second signal exits at once, after running the at_exit hooks (the
+    journal needs none: every record is flushed as it is written).
+    """
+
+    def __init__(self, time_budget: Optional[float] = None) -> None:
+        self.event = threading.Event()
+        self.reason: Optional[str] = None
+        self.exit_code = 0 # 128 + signal number after a signal, 0 after the time budget
+        self._exit_hooks: List[Callable[[], Any]] = []
+        self._timer = None
+        if time_budget:
+            self._timer = threading.Timer(time_budget, self.request, ("time budget", 0))
+            self._timer.daemon = True
+
+    def install(self) -> 'ShutdownControl':
+        """Installs the signal handlers (main thread only) and starts the time budget."""
+        signal.signal(signal.SIGINT, self._on_signal)
+        signal.signal(signal.SIGTERM, self._on_signal)
+        if self._timer is not None:
+            self._timer.start()
+        return self
+
+    def at_exit(self, hook: Callable[[], Any]) -> None:
+        """Registers a hook (e.g. writing the metrics reports) to run before a second signal exits the process."""
+        self._exit_hooks.append(hook)
+
+    def _on_signal(self, sig: int, frame: Any) -> None:
+        if self.event.is_set():
+            print_colored("\nSecond interrupt, exiting now.", "red")
+            # Not in the handler itself: the interrupted main thread may hold a lock the hooks need
+            threading.Thread(target=self._exit_now, args=(128 + sig,), daemon=True).start()
+            return
+        self.request(signal.Signals(sig).name, 128 + sig)
+
+    def _exit_now(self, exit_code: int) -> None:
+        """Runs the at_exit hooks, flushes stdout/stderr and exits without joining the remaining threads."""
+        for hook in self._exit_hooks:
+            try:
+                hook()
+            except Exception as e:
+                print_colored(f"Warning: exit hook failed: {type(e).__name__} - {e}", "yellow")
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code)
+
+    def request(self, reason: str, exit_code: int = 0) -> None:
+        """Starts the shutdown (once)."""
+        if self.event.is_set():
+            return
+        self.reason = reason
+        self.exit_code = exit_code
+        print_colored(f"\nShutdown ({reason}): aborting in-flight requests, progress is kept for the next run...", "yellow")
+        self.event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def finish(self) -> None:
+        """
+        Stops the time budget and, after a shutdown, exits with exit_code. Pool threads still
+        stuck in a connect would keep the interpreter alive (it joins them at exit) for up to
+        DOWNLOAD_TIMEOUT, so then the process exits without waiting for them; everything worth
+        keeping (outputs, caches, journal, metrics) is written by the time this is called, so the
+        at_exit hooks are dropped.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+        self._exit_hooks.clear()
+        if not self.event.is_set():
+            return
+        current = threading.current_thread()
+        if any(thread.is_alive() and not thread.daemon and thread is not current for thread in threading.enumerate()):
+            self._exit_now(self.exit_code)
+        sys.exit(self.exit_code)
+
+
+# --- Download Function with Size Limit (network part of the thread engine) ---
+def fetch_and_parse_m3u(session: requests.Session, m3u_url: str,
+                        conditional_headers: Optional[Dict[str, str]] = None,
+                        body_factory: Callable[..., Any] = M3UStreamParser,
+                        in_flight: Optional[InFlightRequests] = None) -> Tuple[Optional[M3UStreamParser], Optional[int], Dict[str, str]]:
+    """
+    Downloads an M3U body with the MAX_SIZE_BYTES limit, feeding each chunk straight into
+    an M3UStreamParser instead of buffering the whole body.
     Args:
+        session: The requests session to use.
         m3u_url: The URL of the M3U file.
-        file_index: The index for naming the output file.
-        output_folder: The directory to save the file.
+        conditional_headers: Optional If-None-Match / If-Modified-Since headers.
+        body_factory: M3UStreamParser, or M3UBodyBuffer when parsing runs in the process-pool CPU stage.
+        in_flight: Optional registry that lets a cancelled run abort the download.
     Returns:
-        True if processed and saved successfully, False otherwise.
+        (closed parser, or None if skipped/failed/not modified, HTTP status code or None if no response,
+         cache validators {'etag', 'last_modified'} from the response)
+    Raises:
+        RunCancelled: The run was cancelled before or during the download.
     """
-    output_filename = f"M3U{file_index}.m3u"
-    output_filepath = os.path.join(output_folder, output_filename)
-    success = False
-    downloaded_size = 0
     expected_size = None
-    m3u_content_bytes = None
-    session = requests.Session()
-    # Add a small random delay before starting? Might help with massive concurrency.
-    # time.sleep(random.uniform(0, 0.5))
-
-    print_colored(f"https://www.ibm.com/support/pages/node/520321/stub Attempt: {m3u_url}", "cyan")
+    status_code = None
+    validators: Dict[str, str] = {}
+    response = None
 
     # 1. Initial Request and Size Check (if possible)
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36',
-            'Accept': '*/*', # Be more lenient with accept header
-            'Accept-Encoding': 'gzip, deflate',
-            'Connection': 'keep-alive'
-        }
+        check_cancelled(in_flight)
         # --- *** TIMEOUT REMAINS 30 SECONDS *** ---
-        response = session.get(m3u_url, timeout=30, headers=headers, stream=True, allow_redirects=True)
+        headers = {**REQUEST_HEADERS, **conditional_headers} if conditional_headers else REQUEST_HEADERS
+        request_start = time.perf_counter()
+        response = session.get(m3u_url, timeout=DOWNLOAD_TIMEOUT, headers=headers, stream=True, allow_redirects=True)
+        metrics.add_stage('ttfb', time.perf_counter() - request_start)
+        status_code = response.status_code
         response.raise_for_status()
+        validators = get_cache_validators(response.headers)
+        if status_code == 304:
+            response.close()
+            return None, status_code, validators
 
         # --- *** SIZE CHECK BASED ON Content-Length *** ---
         content_length_str = response.headers.get('Content-Length')
@@ -229,71 +1614,345 @@ def download_process_and_save_m3u(m3u_url: str, file_index: int, output_folder:
                 expected_size = int(content_length_str)
                 if expected_size > MAX_SIZE_BYTES:
                     print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Skipping: Size ({expected_size / 1024 / 1024:.1f}MB) exceeds limit ({MAX_SIZE_MB}MB) based on Content-Length.", "magenta")
+                    metrics.set_outcome('size_limit')
                     response.close() # Close the connection without reading body
-                    session.close()
-                    return False # Skip this file
+                    return None, status_code, validators # Skip this file
                 # else: # Optional: log expected size if within limit
                 #    print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Expected size: {expected_size / 1024 / 1024:.2f} MB (within limit).", "cyan")
             except ValueError:
                 expected_size = None # Treat invalid Content-Length as unknown
 
-        # 2. Download content chunk by chunk with size monitoring
-        content_buffer = io.BytesIO()
-        current_download_size = 0
-        for chunk in response.iter_content(chunk_size=65536): # Larger chunk size for potentially faster downloads
-            if chunk:
-                content_buffer.write(chunk)
-                current_download_size += len(chunk)
-                # --- *** SIZE CHECK DURING DOWNLOAD *** ---
-                if current_download_size > MAX_SIZE_BYTES:
-                    print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Skipping: Download exceeded size limit ({MAX_SIZE_MB}MB) during transfer.", "magenta")
-                    response.close() # Stop reading
-                    content_buffer.close() # Discard buffer
-                    session.close()
-                    return False # Skip this file
+        # 2. Download and parse chunk by chunk with size monitoring
+        parser = body_factory(max_bytes=MAX_SIZE_BYTES)
+        body_start = time.perf_counter()
+        feed_seconds = 0.0
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            feed_start = time.perf_counter()
+            fed = not chunk or parser.feed(chunk)
+            feed_seconds += time.perf_counter() - feed_start
+            if not fed:
+                response.close() # Stop reading
+                break
+            check_cancelled(in_flight)
+        check_cancelled(in_flight) # An aborted body may end early without an error
+        parser.close()
+        record_body_metrics(parser, time.perf_counter() - body_start, feed_seconds)
+        return check_parsed_download(parser, expected_size), status_code, validators
+
+    except RunCancelled:
+        if response is not None:
+            response.close()
+        raise
+    except requests.exceptions.Timeout:
+        check_cancelled(in_flight)
+        print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error: Timeout (30s).", "red")
+        metrics.set_outcome('timeout')
+    except requests.exceptions.RequestException as e:
+        check_cancelled(in_flight)
+        print_download_error(getattr(e.response, 'status_code', 'N/A'), type(e).__name__)
+        if is_connection_reset(e):
+            metrics.set_outcome('reset')
+    except ValueError as e:
+         print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error Download: {e}", "red")
+         metrics.set_outcome('empty')
+    except Exception as e:
+        check_cancelled(in_flight)
+        print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error Download (Unexpected): {type(e).__name__} - {e}", "red")
+        metrics.set_outcome('error')
+        # Optionally print full traceback for unexpected errors
+        # print(traceback.format_exc())
+    return None, status_code, validators
 
-        m3u_content_bytes = content_buffer.getvalue()
-        downloaded_size = current_download_size # Final size is the accumulated size
-        content_buffer.close() # Release memory buffer
 
-        # Final check: Incomplete download if server closed connection early but size is still acceptable
-        if expected_size is not None and downloaded_size < expected_size:
-             print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Warning: Final size {downloaded_size} less than expected {expected_size}. File might be incomplete.", "yellow")
+def check_parsed_download(parser: M3UStreamParser, expected_size: Optional[int]) -> Optional[M3UStreamParser]:
+    """
+    Applies the post-download checks (size limit, empty body, #EXTM3U header) to a closed parser.
+    Returns the parser if the download is usable, None otherwise. Raises ValueError on an empty body.
+    """
+    downloaded_size = parser.bytes_fed
+    # --- *** SIZE CHECK DURING DOWNLOAD *** ---
+    if parser.size_exceeded:
+        print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Skipping: Download exceeded size limit ({MAX_SIZE_MB}MB) during transfer.", "magenta")
+        metrics.set_outcome('size_limit')
+        return None
 
-        if downloaded_size == 0 and expected_size != 0:
-             raise ValueError("Downloaded content is empty.")
+    # Final check: Incomplete download if server closed connection early but size is still acceptable
+    if parser.is_m3u and expected_size is not None and downloaded_size < expected_size:
+         print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Warning: Final size {downloaded_size} less than expected {expected_size}. File might be incomplete.", "yellow")
 
-        print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Downloaded {downloaded_size / 1024 / 1024:.2f} MB.", "cyan")
+    if downloaded_size == 0 and expected_size != 0:
+         raise ValueError("Downloaded content is empty.")
 
-    except requests.exceptions.Timeout:
-        print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error: Timeout (30s).", "red")
-        return False
-    except requests.exceptions.RequestException as e:
-        status_code = getattr(e.response, 'status_code', 'N/A')
-        # Log common informative errors
-        if status_code == 404:
-             print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error: Not Found (404).", "red")
-        elif status_code == 403:
-             print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error: Forbidden (403). Check UA/Headers/IP?", "red")
-        elif status_code in [500, 502, 503, 504]:
-             print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error: Server Error ({status_code}).", "red")
+    if not parser.is_m3u:
+        print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error: Not valid M3U (no #EXTM3U). Skipping.", "red")
+        metrics.set_outcome('invalid_m3u')
+        return None
+
+    print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Downloaded {downloaded_size / 1024 / 1024:.2f} MB.", "cyan")
+    return parser
+
+
+def record_body_metrics(parser: Any, body_seconds: float, feed_seconds: float) -> None:
+    """
+    Records the body transfer of a download: the time spent in parser.feed counts as 'parse'
+    for an M3UStreamParser (parsing overlaps the transfer), the rest as 'download'.
+    """
+    if isinstance(parser, M3UStreamParser):
+        metrics.add_stage('parse', feed_seconds)
+        body_seconds -= feed_seconds
+    metrics.add_stage('download', body_seconds)
+    metrics.add_bytes(parser.bytes_fed)
+
+
+# --- Download/Process Function with Size Limit ---
+def download_process_and_save_m3u(m3u_url: str, file_index: int, output_folder: str,
+                                  scheduler: Optional[HostScheduler] = None,
+                                  cache: Optional[PlaylistCache] = None,
+                                  cpu_stage: Optional[CpuStage] = None,
+                                  in_flight: Optional[InFlightRequests] = None,
+                                  progress: Optional[journal.Journal] = None) -> bool:
+    """
+    Downloads (with size limit), parses, saves an M3U file ONLY IF it contains 'Bein',
+    and sorts groups before saving. Skips files > MAX_SIZE_BYTES.
+    Args:
+        m3u_url: The URL of the M3U file.
+        file_index: Position of m3u_url in the input (the output is named after the URL).
+        output_folder: The directory to save the file.
+        scheduler: Optional per-host scheduler; without one a throwaway session is used.
+        cache: Optional conditional-GET / content-hash cache.
+        cpu_stage: Optional process pool; the body is then only downloaded here and parsed there.
+        in_flight: Optional registry that lets a cancelled run abort the download.
+        progress: Optional journal the outcome is recorded in once the URL is done.
+    Returns:
+        True if processed and saved successfully, False otherwise.
+    Raises:
+        RunCancelled: The run was cancelled; nothing is recorded and the previous output is kept.
+    """
+    print_colored(f"https://www.ibm.com/support/pages/node/520321/stub Attempt: {m3u_url}", "cyan")
+    output_filepath = get_output_filepath(output_folder, m3u_url)
+    with metrics.trace_url(m3u_url) as trace:
+        conditional_headers = cache.conditional_headers(m3u_url) if cache else None
+        body_factory = M3UStreamParser if cpu_stage is None else M3UBodyBuffer
+
+        try:
+            if scheduler is None:
+                session = requests.Session()
+                adapter = dnscache.CachedHTTPAdapter(on_connect=in_flight.track if in_flight is not None else None)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                try:
+                    parser, status_code, validators = fetch_and_parse_m3u(session, m3u_url, conditional_headers,
+                                                                          body_factory, in_flight)
+                finally:
+                    session.close()
+            else:
+                host = get_url_host(m3u_url)
+                with scheduler.slot(host):
+                    parser, status_code, validators = fetch_and_parse_m3u(
+                        scheduler.session_for(host), m3u_url, conditional_headers, body_factory, in_flight)
+                scheduler.report(host, status_code)
+        except RunCancelled:
+            metrics.set_outcome('cancelled')
+            raise
+
+        if status_code == 304 and cache is not None:
+            print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Not modified (304), reusing cached result.", "cyan")
+            metrics.set_outcome('not_modified')
+            saved = cache.restore(m3u_url, output_filepath)
+        elif parser is None:
+            saved = False
         else:
-             print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error Download: {type(e).__name__} (Status: {status_code})", "red")
-        return False
+            saved = save_parsed_and_cache_m3u(parser, m3u_url, output_folder, cache, validators, cpu_stage)
+    if not saved:
+        discard_output(output_filepath) # Last run's copy of a playlist that failed or no longer qualifies
+    if progress is not None:
+        progress.record(m3u_url, saved=saved, outcome=trace.outcome)
+    return saved
+
+
+# --- Async Download Function (same limits and checks as the thread engine) ---
+async def fetch_and_parse_m3u_async(session: aiohttp.ClientSession, m3u_url: str,
+                                    conditional_headers: Optional[Dict[str, str]] = None,
+                                    body_factory: Callable[..., Any] = M3UStreamParser) -> Tuple[Optional[M3UStreamParser], Optional[int], Dict[str, str]]:
+    """
+    Async counterpart of fetch_and_parse_m3u. Each chunk is parsed on the loop as it
+    arrives, which keeps the per-step CPU work small (one chunk at a time); with
+    body_factory=M3UBodyBuffer the chunks are only collected.
+    Returns:
+        (closed parser, or None if skipped/failed/not modified, HTTP status code or None if no response,
+         cache validators {'etag', 'last_modified'} from the response)
+    """
+    status_code = None
+    validators: Dict[str, str] = {}
+    try:
+        headers = {**REQUEST_HEADERS, **conditional_headers} if conditional_headers else REQUEST_HEADERS
+        request_start = time.perf_counter()
+        async with session.get(m3u_url, headers=headers, allow_redirects=True) as response:
+            metrics.add_stage('ttfb', time.perf_counter() - request_start)
+            status_code = response.status
+            response.raise_for_status()
+            validators = get_cache_validators(response.headers)
+            if status_code == 304:
+                return None, status_code, validators
+
+            expected_size = response.content_length
+            if expected_size is not None and expected_size > MAX_SIZE_BYTES:
+                print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Skipping: Size ({expected_size / 1024 / 1024:.1f}MB) exceeds limit ({MAX_SIZE_MB}MB) based on Content-Length.", "magenta")
+                metrics.set_outcome('size_limit')
+                return None, status_code, validators
+
+            parser = body_factory(max_bytes=MAX_SIZE_BYTES)
+            body_start = time.perf_counter()
+            feed_seconds = 0.0
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                feed_start = time.perf_counter()
+                fed = parser.feed(chunk)
+                feed_seconds += time.perf_counter() - feed_start
+                if not fed:
+                    break
+        parser.close()
+        record_body_metrics(parser, time.perf_counter() - body_start, feed_seconds)
+        return check_parsed_download(parser, expected_size), status_code, validators
+
+    except asyncio.TimeoutError:
+        print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error: Timeout ({DOWNLOAD_TIMEOUT}s).", "red")
+        metrics.set_outcome('timeout')
+    except aiohttp.ClientResponseError as e:
+        print_download_error(e.status, type(e).__name__)
+    except aiohttp.ClientError as e:
+        print_download_error('N/A', type(e).__name__)
+        if is_connection_reset(e):
+            metrics.set_outcome('reset')
     except ValueError as e:
          print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error Download: {e}", "red")
-         return False
+         metrics.set_outcome('empty')
     except Exception as e:
         print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error Download (Unexpected): {type(e).__name__} - {e}", "red")
-        # Optionally print full traceback for unexpected errors
-        # print(traceback.format_exc())
-        return False
-    finally:
-         # Ensure session is closed even if errors occurred before assignment
-         if 'session' in locals() and session:
-              session.close()
+        metrics.set_outcome('error')
+    return None, status_code, validators
+
+
+# --- Async Download/Process Function ---
+async def download_process_and_save_m3u_async(session: aiohttp.ClientSession, m3u_url: str, file_index: int,
+                                              output_folder: str, cpu_executor: ThreadPoolExecutor,
+                                              scheduler: Optional[AsyncHostScheduler] = None,
+                                              cache: Optional[PlaylistCache] = None,
+                                              cpu_stage: Optional[CpuStage] = None,
+                                              on_saved: Optional[Callable[..., Any]] = None,
+                                              progress: Optional[journal.Journal] = None) -> bool:
+    """
+    Async counterpart of download_process_and_save_m3u. Download and parsing run on the event loop;
+    sorting and saving run in cpu_executor so a large playlist does not stall other downloads.
+    With a cpu_stage the loop only downloads, and cpu_executor threads hand the body to the process pool.
+    Args:
+        session: Shared aiohttp session (connection pool for all downloads).
+        m3u_url: The URL of the M3U file.
+        file_index: Position of m3u_url in the input (the output is named after the URL).
+        output_folder: The directory to save the file.
+        cpu_executor: Executor used for sorting and saving.
+        scheduler: Optional per-host scheduler.
+        cache: Optional conditional-GET / content-hash cache.
+        cpu_stage: Optional process pool for parsing, sorting and saving.
+        on_saved: Optional coroutine function awaited as on_saved(file_index, filepath, channels) after
+                  a successful save; channels are the parsed Channel records, or None if they are not
+                  in memory (cache restore after 304, cpu_stage parsing).
+        progress: Optional journal the outcome is recorded in once the URL is done.
+    Returns:
+        True if processed and saved successfully, False otherwise.
+    Cancelling the task aborts the request; nothing is recorded and the previous output is kept.
+    """
+    print_colored(f"https://www.ibm.com/support/pages/node/520321/stub Attempt: {m3u_url}", "cyan")
+    output_filepath = get_output_filepath(output_folder, m3u_url)
+    channels = None
+    with metrics.trace_url(m3u_url) as trace:
+        conditional_headers = cache.conditional_headers(m3u_url) if cache else None
+        body_factory = M3UStreamParser if cpu_stage is None else M3UBodyBuffer
+
+        try:
+            if scheduler is None:
+                parser, status_code, validators = await fetch_and_parse_m3u_async(
+                    session, m3u_url, conditional_headers, body_factory)
+            else:
+                host = get_url_host(m3u_url)
+                async with scheduler.slot(host):
+                    parser, status_code, validators = await fetch_and_parse_m3u_async(
+                        session, m3u_url, conditional_headers, body_factory)
+                scheduler.report(host, status_code)
+        except asyncio.CancelledError:
+            metrics.set_outcome('cancelled')
+            raise
+
+        loop = asyncio.get_running_loop()
+        # Executor threads do not inherit the loop's context; copy it so they record into this URL's trace
+        if status_code == 304 and cache is not None:
+            print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Not modified (304), reusing cached result.", "cyan")
+            metrics.set_outcome('not_modified')
+            saved = await loop.run_in_executor(cpu_executor, contextvars.copy_context().run,
+                                               cache.restore, m3u_url, output_filepath)
+        elif parser is None:
+            saved = False
+        else:
+            saved = await loop.run_in_executor(cpu_executor, contextvars.copy_context().run,
+                                               save_parsed_and_cache_m3u, parser, m3u_url,
+                                               output_folder, cache, validators, cpu_stage)
+            if isinstance(parser, M3UStreamParser):
+                channels = parser.result()[0]
+    if not saved:
+        discard_output(output_filepath) # Last run's copy of a playlist that failed or no longer qualifies
+    if progress is not None:
+        progress.record(m3u_url, saved=saved, outcome=trace.outcome)
+    if saved and on_saved is not None and os.path.exists(output_filepath): # Not a duplicate the cache left out
+        await on_saved(file_index, output_filepath, channels)
+    return saved
+
+
+# --- Cache-Aware Saving (shared by both engines) ---
+def save_parsed_and_cache_m3u(parser: Any, m3u_url: str, output_folder: str,
+                              cache: Optional[PlaylistCache] = None, validators: Optional[Dict[str, str]] = None,
+                              cpu_stage: Optional[CpuStage] = None) -> bool:
+    """
+    Runs save_parsed_m3u on a streamed playlist (or, with a cpu_stage, process_and_save_m3u on
+    an M3UBodyBuffer in a worker process) unless the cache already holds the result for these
+    exact bytes (then parsing, sorting and reserialization are skipped), and records the new
+    result in the cache.
+    Returns:
+        True if the playlist was saved (or restored from cache), False otherwise.
+    """
+    output_filepath = get_output_filepath(output_folder, m3u_url)
+
+    def save() -> bool:
+        if cpu_stage is not None:
+            saved, stages, outcome = cpu_stage.run(metrics.call_traced, process_and_save_m3u,
+                                                   parser.getvalue(), output_filepath)
+            metrics.merge_traced(stages, outcome)
+            return saved
+        channels, unique_groups, found_bein = parser.result()
+        return save_parsed_m3u(channels, unique_groups, found_bein, output_filepath)
 
+    if cache is None:
+        return save()
 
+    digest = parser.hexdigest()
+    if cache.is_unchanged(m3u_url, digest):
+        print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Content unchanged (hash match), reusing cached result.", "cyan")
+        metrics.set_outcome('unchanged')
+        return cache.restore(m3u_url, output_filepath)
+
+    saved = save()
+    cache.store(m3u_url, digest, validators or {}, output_filepath if saved else None)
+    return saved
+
+
+# --- Parse/Sort/Save Function (CPU part, shared by both engines) ---
+def process_and_save_m3u(m3u_content_bytes: Optional[bytes], output_filepath: str) -> bool:
+    """
+    Parses downloaded M3U bytes, saves them ONLY IF they contain 'Bein', and sorts groups before saving.
+    Args:
+        m3u_content_bytes: The downloaded M3U body.
+        output_filepath: Where to save the playlist (see get_output_filepath).
+    Returns:
+        True if processed and saved successfully, False otherwise.
+    """
     # 3. Parse the downloaded content and Check for 'Bein' (only if downloaded)
     try:
         if m3u_content_bytes is None: # Should not happen if download logic is correct, but check anyway
@@ -304,118 +1963,631 @@ def download_process_and_save_m3u(m3u_url: str, file_index: int, output_folder:
 
         if not m3u_text_content.strip().startswith('#EXTM3U'):
             print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error: Not valid M3U (no #EXTM3U). Skipping.", "red")
+            metrics.set_outcome('invalid_m3u')
             return False
 
         channels, unique_groups, found_bein = parse_m3u_content(m3u_text_content)
 
-        if not channels:
-             print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Warning: No channels parsed. Skipping.", "yellow")
-             return False
-
-        # --- CORE LOGIC: SKIP IF 'Bein' IS NOT FOUND ---
-        if not found_bein:
-            print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Skipping: No 'Bein' group.", "magenta")
-            return False
-        # else: # Reduce verbosity
-        #      print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub 'Bein' group found. Proceeding...", "cyan")
-
     except Exception as e:
         print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error Parsing: {type(e).__name__} - {e}", "red")
+        metrics.set_outcome('parse_error')
         return False
 
+    return save_parsed_m3u(channels, unique_groups, found_bein, output_filepath)
+
+
+# --- Sort/Save Function for Parsed Playlists ---
+def bucket_channels_by_group(channels: List[Channel]) -> Dict[str, List[Channel]]:
+    """
+    Groups channels that have a URL by their group title in a single pass.
+    Args:
+        channels: Parsed Channel records, in playlist order.
+    Returns:
+        Dict mapping group title to its channels, each list in playlist order.
+    """
+    buckets: Dict[str, List[Channel]] = {}
+    for channel in channels:
+        if channel.url:
+            bucket = buckets.get(channel.group_title)
+            if bucket is None:
+                buckets[channel.group_title] = bucket = []
+            bucket.append(channel)
+    return buckets
+
+def format_extinf_line(channel: Channel, group_name: str) -> str:
+    """
+    Renders the #EXTINF line for a channel, forcing its group-title to group_name.
+    Args:
+        channel: The Channel record to render.
+        group_name: The group title to write.
+    Returns:
+        The #EXTINF line without a trailing newline.
+    """
+    attributes_str = channel.attributes_str
+    canonical = CANONICAL_GROUP_ATTRIBUTES_RE.fullmatch(attributes_str)
+    if canonical is not None and canonical.group(1) == group_name:
+        # Already in the rendered layout unless a key repeats (those collapse below)
+        keys = CANONICAL_ATTRIBUTE_KEY_RE.findall(attributes_str)
+        if len(set(keys)) == len(keys):
+            return f"#EXTINF:{channel.duration} {attributes_str},{channel.name}"
+
+    extinf_parts = [f"#EXTINF:{channel.duration}"]
+    has_group_title = False
+    for key, value in channel.attributes:
+        if key == 'group-title':
+            value = group_name
+            has_group_title = True
+        safe_value = str(value).replace('"', "'")
+        extinf_parts.append(f'{key}="{safe_value}"')
+    if not has_group_title:
+        safe_value = group_name.replace('"', "'")
+        extinf_parts.append(f'group-title="{safe_value}"')
+    return " ".join(extinf_parts) + f",{channel.name}"
+
+def save_parsed_m3u(channels: List[Channel], unique_groups: List[str], found_bein: bool,
+                    output_filepath: str) -> bool:
+    """
+    Saves parsed channels ONLY IF they contain 'Bein', with groups sorted by sort_groups.
+    The file is left untouched if it already holds exactly the rendered playlist.
+    Args:
+        channels: Parsed Channel records.
+        unique_groups: Unique group titles.
+        found_bein: Whether a channel matched the 'require' filter rules (by default: a 'Bein' group).
+        output_filepath: Where to save the playlist (see get_output_filepath).
+    Returns:
+        True if saved (or already up to date), False otherwise.
+    """
+    output_filename = os.path.basename(output_filepath)
+    success = False
+
+    if not channels:
+         print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Warning: No channels parsed. Skipping.", "yellow")
+         metrics.set_outcome('no_channels')
+         return False
+
+    # --- CORE LOGIC: SKIP IF 'Bein' (the 'require' rules) IS NOT FOUND ---
+    if not found_bein:
+        print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Skipping: No {FILTER_RULES.description}.", "magenta")
+        metrics.set_outcome('no_bein')
+        return False
+    # else: # Reduce verbosity
+    #      print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub 'Bein' group found. Proceeding...", "cyan")
+
     # 4. Sort Groups
     try:
-        sorted_group_names = sort_groups(unique_groups)
+        with metrics.stage('sort'):
+            sorted_group_names = sort_groups(unique_groups)
         # print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Groups sorted.", "cyan") # Reduce verbosity
 
     except Exception as e:
         print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error Sorting Groups: {type(e).__name__}", "red")
+        metrics.set_outcome('sort_error')
         return False
 
-    # 5. Reconstruct M3U and Save
-    temp_filepath = output_filepath + f".{os.getpid()}.tmp" # Add PID for more unique temp names
+    # 5. Reconstruct M3U and Save (only if the bytes differ from the existing output)
+    write_start = time.perf_counter()
     try:
-        os.makedirs(output_folder, exist_ok=True)
+        channel_buckets = bucket_channels_by_group(channels)
+        valid_channels_count = sum(len(bucket) for bucket in channel_buckets.values())
+        channels_written = 0
+
+        chunks = [b'#EXTM3U\n']
+        written_group_names = []
+        for group_name in sorted_group_names:
+            bucket = channel_buckets.get(group_name)
+            if not bucket:
+                continue
+            group_lines = []
+            for channel in bucket:
+                group_lines.append(format_extinf_line(channel, group_name))
+                group_lines.append(channel.url)
+            group_lines.append('')
+            chunks.append("\n".join(group_lines).encode('utf-8', errors='ignore'))
+            written_group_names.append(group_name)
+            channels_written += len(bucket)
+
+        if channels_written != valid_channels_count:
+             print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Warning: Channel write count mismatch ({channels_written}/{valid_channels_count})", "yellow")
+
+        final_size = sum(len(chunk) for chunk in chunks)
+        if write_if_changed(output_filepath, chunks):
+            print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Saved: {output_filename} ({final_size / 1024 / 1024:.2f} MB)", "green")
+            metrics.set_outcome('saved')
+        else:
+            print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Unchanged: {output_filename} ({final_size / 1024 / 1024:.2f} MB), not rewritten.", "green")
+            metrics.set_outcome('saved_identical')
+        write_if_changed(get_index_path(get_chunks_digest(chunks)), [build_playlist_index(chunks, written_group_names)])
+        success = True
+
+    except Exception as e:
+        print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error Saving File: {type(e).__name__} - {e}", "red")
+        metrics.set_outcome('write_error')
+        success = False
+    metrics.add_stage('write', time.perf_counter() - write_start)
+    return success
 
-        with open(temp_filepath, 'wb') as f:
-            f.write(b'#EXTM3U\n')
 
-            channels_written = 0
-            valid_channels_count = sum(1 for ch in channels if ch.get('url'))
+# --- Near-Duplicate Clustering ---
+def channel_fingerprint_key(name: str, group_title: str, url: str) -> str:
+    """
+    Normalized identity of a channel that ignores panel credentials: lowercased name and
+    group plus the last URL path segment (the stream id).
+    """
+    stream_id = url.rstrip('/').rsplit('/', 1)[-1]
+    return f"{group_title.strip().lower()}\x1f{name.strip().lower()}\x1f{stream_id}"
 
-            for group_name in sorted_group_names:
-                for channel in channels:
-                    if channel.get('group_title') == group_name and channel.get('url'):
-                        extinf_parts = [f"#EXTINF:{channel.get('duration', -1)}"]
-                        attributes = channel.get('attributes', {})
-                        attributes['group-title'] = group_name
-                        for key, value in attributes.items():
-                             safe_value = str(value).replace('"', "'")
-                             extinf_parts.append(f'{key}="{safe_value}"')
 
-                        extinf_line = " ".join(extinf_parts) + f",{channel.get('name', 'Unnamed Channel')}"
+class PlaylistFingerprint:
+    """
+    Exact hash plus bottom-k MinHash sketch of a playlist's normalized channel set.
+    Two playlists served by the same backend under different credentials have the
+    same exact hash; a few added or removed channels keep the sketches close.
+    """
+    __slots__ = ('file_index', 'channel_count', 'exact', 'sketch', '_sketch_set')
+
+    def __init__(self, file_index: int, keys: Any, sketch_size: int = MINHASH_SKETCH_SIZE) -> None:
+        hashes = {int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+                  for key in keys}
+        self.file_index = file_index
+        self.channel_count = len(hashes)
+        self.exact = hashlib.sha256(b''.join(h.to_bytes(8, 'big') for h in sorted(hashes))).hexdigest()
+        self.sketch = heapq.nsmallest(sketch_size, hashes)
+        self._sketch_set = frozenset(self.sketch)
+
+    def similarity(self, other: 'PlaylistFingerprint') -> float:
+        """Estimated Jaccard similarity of the two channel sets."""
+        if self.exact == other.exact:
+            return 1.0
+        union_sketch = heapq.nsmallest(len(self.sketch), self._sketch_set | other._sketch_set)
+        if not union_sketch:
+            return 0.0
+        shared = sum(1 for h in union_sketch if h in self._sketch_set and h in other._sketch_set)
+        return shared / len(union_sketch)
+
+
+def fingerprint_channels(channels: List[Channel], file_index: int) -> PlaylistFingerprint:
+    """Fingerprints parsed channels (only those with a URL, as written by save_parsed_m3u)."""
+    return PlaylistFingerprint(file_index, (channel_fingerprint_key(ch.name, ch.group_title, ch.url)
+                                            for ch in channels if ch.url))
+
+
+def fingerprint_saved_playlist(filepath: str, file_index: int) -> Optional[PlaylistFingerprint]:
+    """
+    Fingerprints a playlist written by save_parsed_m3u (or restored from the cache). Those files
+    always have the URL right after its '#EXTINF' line, so one EXTINF_PAIR_RE scan is enough.
+    Returns None if the file cannot be read.
+    """
+    try:
+        with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
+            text = f.read()
+    except OSError as e:
+        print_colored(f"  Warning: Could not fingerprint '{filepath}': {e}", "yellow")
+        return None
+    return PlaylistFingerprint(file_index, (
+        channel_fingerprint_key(name, extract_group_title(attributes_str.strip()), url.rstrip())
+        for _, attributes_str, name, url in EXTINF_PAIR_RE.findall(text)))
 
-                        try:
-                            f.write(extinf_line.encode('utf-8', errors='ignore') + b'\n')
-                            f.write(channel['url'].encode('utf-8', errors='ignore') + b'\n')
-                            channels_written += 1
-                        except Exception as write_err:
-                             # Log write errors less verbosely or collect them
-                             pass # print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error writing channel '{channel.get('name')}': {write_err}", "yellow")
 
+def cluster_fingerprints(fingerprints: List[PlaylistFingerprint],
+                         threshold: float = DEDUPE_SIMILARITY) -> List[List[Tuple[PlaylistFingerprint, float]]]:
+    """
+    Greedy clustering: playlists are visited largest first (then by file index) and join the
+    first representative they match (same exact hash or similarity >= threshold).
+    Returns:
+        Clusters as lists of (fingerprint, similarity to the representative); the first item
+        of each cluster is its representative.
+    """
+    clusters: List[List[Tuple[PlaylistFingerprint, float]]] = []
+    by_exact: Dict[str, List[Tuple[PlaylistFingerprint, float]]] = {}
+    for fingerprint in sorted(fingerprints, key=lambda fp: (-fp.channel_count, fp.file_index)):
+        cluster = by_exact.get(fingerprint.exact)
+        similarity = 1.0
+        if cluster is None:
+            for candidate in clusters:
+                similarity = candidate[0][0].similarity(fingerprint)
+                if similarity >= threshold:
+                    cluster = candidate
+                    break
+        if cluster is None:
+            cluster = []
+            clusters.append(cluster)
+            similarity = 1.0
+        cluster.append((fingerprint, similarity))
+        by_exact.setdefault(fingerprint.exact, cluster)
+    return clusters
 
-            if channels_written != valid_channels_count:
-                 print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Warning: Channel write count mismatch ({channels_written}/{valid_channels_count})", "yellow")
 
-        # Atomic move/replace
-        if os.path.exists(output_filepath):
-             os.remove(output_filepath) # Remove existing file first on some systems for reliability
-        shutil.move(temp_filepath, output_filepath)
+def read_cluster_fallbacks(output_folder: str) -> Set[str]:
+    """Source URLs the last dedupe (its CLUSTERS_MANIFEST in output_folder) listed as fallbacks."""
+    try:
+        with open(os.path.join(output_folder, CLUSTERS_MANIFEST), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        return {fallback['url'] for cluster in manifest for fallback in cluster.get('fallbacks', [])}
+    except FileNotFoundError:
+        return set()
+    except (OSError, ValueError, TypeError, KeyError) as e:
+        print_colored(f"Warning: Could not read '{CLUSTERS_MANIFEST}': {e}", "yellow")
+        return set()
 
-        final_size = os.path.getsize(output_filepath)
-        print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Saved: {output_filename} ({final_size / 1024 / 1024:.2f} MB)", "green")
-        success = True
 
-    except Exception as e:
-        print_colored(f"  https://www.ibm.com/support/pages/node/520321/stub Error Saving File: {type(e).__name__} - {e}", "red")
-        success = False
-    finally:
-        # Clean up temp file if move failed or error occurred
-        if os.path.exists(temp_filepath):
+def dedupe_saved_playlists(output_folder: str, m3u_urls: List[str], threshold: float = DEDUPE_SIMILARITY,
+                           cache: Optional[PlaylistCache] = None) -> Tuple[int, int]:
+    """
+    Clusters the playlists saved in output_folder, keeps one representative per cluster and
+    removes the others, recording them (file, source URL, similarity) as fallbacks of their
+    representative in CLUSTERS_MANIFEST. Later stages then only probe and commit one copy
+    per backend. Duplicates the cache left out this run (unchanged since the last dedupe) are
+    clustered from their cached copies, so they stay fallbacks without being written and
+    removed again; one that now represents its cluster is written out.
+    Args:
+        output_folder: Folder holding the outputs (named by get_output_name).
+        m3u_urls: Source URLs in input order; fingerprints carry the 1-based index of a URL's first line.
+        threshold: Minimum estimated similarity for a near-duplicate.
+        cache: The run's PlaylistCache, if any (see PlaylistCache.known_duplicates).
+    Returns:
+        (number of clusters, number of fallbacks)
+    """
+    fingerprints = []
+    first_index: Dict[str, int] = {}
+    for file_index, m3u_url in enumerate(m3u_urls, 1):
+        first_index.setdefault(m3u_url, file_index) # A repeated line shares its URL's output
+    for m3u_url, file_index in first_index.items():
+        filepath = get_output_filepath(output_folder, m3u_url)
+        if not os.path.exists(filepath) and cache is not None:
+            filepath = cache.skipped_copy(m3u_url) or filepath
+        if os.path.exists(filepath):
+            fingerprint = fingerprint_saved_playlist(filepath, file_index)
+            if fingerprint is not None and fingerprint.channel_count:
+                fingerprints.append(fingerprint)
+
+    clusters = cluster_fingerprints(fingerprints, threshold)
+    manifest = []
+    removed = 0
+    for cluster in clusters:
+        representative = cluster[0][0]
+        representative_url = m3u_urls[representative.file_index - 1]
+        if cache is not None and cache.skipped_copy(representative_url) is not None:
+            cache.restore_skipped(representative_url, get_output_filepath(output_folder, representative_url))
+        fallbacks = []
+        for fingerprint, similarity in cluster[1:]:
+            filepath = get_output_filepath(output_folder, m3u_urls[fingerprint.file_index - 1])
+            removed += 1
             try:
-                os.remove(temp_filepath)
-            except OSError:
-                pass
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass # Left out by the cache
+            except OSError as e:
+                print_colored(f"  Warning: Could not remove duplicate '{filepath}': {e}", "yellow")
+            fallbacks.append({
+                'file': os.path.basename(filepath), 'url': m3u_urls[fingerprint.file_index - 1],
+                'channels': fingerprint.channel_count, 'similarity': round(similarity, 3),
+            })
+        manifest.append({
+            'file': get_output_name(representative_url),
+            'url': representative_url,
+            'channels': representative.channel_count, 'fallbacks': fallbacks,
+        })
+
+    manifest_path = os.path.join(output_folder, CLUSTERS_MANIFEST)
+    temp_path = manifest_path + f".{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(temp_path, manifest_path)
+    except OSError as e:
+        print_colored(f"Warning: Could not write '{manifest_path}': {e}", "yellow")
+    return len(clusters), removed
+
+
+# --- Peak Memory Helper ---
+def get_peak_rss_mb() -> Optional[float]:
+    """Returns the peak resident set size of this process in MB, or None if unavailable."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 1024 / 1024 # Bytes on macOS
+    return peak / 1024 # Kilobytes on Linux
+
+
+# --- Thread Engine ---
+def run_thread_engine(m3u_urls: List[str], output_folder: str, max_concurrent_workers: int,
+                      shutdown_event: threading.Event, per_host_limit: int = PER_HOST_LIMIT,
+                      cache: Optional[PlaylistCache] = None,
+                      cpu_stage: Optional[CpuStage] = None,
+                      limit: Optional[AIMDLimit] = None,
+                      dns_cache: Optional[dnscache.DNSCache] = None,
+                      progress: Optional[journal.Journal] = None) -> Tuple[int, int, int]:
+    """
+    Runs download_process_and_save_m3u for every URL in a thread pool, submitted in
+    round-robin host order and throttled per host by a HostScheduler. A URL is only submitted
+    once the adaptive limit (default: AIMDLimit up to max_concurrent_workers) has a free slot,
+    so the pool only grows threads as far as the limit does. URLs on hosts the dns_cache knows
+    do not resolve are skipped without a thread, and the others connect to the cached addresses.
+    With a cpu_stage the
+    threads only download and parsing/saving runs in the process pool.
+    Once shutdown_event is set, downloads not started yet are cancelled and those in flight are
+    aborted (InFlightRequests); the engine waits at most CANCEL_DRAIN_SEC for them and returns.
+    Returns:
+        (processed_count, saved_count, error_count), counting only URLs that finished
+    """
+    processed_count = 0
+    saved_count = 0
+    error_count = 0
+
+    limit = limit or AIMDLimit("download", max_concurrent_workers)
+    limiter = AdaptiveLimiter(limit)
+    in_flight = InFlightRequests(shutdown_event)
+    scheduler = HostScheduler(per_host_limit, limit, shutdown_event, dns_cache, in_flight.track)
 
-    # Clean up final file if saving clearly failed
-    if not success and os.path.exists(output_filepath):
+    def download_in_slot(*args: Any) -> bool:
         try:
-            os.remove(output_filepath)
-        except OSError:
-            pass
+            return download_process_and_save_m3u(*args)
+        finally:
+            limiter.release()
 
-    return success
+    executor = ThreadPoolExecutor(max_workers=max_concurrent_workers)
+    try:
+        futures = {}
+        for idx, m3u_url in interleave_by_host(m3u_urls):
+            if skip_unresolvable(m3u_url, dns_cache):
+                processed_count += 1
+                error_count += 1
+                if progress is not None:
+                    progress.record(m3u_url, saved=False, outcome='dns_error')
+                continue
+            if not limiter.acquire(shutdown_event):
+                break # Shutdown: submit nothing more
+            future = executor.submit(download_in_slot, m3u_url, idx, output_folder, scheduler, cache, cpu_stage,
+                                     in_flight, progress)
+            futures[future] = (idx, m3u_url)
+
+        pending = set(futures)
+        drain_deadline = None
+        while pending:
+            done, pending = wait(pending, timeout=CANCEL_POLL_SEC, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.cancelled():
+                    continue
+                idx, url = futures[future]
+                try:
+                    was_successful = future.result()
+                except RunCancelled:
+                    continue # Not finished; a resumed run does it again
+                except Exception as e:
+                    print_colored(f"Critical error retrieving result for URL #{idx}: {e}", "red")
+                    processed_count += 1
+                    error_count += 1
+                    continue
+                processed_count += 1
+                if was_successful:
+                    saved_count += 1
+                else:
+                    # Reason (no 'Bein', size limit, HTTP error...) is in the metrics outcome
+                    error_count += 1 # Increment general non-save counter
+            if shutdown_event.is_set() and drain_deadline is None:
+                for future in pending:
+                    future.cancel() # Not started yet
+                aborted = in_flight.cancel()
+                print_colored(f"Shutdown signaled: aborted {aborted} open connections, "
+                              f"waiting up to {CANCEL_DRAIN_SEC:.0f}s for the workers to stop.", "yellow")
+                drain_deadline = time.monotonic() + CANCEL_DRAIN_SEC
+            if drain_deadline is not None and time.monotonic() >= drain_deadline:
+                if pending:
+                    print_colored(f"{len(pending)} workers are still connecting; not waiting for them.", "yellow")
+                break
+    finally:
+        shutdown_executor(executor, wait=not shutdown_event.is_set())
+        scheduler.close()
+    return processed_count, saved_count, error_count
+
+
+# --- Async Engine ---
+async def run_async_engine(m3u_urls: List[str], output_folder: str, max_concurrent_workers: int,
+                           shutdown_event: threading.Event, per_host_limit: int = PER_HOST_LIMIT,
+                           cache: Optional[PlaylistCache] = None,
+                           cpu_stage: Optional[CpuStage] = None,
+                           on_saved: Optional[Callable[..., Any]] = None,
+                           limit: Optional[AIMDLimit] = None,
+                           dns_cache: Optional[dnscache.DNSCache] = None,
+                           progress: Optional[journal.Journal] = None) -> Tuple[int, int, int]:
+    """
+    Runs download_process_and_save_m3u_async for every URL on one event loop.
+    Worker coroutines pull from a queue while holding a slot of the adaptive limit (default:
+    AIMDLimit up to max_concurrent_workers), so at most that many bodies are held in memory
+    at once; parsing and saving use a small thread pool sized to the CPUs
+    (with a cpu_stage, one thread per pending slot that hands bodies to the process pool).
+    URLs are queued in round-robin host order and throttled per host by an AsyncHostScheduler.
+    With a dns_cache, hosts known not to resolve are skipped and the others connect to the
+    cached addresses.
+    on_saved is passed to every download (a slow on_saved holds back further downloads).
+    Once shutdown_event is set the worker tasks are cancelled, which aborts their requests.
+    Returns:
+        (processed_count, saved_count, error_count), counting only URLs that finished
+    """
+    counts = {'processed': 0, 'saved': 0, 'error': 0}
+    queue: asyncio.Queue = asyncio.Queue()
+    for idx, m3u_url in interleave_by_host(m3u_urls):
+        if skip_unresolvable(m3u_url, dns_cache):
+            counts['processed'] += 1
+            counts['error'] += 1
+            if progress is not None:
+                progress.record(m3u_url, saved=False, outcome='dns_error')
+        else:
+            queue.put_nowait((idx, m3u_url))
+
+    limit = limit or AIMDLimit("download", max_concurrent_workers)
+    limiter = AsyncAdaptiveLimiter(limit)
+    scheduler = AsyncHostScheduler(per_host_limit, limit)
+    timeout = aiohttp.ClientTimeout(sock_connect=DOWNLOAD_TIMEOUT, sock_read=DOWNLOAD_TIMEOUT)
+    resolver = dns_cache.aiohttp_resolver() if dns_cache is not None else None
+    connector = aiohttp.TCPConnector(limit=max_concurrent_workers, limit_per_host=scheduler.per_host_limit,
+                                     ttl_dns_cache=300, resolver=resolver)
+    trace_configs = [metrics.aiohttp_trace_config()] # DNS and connect timings per URL
+
+    cpu_threads = cpu_stage.max_pending if cpu_stage is not None else os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=cpu_threads) as cpu_executor:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                         trace_configs=trace_configs) as session:
+
+            async def worker() -> None:
+                while not shutdown_event.is_set() and not queue.empty():
+                    async with limiter.slot():
+                        try:
+                            idx, m3u_url = queue.get_nowait()
+                        except asyncio.QueueEmpty:
+                            return
+                        try:
+                            saved = await download_process_and_save_m3u_async(session, m3u_url, idx, output_folder,
+                                                                              cpu_executor, scheduler, cache, cpu_stage,
+                                                                              on_saved, progress)
+                        except Exception as e:
+                            print_colored(f"Critical error retrieving result for URL #{idx}: {e}", "red")
+                            saved = False
+                        counts['processed'] += 1
+                        counts['saved' if saved else 'error'] += 1
+
+            async def cancel_on_shutdown(tasks: List[asyncio.Task]) -> None:
+                while not shutdown_event.is_set():
+                    await asyncio.sleep(CANCEL_POLL_SEC)
+                for task in tasks:
+                    task.cancel()
+
+            num_workers = max(1, min(max_concurrent_workers, len(m3u_urls)))
+            workers = [asyncio.ensure_future(worker()) for _ in range(num_workers)]
+            watcher = asyncio.ensure_future(cancel_on_shutdown(workers))
+            try:
+                await asyncio.gather(*workers, return_exceptions=True) # Cancelled workers end with CancelledError
+            finally:
+                watcher.cancel()
+
+    if shutdown_event.is_set():
+        print_colored("Shutdown signaled, stopping result processing.", "yellow")
+    return counts['processed'], counts['saved'], counts['error']
+
+
+# --- Resuming Interrupted Runs ---
+def split_resumed_urls(m3u_urls: List[str], output_folder: str,
+                       progress: journal.Journal) -> Tuple[List[str], int, int]:
+    """
+    Splits m3u_urls into the URLs still to do and those the journal of an interrupted run
+    already covers (a saved URL only while its output still exists).
+    Returns:
+        (pending URLs, resumed count, resumed saved count)
+    """
+    pending = []
+    resumed = resumed_saved = 0
+    for m3u_url in m3u_urls:
+        entry = progress.get(m3u_url)
+        if entry is None or (entry.get('saved') and not os.path.exists(get_output_filepath(output_folder, m3u_url))):
+            pending.append(m3u_url)
+            continue
+        resumed += 1
+        resumed_saved += bool(entry.get('saved'))
+    return pending, resumed, resumed_saved
+
+
+# --- Output Folder Preparation ---
+def prepare_output_folder(output_folder: str, m3u_urls: List[str]) -> int:
+    """
+    Creates output_folder if needed and removes the files in it that no URL of this run writes
+    (playlists dropped from the input, old index-named M3U{n}.m3u files, leftover temp files).
+    Outputs of current URLs are kept so unchanged playlists are not rewritten, and so is the
+    CLUSTERS_MANIFEST (see PlaylistCache.known_duplicates); exits if the folder cannot be created.
+    Returns:
+        The number of stale files removed.
+    """
+    try:
+        os.makedirs(output_folder, exist_ok=True)
+    except OSError as e:
+         print_colored(f"Fatal Error: Could not create output folder '{output_folder}': {e}", "red")
+         sys.exit(1)
+
+    current = {get_output_name(m3u_url) for m3u_url in m3u_urls}
+    current.add(CLUSTERS_MANIFEST) # Replaced by the next complete dedupe
+    removed = 0
+    for entry in os.scandir(output_folder):
+        if entry.name in current:
+            continue
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+            removed += 1
+        except OSError as e:
+            print_colored(f"Warning: Could not remove stale output '{entry.path}': {e}", "yellow")
+    if removed:
+        print_colored(f"Removed {removed} stale file(s) from {output_folder}.", "yellow")
+    return removed
+
+
+# --- Command Line Arguments ---
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parses command line options."""
+    parser = argparse.ArgumentParser(description="Download, filter ('Bein') and save M3U playlists.")
+    parser.add_argument("--engine", choices=ENGINES, default="thread",
+                        help="Download engine: 'thread' (ThreadPoolExecutor) or 'async' (asyncio/aiohttp).")
+    parser.add_argument("--workers", type=int, default=2000,
+                        help="Ceiling of the adaptive download concurrency (threads or in-flight requests).")
+    parser.add_argument("--start-workers", type=int, default=AIMD_START,
+                        help="Concurrency the adaptive limit starts from; it grows while latency and errors stay healthy.")
+    parser.add_argument("--per-host", type=int, default=PER_HOST_LIMIT,
+                        help="Max in-flight requests per host (panels throttle or block beyond this).")
+    parser.add_argument("--cache-dir", default=CACHE_DIR,
+                        help="Directory of the conditional-GET / content-hash cache.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always download, parse and rewrite every playlist.")
+    parser.add_argument("--no-dns-cache", action="store_true",
+                        help="Resolve hosts per request through the system resolver instead of up front.")
+    parser.add_argument("--cpu-workers", type=int, default=None,
+                        help="Processes for parsing/sorting/saving (default: one per core, 0 on a single core; "
+                             "0 parses inside the download workers).")
+    parser.add_argument("--no-dedupe", action="store_true",
+                        help="Keep every saved playlist instead of one per near-duplicate cluster.")
+    parser.add_argument("--similarity", type=float, default=DEDUPE_SIMILARITY,
+                        help="Estimated channel-set similarity at which playlists count as duplicates.")
+    parser.add_argument("--rules", default=filters.FILTER_RULES_FILE,
+                        help="JSON filter rule file (require/include/exclude patterns, group priority tiers); "
+                             "the built-in 'Bein' rules apply if it does not exist.")
+    parser.add_argument("--metrics-dir", default=metrics.METRICS_DIR,
+                        help="Directory the per-stage metrics (hotrun.json, hotrun.prom) are written to.")
+    parser.add_argument("--journal", default=None,
+                        help=f"Progress journal of this run (default: {JOURNAL_FILE} in --cache-dir); an interrupted "
+                             "run leaves it behind and the next run skips the URLs it records.")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Ignore the journal of an interrupted run and process every URL.")
+    parser.add_argument("--resume-max-age", type=float, default=journal.JOURNAL_MAX_AGE_SEC,
+                        help="Seconds a journal entry stays fresh enough to skip its URL.")
+    parser.add_argument("--time-budget", type=float, default=None,
+                        help="Seconds after which the run cancels itself (like Ctrl+C) and keeps its progress, "
+                             "e.g. to finish before a CI job timeout.")
+    return parser.parse_args(argv)
 
 
 # --- Main Function ---
-def main() -> None:
+def main(argv: Optional[List[str]] = None) -> None:
     """Main function to read URLs, download, process, and save M3U files."""
+    args = parse_args(argv)
     # --- Parameters ---
     input_file = "m3ulinks.txt" # Input file name
     output_folder = "specialiptvs" # Output folder
-    max_concurrent_workers = 2000 # Max concurrent workers
+    max_concurrent_workers = args.workers # Max concurrent workers
     # MAX_SIZE_MB is defined as a constant at the top
+    filter_rules = load_filter_rules(args.rules) # Before any parser or CpuStage is created
 
     start_time = time.time()
 
     print_colored(f"--- M3U Downloader & Processor ---", "magenta")
     print_colored(f"Input file: '{input_file}'", "cyan")
     print_colored(f"Output folder: '{output_folder}'", "cyan")
-    print_colored(f"Required Group: 'Bein' (case-insensitive)", "yellow")
+    print_colored(f"Engine: '{args.engine}'", "cyan")
+    print_colored(f"Filter rules: {filter_rules.summary()}", "yellow")
     print_colored(f"Max File Size: {MAX_SIZE_MB} MB", "yellow")
-    print_colored(f"--- WARNING: Max concurrent workers set to {max_concurrent_workers}! ---", "red")
-    print_colored(f"--- High worker count likely unstable & may cause IP blocks! ---", "red")
-    print_colored(f"--- Download timeout set to 30 seconds. ---", "yellow")
+    print_colored(f"--- Adaptive concurrency: starts at {args.start_workers}, ceiling {max_concurrent_workers} "
+                  f"(cut on timeouts, resets and 5xx). ---", "yellow")
+    print_colored(f"--- Download timeout set to {DOWNLOAD_TIMEOUT} seconds. ---", "yellow")
+    print_colored(f"--- Per-host limit: {args.per_host} in-flight requests (adaptive backoff on 403/429/5xx). ---", "yellow")
     print_colored(f"----------------------------------", "magenta")
 
 
@@ -429,83 +2601,109 @@ def main() -> None:
 
 
     # Clean and prepare output directory
-    if os.path.exists(output_folder):
-         print_colored(f"Removing existing output folder: {output_folder}...", "yellow")
-         try:
-            shutil.rmtree(output_folder)
-            time.sleep(0.5)
-         except OSError as e:
-             print_colored(f"Warning: Could not remove folder '{output_folder}': {e}.", "yellow")
-
-    try:
-        os.makedirs(output_folder, exist_ok=True)
-    except OSError as e:
-         print_colored(f"Fatal Error: Could not create output folder '{output_folder}': {e}", "red")
-         sys.exit(1)
-
-
-    print_colored(f"Starting parallel processing of {len(m3u_urls)} M3U files...", "magenta")
+    prepare_output_folder(output_folder, m3u_urls)
+
+    progress = journal.Journal(args.journal or os.path.join(args.cache_dir, JOURNAL_FILE),
+                               {'tool': 'hotrun', 'rules': filter_rules.digest, 'output': output_folder},
+                               args.resume_max_age, resume=not args.no_resume)
+    pending_urls, resumed_count, resumed_saved = split_resumed_urls(m3u_urls, output_folder, progress)
+    if resumed_count:
+        print_colored(f"Resuming an interrupted run: {resumed_count} URLs already done ({resumed_saved} saved), "
+                      f"{len(pending_urls)} to go.", "yellow")
+
+
+    cache = None if args.no_cache else PlaylistCache(args.cache_dir, filter_rules.digest)
+    if cache is not None and not args.no_dedupe:
+        cache.known_duplicates = read_cluster_fallbacks(output_folder)
+    dns_cache = None
+    if not args.no_dns_cache:
+        dns_cache = dnscache.DNSCache(os.path.join(args.cache_dir, "dns.json"))
+        hosts = [dnscache.get_hostname(m3u_url) for m3u_url in m3u_urls]
+        dns_start = time.perf_counter()
+        looked_up = dns_cache.resolve_blocking(hosts)
+        log_dns_stage(dns_cache, hosts, looked_up, time.perf_counter() - dns_start)
+    cpu_workers = get_cpu_workers(args.cpu_workers)
+    cpu_stage = CpuStage(cpu_workers) if cpu_workers else None
+
+    download_limit = AIMDLimit("download", max_concurrent_workers, args.start_workers)
+
+    print_colored(f"Starting parallel processing of {len(pending_urls)} M3U files...", "magenta")
 
     processed_count = 0
     saved_count = 0
-    skipped_size_count = 0
-    skipped_no_bein_count = 0
     error_count = 0
 
-    # Global flag to signal shutdown
-    shutdown_flag = False
-    def signal_handler(sig, frame):
-        nonlocal shutdown_flag
-        if not shutdown_flag: # Prevent multiple prints if Ctrl+C is hit repeatedly
-             print_colored('\nCtrl+C detected. Attempting graceful shutdown (may take time)...', 'yellow')
-             shutdown_flag = True
-    signal.signal(signal.SIGINT, signal_handler)
+    # Ctrl+C, SIGTERM and --time-budget set the shutdown event; progress so far stays in the journal
+    shutdown = ShutdownControl(args.time_budget).install()
+    shutdown.at_exit(lambda: metrics.write_reports("hotrun", args.metrics_dir))
+    shutdown_event = shutdown.event
 
     try:
-        with ThreadPoolExecutor(max_workers=max_concurrent_workers) as executor:
-            futures = {
-                executor.submit(download_process_and_save_m3u, m3u_url, idx, output_folder): (idx, m3u_url)
-                for idx, m3u_url in enumerate(m3u_urls, start=1)
-            }
-
-            for future in as_completed(futures):
-                # Check shutdown flag before processing next result
-                if shutdown_flag:
-                    # Optionally try to cancel pending futures (though not guaranteed)
-                    # for f in futures:
-                    #     if not f.done(): f.cancel()
-                    print_colored("Shutdown signaled, stopping result processing.", "yellow")
-                    break
-
-                idx, url = futures[future]
-                processed_count += 1
-                try:
-                    was_successful = future.result()
-                    if was_successful:
-                        saved_count += 1
-                    else:
-                        # Can't easily distinguish reason here, rely on function logs
-                        error_count += 1 # Increment general non-save counter
-                except Exception as e:
-                    print_colored(f"Critical error retrieving result for URL #{idx}: {e}", "red")
-                    error_count += 1
+        if args.engine == "async":
+            processed_count, saved_count, error_count = asyncio.run(
+                run_async_engine(pending_urls, output_folder, max_concurrent_workers, shutdown_event, args.per_host,
+                                 cache, cpu_stage, limit=download_limit, dns_cache=dns_cache, progress=progress))
+        else:
+            processed_count, saved_count, error_count = run_thread_engine(
+                pending_urls, output_folder, max_concurrent_workers, shutdown_event, args.per_host, cache, cpu_stage,
+                download_limit, dns_cache, progress)
 
     except Exception as e:
-         print_colored(f"\nFatal error during thread pool execution: {type(e).__name__} - {e}", "red")
-         error_count = len(m3u_urls) - saved_count # Assume remaining failed
-
+         print_colored(f"\nFatal error during {args.engine} engine execution: {type(e).__name__} - {e}", "red")
+         error_count = len(pending_urls) - saved_count # Assume remaining failed
+    finally:
+        if cpu_stage is not None:
+            cpu_stage.close()
+    processed_count += resumed_count
+    saved_count += resumed_saved
+    error_count += resumed_count - resumed_saved
+
+    cluster_count = None
+    removed_duplicates = 0
+    if not args.no_dedupe and not shutdown_event.is_set():
+        cluster_count, removed_duplicates = dedupe_saved_playlists(output_folder, m3u_urls, args.similarity, cache)
+        print_colored(f"Kept {cluster_count} playlists, removed {removed_duplicates} near-duplicates "
+                      f"(fallbacks listed in '{CLUSTERS_MANIFEST}').", "cyan")
+
+    if cache is not None:
+        evicted = cache.evict()
+        cache.save()
+        if evicted:
+            print_colored(f"Evicted {evicted} stale cache entries from '{args.cache_dir}'.", "cyan")
+    prune_playlist_indexes()
+    if dns_cache is not None:
+        dns_cache.save()
+    if shutdown.cancelled:
+        progress.close()
+        print_colored(f"Run stopped ({shutdown.reason}) after {len(progress)} of {len(m3u_urls)} URLs; "
+                      f"progress kept in '{progress.path}' for the next run.", "yellow")
+    else:
+        progress.complete()
 
     end_time = time.time()
     duration = end_time - start_time
+    peak_rss_mb = get_peak_rss_mb()
+    outcome_counts = metrics.recorder.outcome_counts('playlist')
+    report_paths = metrics.write_reports("hotrun", args.metrics_dir)
 
     # Final Summary (Counts for skipped reasons are not precise from here)
     print_colored(f"\n--- Processing Summary ---", "magenta")
     print_colored(f"Total URLs attempted: {len(m3u_urls)}", "cyan")
-    print_colored(f"Successfully saved (contained 'Bein', <= {MAX_SIZE_MB}MB): {saved_count}", "green")
+    print_colored(f"Successfully saved (contained {filter_rules.description}, <= {MAX_SIZE_MB}MB): {saved_count}", "green")
     print_colored(f"Skipped or Failed: {error_count + (processed_count - saved_count - error_count)}", "red") # Estimate skipped based on difference
-    print_colored(f"(Check logs for skips: size limit, no 'Bein', errors)", "yellow")
+    if outcome_counts:
+        print_colored("Outcomes: " + ", ".join(f"{outcome} {count}" for outcome, count in outcome_counts.items()), "yellow")
+    if cluster_count is not None:
+        print_colored(f"Unique playlists after dedupe: {cluster_count} ({removed_duplicates} duplicates moved to fallbacks)", "green")
+    print_colored(f"Engine: {args.engine} (adaptive workers: peak {download_limit.peak}, final {download_limit.current()} "
+                  f"of {max_concurrent_workers}; {args.per_host} per host, {cpu_workers or 'no'} CPU processes)", "cyan")
     print_colored(f"Total processing time: {duration:.2f} seconds", "cyan")
+    if peak_rss_mb is not None:
+        print_colored(f"Peak RSS: {peak_rss_mb:.1f} MB", "cyan")
+    if report_paths is not None:
+        print_colored(f"Metrics: {report_paths[0]}, {report_paths[1]}", "cyan")
     print_colored(f"--------------------------", "magenta")
+    shutdown.finish()
 
 # --- Entry Point ---
 if __name__ == "__main__":
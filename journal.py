@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Progress journal for resumable runs of hotrun.py and toptv.py.
+
+A run that is interrupted (Ctrl+C, a cancelled or timed-out Actions job, --time-budget) used
+to lose all of its progress. A Journal appends one JSON line per finished item (a playlist
+URL for hotrun.py, a playlist file for toptv.py) the moment it finishes, flushed straight
+away, so at most the items in flight are lost. The next run with the same context (filter
+rules, probe settings) loads the entries newer than JOURNAL_MAX_AGE_SEC and skips those items;
+a run that completes removes its journal, so the run after it starts over.
+
+    {"journal": 1, "context": {"tool": "hotrun", ...}, "started": 1760000000.0}
+    {"key": "http://panel/get.php?...", "time": 1760000012.3, "saved": true, "outcome": "saved"}
+"""
+import os
+import json
+import time
+import threading
+from typing import Optional, Dict, Any
+
+from console import print_colored
+
+# --- Constants ---
+JOURNAL_VERSION = 1
+JOURNAL_MAX_AGE_SEC = 3 * 3600 # Entries older than this are not trusted by a resumed run
+
+
+class Journal:
+    """
+    Append-only log of finished items, resumed from the journal an interrupted run left if its
+    context matches. The file is rewritten on open with just the entries still used (a line cut
+    off by a kill is dropped). Thread-safe: record() is called from worker threads and the event loop.
+    """
+
+    def __init__(self, path: str, context: Dict[str, Any], max_age: float = JOURNAL_MAX_AGE_SEC,
+                 resume: bool = True) -> None:
+        self.path = path
+        self.context = context
+        self.max_age = max_age
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._file = None
+        if resume:
+            self._load()
+        self.resumed = len(self._entries) # Entries taken over from an earlier run
+        self._open()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            print_colored(f"Warning: Could not read journal '{self.path}': {e}", "yellow")
+            return
+        try:
+            header = json.loads(lines[0]) if lines else None
+        except ValueError:
+            header = None
+        if (not isinstance(header, dict) or header.get('journal') != JOURNAL_VERSION
+                or header.get('context') != self.context):
+            return # Another tool, other rules or settings: start over
+        oldest = time.time() - self.max_age
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue # Cut off mid-write
+            if isinstance(entry, dict) and 'key' in entry and entry.get('time', 0) >= oldest:
+                self._entries[entry['key']] = entry
+        self.started = header.get('started', self.started)
+
+    def _open(self) -> None:
+        temp_path = self.path + f".{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'journal': JOURNAL_VERSION, 'context': self.context, 'started': self.started}) + "\n")
+                for entry in self._entries.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(temp_path, self.path)
+            self._file = open(self.path, 'a', encoding='utf-8')
+        except OSError as e:
+            print_colored(f"Warning: Could not write journal '{self.path}': {e}. Progress is not recorded.", "yellow")
+            self._file = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """The entry of a finished item, or None if it still has to be done."""
+        with self._lock:
+            return self._entries.get(key)
+
+    def record(self, key: str, **fields: Any) -> None:
+        """Records that the item `key` finished, with its outcome fields (JSON-serializable)."""
+        entry = {'key': key, 'time': round(time.time(), 3), **fields}
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._entries[key] = entry
+            if self._file is not None:
+                try:
+                    self._file.write(line)
+                    self._file.flush()
+                except OSError as e:
+                    print_colored(f"Warning: Could not append to journal '{self.path}': {e}", "yellow")
+
+    def close(self) -> None:
+        """Closes the journal, keeping it for the next run to resume from."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def complete(self) -> None:
+        """Closes and removes the journal: the run finished, so the next one starts over."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print_colored(f"Warning: Could not remove journal '{self.path}': {e}", "yellow")
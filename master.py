@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+Merges the saved playlists of specialiptvs/ into one deduplicated master playlist. Every
+channel entry is put into an inverted index keyed by its tvg-id and its normalized name
+(lowercased, punctuation and quality tags such as FHD/HD/4K/HEVC removed), so the same
+channel from different panels lands in one slot. The master playlist lists each channel
+once, groups ordered by hotrun.sort_groups (the tiers of the filter rules), with its best URL; the channel index
+(best/master_index.json) keeps up to MASTER_MAX_URLS ranked URLs per channel, one per
+panel, for failover. Playlists ranked by toptv (best/probe_metrics.json) come first.
+
+    python master.py
+    python master.py --max-urls 3 --probed-only
+"""
+import os
+import re
+import sys
+import json
+import glob
+import time
+import argparse
+import unicodedata
+from typing import List, Optional, Dict, Tuple
+
+import hotrun
+import toptv
+import filters
+from hotrun import print_colored, Channel
+
+# --- Constants ---
+MASTER_FILE = "master.m3u" # Published next to mvp.m3u
+MASTER_INDEX_FILE = os.path.join(toptv.best_folder, "master_index.json") # Channel -> ranked URLs
+MASTER_MAX_URLS = 5 # URLs kept per channel (primary plus fallbacks), at most one per panel
+VOD_URL_PARTS = ('/movie/', '/series/') # Xtream VOD entries; the master only lists live channels
+QUALITY_RANKS = {'8k': 5, '4k': 4, 'uhd': 4, '2160p': 4, 'fhd': 3, 'fullhd': 3, '1080p': 3, '1080i': 3,
+                 'hd': 2, '720p': 2, 'hq': 2, 'sd': 1, '576p': 1, '480p': 1, 'lq': 0}
+UNKNOWN_QUALITY_RANK = 1 # Untagged names rank with SD among candidates of the same source
+CODEC_TOKENS = frozenset(('hevc', 'h265', 'h264', 'x265', 'x264', 'avc', 'raw', '50fps', '60fps'))
+IGNORED_TVG_IDS = frozenset(('', 'none', 'null', 'n/a', '0', '-'))
+
+# --- Precompiled Patterns ---
+NAME_TOKEN_RE = re.compile(r'[^\W_]+') # Runs of letters and digits (any script)
+FULL_HD_RE = re.compile(r'full[\s_-]*hd')
+GLUED_QUALITY_RE = re.compile(r'(\d+)(fhd|uhd|hd|sd)') # "1HD" after NFKC folds "1ᴴᴰ"
+TVG_ID_RE = re.compile(r'tvg-id="([^"]*)"')
+VOD_URL_RE = re.compile("|".join(re.escape(part) for part in VOD_URL_PARTS))
+
+
+# --- Channel Name Normalization ---
+def normalize_channel_name(name: str) -> Tuple[str, int]:
+    """
+    Returns (index key, quality rank) of a channel name. Quality and codec tags are dropped
+    from the key wherever they appear, so "beIN SPORTS 1 ᶠᴴᴰ" and "BeIN Sports 1 HD" share a key;
+    the best quality tag found is returned as its rank (UNKNOWN_QUALITY_RANK if none).
+    """
+    folded = FULL_HD_RE.sub('fhd', unicodedata.normalize('NFKC', name).lower())
+    tokens = []
+    quality = None
+    for token in NAME_TOKEN_RE.findall(folded):
+        glued = GLUED_QUALITY_RE.fullmatch(token)
+        if glued is not None:
+            token, tag = glued.groups()
+            quality = max(quality or 0, QUALITY_RANKS[tag])
+        rank = QUALITY_RANKS.get(token)
+        if rank is not None:
+            quality = max(quality or 0, rank)
+        elif token not in CODEC_TOKENS:
+            tokens.append(token)
+    key = " ".join(tokens) or " ".join(NAME_TOKEN_RE.findall(folded)) or folded.strip()
+    return key, UNKNOWN_QUALITY_RANK if quality is None else quality
+
+
+def get_panel_host(url: str) -> str:
+    """
+    Lowercased host[:port] of a stream URL, like hotrun.get_url_host but by splitting on '/'
+    (urlparse dominated the build with one call per candidate).
+    """
+    parts = url.split('/', 3)
+    return parts[2].lower() if len(parts) > 2 else url.lower()
+
+
+# --- Inverted Channel Index ---
+class MasterChannel:
+    """One merged channel: its candidate entries from every source, ranked when the index is built."""
+    __slots__ = ('candidates',)
+
+    def __init__(self) -> None:
+        # (group rank, source rank, -quality, sequence, url, duration, name, attributes_str, group_title, source)
+        self.candidates: List[Tuple] = []
+
+
+class ChannelIndex:
+    """
+    Inverted index tvg-id -> channel and normalized name -> channel. An entry joins the channel
+    of its tvg-id if one exists, else the channel of its name, and registers both keys; each
+    entry costs two dict lookups, so building stays linear in the number of entries.
+    Name normalization and group ranks are memoized (names repeat across panels).
+    """
+
+    def __init__(self, include_vod: bool = False) -> None:
+        self.include_vod = include_vod
+        self.channels: List[MasterChannel] = []
+        self.entries = 0
+        self._by_tvg_id: Dict[str, MasterChannel] = {}
+        self._by_name: Dict[str, MasterChannel] = {}
+        self._names: Dict[str, Tuple[str, int]] = {}
+        self._group_ranks: Dict[str, int] = {}
+
+    def add_playlist(self, filepath: str, source_rank: int) -> int:
+        """
+        Indexes every channel of a playlist written by hotrun.save_parsed_m3u (the URL always
+        follows its '#EXTINF' line, so one EXTINF_PAIR_RE scan reads it).
+        Returns:
+            The number of entries indexed, or -1 if the file cannot be read.
+        """
+        try:
+            with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
+                text = f.read()
+        except OSError as e:
+            print_colored(f"  Warning: Could not read '{filepath}': {e}", "yellow")
+            return -1
+
+        source = os.path.basename(filepath)
+        added = 0
+        for duration, attributes_str, name, url in hotrun.EXTINF_PAIR_RE.findall(text):
+            url = url.rstrip()
+            if not self.include_vod and VOD_URL_RE.search(url):
+                continue
+            attributes_str = attributes_str.strip()
+            name = name.strip()
+            normalized = self._names.get(name)
+            if normalized is None:
+                normalized = self._names[name] = normalize_channel_name(name)
+            name_key, quality = normalized
+            group_title = hotrun.extract_group_title(attributes_str)
+            group_rank = self._group_ranks.get(group_title)
+            if group_rank is None:
+                group_rank = self._group_ranks[group_title] = hotrun.get_group_rank(group_title)
+
+            tvg_match = TVG_ID_RE.search(attributes_str)
+            tvg_id = tvg_match.group(1).strip().lower() if tvg_match else ''
+            if tvg_id in IGNORED_TVG_IDS:
+                tvg_id = ''
+            channel = self._by_tvg_id.get(tvg_id) if tvg_id else None
+            if channel is None:
+                channel = self._by_name.get(name_key)
+            if channel is None:
+                channel = MasterChannel()
+                self.channels.append(channel)
+            if tvg_id:
+                self._by_tvg_id.setdefault(tvg_id, channel)
+            self._by_name.setdefault(name_key, channel)
+
+            channel.candidates.append((group_rank, source_rank, -quality, self.entries, url,
+                                       int(duration), name, attributes_str, group_title, source))
+            self.entries += 1
+            added += 1
+        return added
+
+    def build(self, max_urls: int = MASTER_MAX_URLS) -> List[Tuple[Channel, List[Tuple]]]:
+        """
+        Ranks each channel's candidates (sort_groups priority of their group, then source rank,
+        then quality, then input order) and keeps the first max_urls whose panels (host:port)
+        differ.
+        Returns:
+            [(primary entry as a Channel, kept candidates best first)] in index order.
+        """
+        merged = []
+        for channel in self.channels:
+            channel.candidates.sort()
+            kept = []
+            hosts = set()
+            for candidate in channel.candidates:
+                host = get_panel_host(candidate[4])
+                if host in hosts:
+                    continue
+                hosts.add(host)
+                kept.append(candidate)
+                if len(kept) >= max_urls:
+                    break
+            _, _, _, _, url, duration, name, attributes_str, group_title, _ = kept[0]
+            merged.append((Channel(duration, name, attributes_str, url, group_title), kept))
+        return merged
+
+
+# --- Sources ---
+def get_ranked_sources(input_folder: str, probed_only: bool = False) -> List[str]:
+    """
+    Playlists of input_folder in source rank order: those toptv ranked in best/probe_metrics.json
+    (fastest first), then the rest by name unless probed_only.
+    """
+    file_paths = sorted(glob.glob(os.path.join(input_folder, '*.m3u')))
+    ranks: Dict[str, int] = {}
+    try:
+        with open(os.path.join(toptv.best_folder, toptv.probe_metrics_file), 'r', encoding='utf-8') as f:
+            ranks = {item['file']: item['rank'] for item in json.load(f) if item.get('rank')}
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print_colored(f"Warning: Could not read probe ranks: {e}", "yellow")
+
+    ranked = sorted((path for path in file_paths if os.path.basename(path) in ranks),
+                    key=lambda path: ranks[os.path.basename(path)])
+    if probed_only:
+        return ranked
+    return ranked + [path for path in file_paths if os.path.basename(path) not in ranks]
+
+
+# --- Writing ---
+def write_master_playlist(merged: List[Tuple[Channel, List[Tuple]]], output_filepath: str) -> bool:
+    """
+    Writes one entry per merged channel, groups ordered by sort_groups and channels in index
+    order within a group. Returns True if the file was written (False if unchanged).
+    """
+    buckets = hotrun.bucket_channels_by_group([channel for channel, _ in merged])
+    chunks = [b'#EXTM3U\n']
+    for group_name in hotrun.sort_groups(list(buckets)):
+        group_lines = []
+        for channel in buckets[group_name]:
+            group_lines.append(hotrun.format_extinf_line(channel, group_name))
+            group_lines.append(channel.url)
+        group_lines.append('')
+        chunks.append("\n".join(group_lines).encode('utf-8', errors='ignore'))
+    return hotrun.write_if_changed(output_filepath, chunks)
+
+
+def write_channel_index(merged: List[Tuple[Channel, List[Tuple]]], index_filepath: str) -> bool:
+    """
+    Writes the channel index: per channel its name, group, tvg-id and ranked URLs
+    ({'url', 'file', 'group'}, primary first). Returns True if the file was written.
+    """
+    index = []
+    for channel, kept in merged:
+        tvg_match = TVG_ID_RE.search(channel.attributes_str)
+        index.append({
+            'name': channel.name, 'group': channel.group_title,
+            'tvg_id': tvg_match.group(1) if tvg_match else None,
+            'urls': [{'url': candidate[4], 'file': candidate[9], 'group': candidate[8]} for candidate in kept],
+        })
+    # One channel per line keeps the committed file's diffs readable
+    lines = ",\n".join(json.dumps(item, ensure_ascii=False) for item in index)
+    return hotrun.write_if_changed(index_filepath, [f"[\n{lines}\n]\n".encode('utf-8')])
+
+
+def build_master(input_folder: str = toptv.input_folder, output_filepath: str = MASTER_FILE,
+                 index_filepath: Optional[str] = MASTER_INDEX_FILE, max_urls: int = MASTER_MAX_URLS,
+                 probed_only: bool = False, include_vod: bool = False) -> Tuple[int, int, int]:
+    """
+    Indexes every source playlist and writes the master playlist (and the channel index).
+    Returns:
+        (source playlists read, entries indexed, merged channels)
+    """
+    sources = get_ranked_sources(input_folder, probed_only)
+    channel_index = ChannelIndex(include_vod)
+    read = 0
+    for source_rank, filepath in enumerate(sources):
+        if channel_index.add_playlist(filepath, source_rank) >= 0:
+            read += 1
+    merged = channel_index.build(max(1, max_urls))
+    if not merged:
+        print_colored(f"No channels found in '{input_folder}', master playlist not written.", "yellow")
+        return read, channel_index.entries, 0
+
+    try:
+        if write_master_playlist(merged, output_filepath):
+            print_colored(f"Saved: {output_filepath} ({len(merged)} channels)", "green")
+        else:
+            print_colored(f"Unchanged: {output_filepath} ({len(merged)} channels), not rewritten.", "green")
+        if index_filepath and write_channel_index(merged, index_filepath):
+            print_colored(f"Saved: {index_filepath}", "green")
+    except OSError as e:
+        print_colored(f"Error writing the master playlist: {e}", "red")
+    return read, channel_index.entries, len(merged)
+
+
+# --- Command Line Arguments ---
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parses command line options."""
+    parser = argparse.ArgumentParser(description="Merge the saved playlists into one deduplicated master playlist.")
+    parser.add_argument("--input", default=toptv.input_folder, help="Folder of source playlists.")
+    parser.add_argument("--output", default=MASTER_FILE, help="Master playlist to write.")
+    parser.add_argument("--index", default=MASTER_INDEX_FILE,
+                        help="Channel index (ranked failover URLs per channel) to write; '' to skip.")
+    parser.add_argument("--max-urls", type=int, default=MASTER_MAX_URLS,
+                        help="URLs kept per channel, primary included, at most one per panel.")
+    parser.add_argument("--probed-only", action="store_true",
+                        help="Only merge playlists toptv ranked as valid (best/probe_metrics.json).")
+    parser.add_argument("--include-vod", action="store_true", help="Also merge movie and series entries.")
+    parser.add_argument("--rules", default=filters.FILTER_RULES_FILE,
+                        help="JSON filter rule file whose priority tiers order groups and rank fallback URLs.")
+    return parser.parse_args(argv)
+
+
+# --- Main Function ---
+def main(argv: Optional[List[str]] = None) -> None:
+    """Builds master.m3u and its channel index from specialiptvs/."""
+    args = parse_args(argv)
+    start_time = time.time()
+    hotrun.load_filter_rules(args.rules)
+    read, entries, channels = build_master(args.input, args.output, args.index or None, args.max_urls,
+                                           args.probed_only, args.include_vod)
+    print_colored(f"\n--- Master Playlist Summary ---", "magenta")
+    print_colored(f"Playlists merged: {read}, entries indexed: {entries}, unique channels: {channels}", "cyan")
+    print_colored(f"Total time: {time.time() - start_time:.2f} seconds", "cyan")
+    print_colored(f"-------------------------------", "magenta")
+
+
+# --- Entry Point ---
+if __name__ == "__main__":
+    if sys.version_info < (3, 7):
+        print_colored("Error: This script requires Python 3.7 or higher.", "red")
+        sys.exit(1)
+    main()
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+"""
+Per-URL instrumentation shared by hotrun.py, toptv.py and pipeline.py.
+
+Each playlist download or stream probe gets a Trace (stage timings, bytes, one categorical
+outcome). The trace of the running URL lives in a context variable, so the functions deep in
+the download path record into it without being passed anything, and a trace is only merged
+into the shared histograms (one lock acquisition) when its URL is finished. At the end of a
+run write_reports() writes metrics/<name>.json (histograms, outcome counts and per-URL
+records, concurrency limits over time) and metrics/<name>.prom (Prometheus text format).
+"""
+import os
+import json
+import time
+import socket
+import threading
+import contextlib
+import contextvars
+from typing import List, Optional, Dict, Any, Tuple, Callable, Iterator
+
+import aiohttp
+import requests.adapters
+import urllib3.connection
+import urllib3.connectionpool
+import urllib3.exceptions
+import urllib3.util.connection
+
+# --- Constants ---
+METRICS_DIR = "metrics"
+METRIC_PREFIX = "m3u"
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTES_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 ** 2, 10 * 1024 ** 2, 100 * 1024 ** 2)
+
+
+# --- Histogram ---
+class Histogram:
+    """Cumulative-bucket histogram (Prometheus semantics: a value lands in every bucket >= it)."""
+    __slots__ = ('bounds', 'counts', 'count', 'total')
+
+    def __init__(self, bounds: Tuple[float, ...]) -> None:
+        self.bounds = bounds
+        self.counts = [0] * len(bounds) # Non-cumulative; cumulated on export
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """[(le, cumulative count)] including '+Inf'."""
+        buckets = []
+        running = 0
+        for bound, count in zip(self.bounds, self.counts):
+            running += count
+            buckets.append((str(bound) if isinstance(bound, int) else f"{bound:g}", running))
+        buckets.append(("+Inf", self.count))
+        return buckets
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'count': self.count, 'sum': round(self.total, 6), 'buckets': dict(self.cumulative())}
+
+
+# --- Per-URL Trace ---
+class Trace:
+    """Stage timings (seconds), bytes and outcome of one playlist download or stream probe."""
+    __slots__ = ('kind', 'url', 'stages', 'bytes', 'outcome', 'started', 'marks')
+
+    def __init__(self, kind: str, url: str) -> None:
+        self.kind = kind # 'playlist' or 'stream'
+        self.url = url
+        self.stages: Dict[str, float] = {}
+        self.bytes = 0
+        self.outcome: Optional[str] = None
+        self.started = time.perf_counter()
+        self.marks: Dict[str, Any] = {} # Start times of stages measured by callbacks
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'kind': self.kind, 'url': self.url, 'outcome': self.outcome, 'bytes': self.bytes,
+                'stages': {stage: round(seconds, 6) for stage, seconds in self.stages.items()}}
+
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar('metrics_trace', default=None)
+
+
+# --- Recorder ---
+class Recorder:
+    """Aggregates finished traces into per-(kind, stage) histograms and outcome counters. Thread-safe."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.stage_histograms: Dict[Tuple[str, str], Histogram] = {}
+        self.bytes_histograms: Dict[str, Histogram] = {}
+        self.outcomes: Dict[Tuple[str, str], int] = {}
+        self.traces: List[Trace] = []
+        self.limits: Dict[str, List[Tuple[float, int]]] = {} # Concurrency limit over time, per limiter
+        self.started = time.perf_counter()
+
+    def finish(self, trace: Trace) -> None:
+        """Records a finished trace (its 'total' stage is the time since it started, unless set)."""
+        if 'total' not in trace.stages:
+            trace.stages['total'] = time.perf_counter() - trace.started
+        trace.marks = {}
+        outcome = trace.outcome or 'unknown'
+        with self._lock:
+            for stage, seconds in trace.stages.items():
+                histogram = self.stage_histograms.get((trace.kind, stage))
+                if histogram is None:
+                    histogram = self.stage_histograms[(trace.kind, stage)] = Histogram(SECONDS_BUCKETS)
+                histogram.observe(seconds)
+            histogram = self.bytes_histograms.get(trace.kind)
+            if histogram is None:
+                histogram = self.bytes_histograms[trace.kind] = Histogram(BYTES_BUCKETS)
+            histogram.observe(trace.bytes)
+            self.outcomes[(trace.kind, outcome)] = self.outcomes.get((trace.kind, outcome), 0) + 1
+            self.traces.append(trace)
+
+    def record_limit(self, name: str, limit: int) -> None:
+        """Records that the concurrency limit `name` changed to `limit` (seconds since the recorder was created)."""
+        with self._lock:
+            self.limits.setdefault(name, []).append((round(time.perf_counter() - self.started, 3), limit))
+
+    def outcome_counts(self, kind: str) -> Dict[str, int]:
+        """{outcome: count} for one kind, most frequent first."""
+        with self._lock:
+            counts = {outcome: count for (k, outcome), count in self.outcomes.items() if k == kind}
+        return dict(sorted(counts.items(), key=lambda item: (-item[1], item[0])))
+
+    def report(self, name: str) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'run': name,
+                'generated_at': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                'stages': {f"{kind}.{stage}": histogram.to_dict()
+                           for (kind, stage), histogram in sorted(self.stage_histograms.items())},
+                'bytes': {kind: histogram.to_dict() for kind, histogram in sorted(self.bytes_histograms.items())},
+                'outcomes': {f"{kind}.{outcome}": count for (kind, outcome), count in sorted(self.outcomes.items())},
+                'concurrency': {name: {'final': changes[-1][1], 'peak': max(limit for _, limit in changes),
+                                       'changes': [list(change) for change in changes]}
+                                for name, changes in sorted(self.limits.items())},
+                'urls': [trace.to_dict() for trace in self.traces],
+            }
+
+    def prometheus(self, name: str) -> str:
+        """The aggregates in Prometheus text exposition format, labelled run=name."""
+        lines = []
+        with self._lock:
+            metric = f"{METRIC_PREFIX}_stage_seconds"
+            lines += [f"# HELP {metric} Time spent per URL in each stage.", f"# TYPE {metric} histogram"]
+            for (kind, stage), histogram in sorted(self.stage_histograms.items()):
+                lines += format_histogram(metric, f'run="{name}",kind="{kind}",stage="{stage}"', histogram)
+            metric = f"{METRIC_PREFIX}_transfer_bytes"
+            lines += [f"# HELP {metric} Bytes transferred per URL.", f"# TYPE {metric} histogram"]
+            for kind, histogram in sorted(self.bytes_histograms.items()):
+                lines += format_histogram(metric, f'run="{name}",kind="{kind}"', histogram)
+            metric = f"{METRIC_PREFIX}_outcomes_total"
+            lines += [f"# HELP {metric} URLs by outcome.", f"# TYPE {metric} counter"]
+            for (kind, outcome), count in sorted(self.outcomes.items()):
+                lines.append(f'{metric}{{run="{name}",kind="{kind}",outcome="{outcome}"}} {count}')
+            for metric, help_text, pick in ((f"{METRIC_PREFIX}_concurrency_limit", "Adaptive concurrency limit at the end of the run.",
+                                             lambda changes: changes[-1][1]),
+                                            (f"{METRIC_PREFIX}_concurrency_limit_peak", "Highest adaptive concurrency limit of the run.",
+                                             lambda changes: max(limit for _, limit in changes))):
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+                for limiter, changes in sorted(self.limits.items()):
+                    lines.append(f'{metric}{{run="{name}",limiter="{limiter}"}} {pick(changes)}')
+        return "\n".join(lines) + "\n"
+
+
+def format_histogram(metric: str, labels: str, histogram: Histogram) -> List[str]:
+    """Prometheus _bucket/_sum/_count lines of one histogram."""
+    lines = [f'{metric}_bucket{{{labels},le="{le}"}} {count}' for le, count in histogram.cumulative()]
+    lines.append(f"{metric}_sum{{{labels}}} {histogram.total:.6f}")
+    lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+    return lines
+
+
+recorder = Recorder() # Process-wide recorder used by the helpers below
+
+
+# --- Recording Helpers (no-ops outside a trace) ---
+@contextlib.contextmanager
+def trace_url(url: str, kind: str = 'playlist') -> Iterator[Trace]:
+    """Makes a new Trace the current one for the duration of the block, then records it."""
+    trace = Trace(kind, url)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        recorder.finish(trace)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Adds the time spent in the block to stage `name` of the current trace."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - start)
+
+
+def add_stage(name: str, seconds: float) -> None:
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+def add_bytes(count: int) -> None:
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.bytes += count
+
+
+def set_outcome(outcome: str, overwrite: bool = True) -> None:
+    """Sets the outcome of the current trace (with overwrite=False only if none is set yet)."""
+    trace = _current_trace.get()
+    if trace is not None and (overwrite or trace.outcome is None):
+        trace.outcome = outcome
+
+
+def http_outcome(status_code: Any) -> str:
+    """'http_403' etc., or 'connection_error' when there was no response."""
+    return f"http_{status_code}" if isinstance(status_code, int) else 'connection_error'
+
+
+def call_traced(func: Callable[..., Any], *args: Any) -> Tuple[Any, Dict[str, float], Optional[str]]:
+    """
+    Runs func(*args) under a throwaway trace and returns (result, stages, outcome), so work
+    done in a worker process can be merged into the parent's trace with merge_traced().
+    """
+    trace = Trace('worker', '')
+    token = _current_trace.set(trace)
+    try:
+        return func(*args), trace.stages, trace.outcome
+    finally:
+        _current_trace.reset(token)
+
+
+def merge_traced(stages: Dict[str, float], outcome: Optional[str]) -> None:
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    for name, seconds in stages.items():
+        trace.add(name, seconds)
+    if outcome is not None:
+        trace.outcome = outcome
+
+
+# --- aiohttp DNS/Connect Timing ---
+async def _on_dns_resolvehost_start(session, ctx, params) -> None:
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.marks['dns'] = time.perf_counter()
+
+
+async def _on_dns_resolvehost_end(session, ctx, params) -> None:
+    trace = _current_trace.get()
+    if trace is not None and 'dns' in trace.marks:
+        trace.add('dns', time.perf_counter() - trace.marks.pop('dns'))
+
+
+async def _on_connection_create_start(session, ctx, params) -> None:
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.marks['connect'] = (time.perf_counter(), trace.stages.get('dns', 0.0))
+
+
+async def _on_connection_create_end(session, ctx, params) -> None:
+    trace = _current_trace.get()
+    if trace is not None and 'connect' in trace.marks:
+        start, dns_before = trace.marks.pop('connect')
+        dns = trace.stages.get('dns', 0.0) - dns_before # Resolution happens inside connection setup
+        trace.add('connect', time.perf_counter() - start - dns)
+
+
+def aiohttp_trace_config() -> aiohttp.TraceConfig:
+    """TraceConfig recording 'dns' and 'connect' (TCP + TLS, without DNS) into the current trace."""
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_dns_resolvehost_start.append(_on_dns_resolvehost_start)
+    trace_config.on_dns_resolvehost_end.append(_on_dns_resolvehost_end)
+    trace_config.on_connection_create_start.append(_on_connection_create_start)
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    return trace_config
+
+
+# --- urllib3 DNS/Connect Timing ---
+class TimedConnectionMixin:
+    """
+    urllib3 connection that resolves its host itself and tries the addresses in order, so it can
+    record 'dns' and 'connect' (TCP + TLS, without DNS) into the current trace, the same split
+    aiohttp_trace_config() gives the async engine. Subclasses may override lookup_addresses().
+    """
+    _dns_seconds = 0.0
+
+    def connect(self) -> None:
+        start = time.perf_counter()
+        self._dns_seconds = 0.0
+        super().connect()
+        add_stage('connect', time.perf_counter() - start - self._dns_seconds)
+
+    def lookup_addresses(self) -> List[str]:
+        """Addresses of the host from the system resolver (raises socket.gaierror if it fails)."""
+        infos = socket.getaddrinfo(self._dns_host, self.port, urllib3.util.connection.allowed_gai_family(),
+                                   socket.SOCK_STREAM)
+        return list(dict.fromkeys(info[4][0] for info in infos))
+
+    def _resolve(self) -> Optional[List[str]]:
+        """lookup_addresses(), timed as 'dns' (None if it fails)."""
+        start = time.perf_counter()
+        try:
+            return self.lookup_addresses()
+        except (socket.gaierror, UnicodeError):
+            return None # urllib3 resolves again and raises its own NameResolutionError
+        finally:
+            self._dns_seconds = time.perf_counter() - start
+            add_stage('dns', self._dns_seconds)
+
+    def _new_conn(self) -> socket.socket:
+        addresses = self._resolve()
+        if not addresses:
+            return super()._new_conn()
+        host = self._dns_host
+        error = None
+        try:
+            for address in addresses:
+                self._dns_host = address # Only the TCP connect uses it; self.host stays the name
+                try:
+                    return super()._new_conn()
+                except (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError) as e:
+                    error = e
+        finally:
+            self._dns_host = host
+        raise error
+
+
+class TimedHTTPConnection(TimedConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    requests adapter whose connections record their dns/connect times (see TimedConnectionMixin).
+    Mount it on the sessions to measure; requests through a proxy do not go through it.
+    """
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+
+# --- Report Files ---
+def write_reports(name: str, folder: str = METRICS_DIR) -> Optional[Tuple[str, str]]:
+    """
+    Writes <folder>/<name>.json and <folder>/<name>.prom.
+    Returns:
+        (json path, prom path), or None if they could not be written.
+    """
+    json_path = os.path.join(folder, f"{name}.json")
+    prom_path = os.path.join(folder, f"{name}.prom")
+    try:
+        os.makedirs(folder, exist_ok=True)
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(recorder.report(name), f, indent=1)
+        with open(prom_path, 'w', encoding='utf-8') as f:
+            f.write(recorder.prometheus(name))
+    except OSError:
+        return None
+    return json_path, prom_path
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Download -> filter -> probe in one pass. Every playlist of m3ulinks.txt that hotrun saves to
+specialiptvs/ (it has a 'Bein' group, or matches the filter rules) goes straight into a bounded probe queue, and toptv's
+prober tests its sample streams while the remaining playlists are still downloading. The
+samples are drawn from the channels hotrun just parsed (no re-read from disk; playlists that
+were not parsed in memory, e.g. restored from the cache after a 304, are sampled through their
+index in .m3ucache), and best/ and mvp.m3u are republished as results arrive instead of after two separate workflow runs.
+
+    python pipeline.py
+    python pipeline.py --samples 5 --probe-queue 32 --proxies 127.0.0.1:8080
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import threading
+from typing import List, Optional, Dict, Tuple
+
+import hotrun
+import toptv
+import metrics
+import master
+import filters
+import dnscache
+from hotrun import print_colored
+
+# --- Constants ---
+INPUT_FILE = "m3ulinks.txt"
+OUTPUT_FOLDER = toptv.input_folder # hotrun's output is toptv's input
+PROBE_QUEUE_SIZE = 64 # Saved playlists waiting for a probe; a full queue holds back downloads
+PIPELINE_SAMPLES = 3 # Streams sampled per playlist
+PUBLISH_INTERVAL_SEC = 30 # Minimum seconds between incremental best/ updates
+
+
+# --- Incremental Publishing ---
+class BestPublisher:
+    """
+    Republishes best/ and mvp.m3u from the probe results so far, at most once every
+    `interval` seconds (the first passing playlist is published at once). Ranks whose
+    file is unchanged are not copied again.
+    """
+
+    def __init__(self, interval: float = PUBLISH_INTERVAL_SEC) -> None:
+        self.interval = interval
+        self.published: Dict[int, str] = {} # {rank: source file} currently in best/
+        self.last_publish: Optional[float] = None
+        self.first_publish: Optional[float] = None # Seconds after start, for the freshness summary
+        self.start = time.monotonic()
+
+    def publish(self, results: Dict[str, toptv.PlaylistProbe], force: bool = False,
+                prune: bool = False) -> List[str]:
+        """Ranks results and updates best/ if forced or the interval has passed. Returns the ranking."""
+        now = time.monotonic()
+        if not force and self.last_publish is not None and now - self.last_publish < self.interval:
+            return []
+        ranked = toptv.rank_probe_results(results)
+        if not ranked and not prune:
+            return ranked
+        self.last_publish = now
+        copied, _ = toptv.publish_best_files(ranked, self.published, prune)
+        if ranked and self.first_publish is None:
+            self.first_publish = now - self.start
+        if copied:
+            print_colored(f"Published {len(ranked)} ranked playlists to '{toptv.best_folder}' ({copied} updated).", "magenta")
+        return ranked
+
+
+# --- Pipeline ---
+async def run_pipeline(args: argparse.Namespace, m3u_urls: List[str], shutdown_event: threading.Event,
+                       cache: Optional[hotrun.PlaylistCache], publisher: BestPublisher,
+                       download_limit: hotrun.AIMDLimit,
+                       probe_limit: hotrun.AIMDLimit,
+                       dns_cache: Optional[dnscache.DNSCache] = None) -> Tuple[Tuple[int, int, int], Dict[str, toptv.PlaylistProbe]]:
+    """
+    Runs hotrun's async engine and feeds each saved playlist to toptv's PlaylistProber
+    through a queue of args.probe_queue playlists. The proxy check runs in a thread while
+    the first playlists download. Downloads and probes each follow their own adaptive limit.
+    With a dns_cache the playlist hosts are resolved before the first download, and each
+    playlist's stream hosts before its probes.
+    Returns:
+        ((processed_count, saved_count, error_count) of the downloads, {file_path: PlaylistProbe})
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, args.probe_queue))
+    proxy_future = loop.run_in_executor(None, toptv.create_proxy_pool, toptv.get_proxy_list(args.proxies),
+                                        args.proxy_check_url, args.proxy_scores)
+
+    async def on_saved(file_index: int, filepath: str, channels: Optional[List[hotrun.Channel]]) -> None:
+        await queue.put((filepath, channels))
+
+    if dns_cache is not None:
+        hosts = [dnscache.get_hostname(m3u_url) for m3u_url in m3u_urls]
+        dns_start = time.perf_counter()
+        looked_up = await dns_cache.resolve(hosts)
+        hotrun.log_dns_stage(dns_cache, hosts, looked_up, time.perf_counter() - dns_start)
+    downloads = asyncio.ensure_future(hotrun.run_async_engine(
+        m3u_urls, OUTPUT_FOLDER, args.workers, shutdown_event, args.per_host, cache, None, on_saved, download_limit,
+        dns_cache))
+
+    proxy_pool = await proxy_future
+    prober = probe_cache = sample_seed = None
+    if proxy_pool is None:
+        print_colored("No live proxies found. Downloading only; best/ is left as it is.", "red")
+    else:
+        proxy_pool.start_background_recheck()
+        if not args.no_probe_cache:
+            probe_cache = toptv.ProbeCache(args.probe_cache, args.success_ttl, args.failure_ttl,
+                                           args.reprobe_fraction, toptv.PROBE_MIN_BYTES / args.window)
+            sample_seed = int(time.time() // max(args.success_ttl, 1))
+        prober = toptv.PlaylistProber(proxy_pool, args.concurrency, args.window, args.timeout,
+                                      args.quorum, probe_cache, probe_limit, dns_cache)
+
+    async def consumer() -> None:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            if prober is None:
+                continue # Keep draining so downloads are not held back
+            filepath, channels = item
+            try:
+                if channels is None or args.samples <= 1:
+                    urls = toptv.get_probe_samples(filepath, args.samples, sample_seed)
+                else:
+                    urls = toptv.select_probe_samples(channels, args.samples, sample_seed)
+                if urls and (await prober.probe_file(filepath, urls)).ok:
+                    publisher.publish(prober.results)
+            except Exception as e:
+                print_colored(f"Error probing {os.path.basename(filepath)}: {type(e).__name__} - {e}", "red")
+
+    num_consumers = max(1, args.concurrency // max(1, args.samples))
+    consumers = [asyncio.ensure_future(consumer()) for _ in range(num_consumers)]
+    try:
+        counts = await downloads
+    finally:
+        if shutdown_event.is_set():
+            for task in consumers:
+                task.cancel() # Aborts the probes in flight; queued playlists are not probed
+        else:
+            for _ in consumers:
+                await queue.put(None)
+        await asyncio.gather(*consumers, return_exceptions=True)
+        if prober is not None:
+            await prober.close()
+        if probe_cache is not None:
+            probe_cache.close()
+        if proxy_pool is not None:
+            proxy_pool.close()
+    return counts, (prober.results if prober is not None else {})
+
+
+# --- Command Line Arguments ---
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parses command line options (hotrun's download options and toptv's probe options)."""
+    parser = argparse.ArgumentParser(description="Download, filter ('Bein') and probe M3U playlists in one pass.")
+    parser.add_argument("--workers", type=int, default=2000, help="Ceiling of the adaptive download concurrency.")
+    parser.add_argument("--start-workers", type=int, default=hotrun.AIMD_START,
+                        help="Download concurrency the adaptive limit starts from.")
+    parser.add_argument("--per-host", type=int, default=hotrun.PER_HOST_LIMIT,
+                        help="Max in-flight download requests per host.")
+    parser.add_argument("--cache-dir", default=hotrun.CACHE_DIR,
+                        help="Directory of the conditional-GET / content-hash cache.")
+    parser.add_argument("--no-cache", action="store_true", help="Always download, parse and rewrite every playlist.")
+    parser.add_argument("--no-dns-cache", action="store_true",
+                        help="Resolve hosts per request through the system resolver instead of up front.")
+    parser.add_argument("--no-dedupe", action="store_true",
+                        help="Keep every saved playlist instead of one per near-duplicate cluster.")
+    parser.add_argument("--similarity", type=float, default=hotrun.DEDUPE_SIMILARITY,
+                        help="Estimated channel-set similarity at which playlists count as duplicates.")
+    parser.add_argument("--probe-queue", type=int, default=PROBE_QUEUE_SIZE,
+                        help="Saved playlists waiting for a probe before downloads are held back.")
+    parser.add_argument("--publish-interval", type=float, default=PUBLISH_INTERVAL_SEC,
+                        help="Minimum seconds between incremental best/ updates.")
+    parser.add_argument("--concurrency", type=int, default=toptv.PROBE_CONCURRENCY,
+                        help="Ceiling of the adaptive probe concurrency.")
+    parser.add_argument("--start-concurrency", type=int, default=hotrun.AIMD_START,
+                        help="Probe concurrency the adaptive limit starts from.")
+    parser.add_argument("--window", type=float, default=toptv.PROBE_WINDOW_SEC,
+                        help="Seconds of stream measured after the first byte.")
+    parser.add_argument("--timeout", type=float, default=toptv.PROBE_TIMEOUT, help="Seconds per probe.")
+    parser.add_argument("--samples", type=int, default=PIPELINE_SAMPLES,
+                        help="Streams sampled per playlist, weighted towards Iran and sports groups.")
+    parser.add_argument("--quorum", type=int, default=None,
+                        help="Passing samples needed to accept a playlist (default: a majority of --samples).")
+    parser.add_argument("--proxies", help="Comma-separated host:port list (or a file with one per line) "
+                                          "to use instead of toptv.PROXY_LIST.")
+    parser.add_argument("--proxy-check-url", default=toptv.PROXY_CHECK_URL, help="URL fetched to health-check a proxy.")
+    parser.add_argument("--proxy-scores", default=toptv.PROXY_SCORES_FILE,
+                        help="File the proxy scores are loaded from and saved to between runs.")
+    parser.add_argument("--probe-cache", default=toptv.PROBE_CACHE_FILE,
+                        help="SQLite file of probe results reused between runs.")
+    parser.add_argument("--no-probe-cache", action="store_true", help="Probe every sampled stream.")
+    parser.add_argument("--success-ttl", type=float, default=toptv.PROBE_SUCCESS_TTL_SEC,
+                        help="Seconds a passing probe result is reused.")
+    parser.add_argument("--failure-ttl", type=float, default=toptv.PROBE_FAILURE_TTL_SEC,
+                        help="Seconds a failing probe result is reused.")
+    parser.add_argument("--reprobe-fraction", type=float, default=toptv.PROBE_REPROBE_FRACTION,
+                        help="Share of fresh cached results probed again anyway (0-1).")
+    parser.add_argument("--rules", default=filters.FILTER_RULES_FILE,
+                        help="JSON filter rule file (require/include/exclude patterns, group priority tiers).")
+    parser.add_argument("--no-master", action="store_true",
+                        help="Do not rebuild master.m3u (one entry per channel with ranked failover URLs) at the end.")
+    parser.add_argument("--metrics-dir", default=metrics.METRICS_DIR,
+                        help="Directory the per-stage metrics (pipeline.json, pipeline.prom) are written to.")
+    parser.add_argument("--time-budget", type=float, default=None,
+                        help="Seconds after which the run cancels itself (like Ctrl+C): downloads and probes "
+                             "in flight are aborted and best/ keeps what was published so far.")
+    return parser.parse_args(argv)
+
+
+# --- Main Function ---
+def main(argv: Optional[List[str]] = None) -> None:
+    """Downloads, filters and probes the playlists of m3ulinks.txt, publishing best/ and mvp.m3u as it goes."""
+    args = parse_args(argv)
+    start_time = time.time()
+    filter_rules = hotrun.load_filter_rules(args.rules)
+
+    m3u_urls = hotrun.get_m3u_urls_from_file(INPUT_FILE)
+    if not m3u_urls:
+        print_colored(f"No valid URLs found in '{INPUT_FILE}'. Exiting.", "red")
+        sys.exit(1)
+    hotrun.prepare_output_folder(OUTPUT_FOLDER, m3u_urls)
+    os.makedirs(toptv.best_folder, exist_ok=True) # Kept until replaced, so mvp.m3u never goes missing
+
+    cache = None if args.no_cache else hotrun.PlaylistCache(args.cache_dir, filter_rules.digest)
+    if cache is not None and not args.no_dedupe:
+        cache.known_duplicates = hotrun.read_cluster_fallbacks(OUTPUT_FOLDER)
+    publisher = BestPublisher(args.publish_interval)
+    download_limit = hotrun.AIMDLimit("download", args.workers, args.start_workers)
+    probe_limit = hotrun.AIMDLimit("probe", args.concurrency, args.start_concurrency)
+    dns_cache = None if args.no_dns_cache else dnscache.DNSCache(os.path.join(args.cache_dir, "dns.json"))
+
+    shutdown = hotrun.ShutdownControl(args.time_budget).install()
+    shutdown.at_exit(lambda: metrics.write_reports("pipeline", args.metrics_dir))
+    shutdown_event = shutdown.event
+
+    print_colored(f"--- M3U Pipeline: {len(m3u_urls)} playlists, {args.samples} samples each, "
+                  f"probe queue {args.probe_queue} ---", "magenta")
+    (processed_count, saved_count, error_count), probe_results = asyncio.run(
+        run_pipeline(args, m3u_urls, shutdown_event, cache, publisher, download_limit, probe_limit, dns_cache))
+
+    if not args.no_dedupe and not shutdown_event.is_set():
+        cluster_count, removed_duplicates = hotrun.dedupe_saved_playlists(OUTPUT_FOLDER, m3u_urls, args.similarity, cache)
+        print_colored(f"Kept {cluster_count} playlists, removed {removed_duplicates} near-duplicates.", "cyan")
+        probe_results = {path: probe for path, probe in probe_results.items() if os.path.exists(path)}
+    if cache is not None:
+        cache.evict()
+        cache.save()
+    hotrun.prune_playlist_indexes()
+    if dns_cache is not None:
+        dns_cache.save()
+
+    valid_files = []
+    if probe_results:
+        valid_files = publisher.publish(probe_results, force=True, prune=not shutdown.cancelled)
+        toptv.save_probe_metrics(probe_results, valid_files)
+    if not args.no_master and not shutdown_event.is_set():
+        master.build_master(OUTPUT_FOLDER)
+
+    print_colored(f"\n--- Pipeline Summary ---", "magenta")
+    print_colored(f"Playlists downloaded: {processed_count}, saved (contained {filter_rules.description}): {saved_count}", "cyan")
+    print_colored(f"Playlists probed: {len(probe_results)}, valid: {len(valid_files)}", "green")
+    print_colored(f"Concurrency (peak/final): downloads {download_limit.peak}/{download_limit.current()}, "
+                  f"probes {probe_limit.peak}/{probe_limit.current()}", "cyan")
+    for kind in ('playlist', 'stream'):
+        outcome_counts = metrics.recorder.outcome_counts(kind)
+        if outcome_counts:
+            print_colored(f"{kind.capitalize()} outcomes: " + ", ".join(f"{outcome} {count}" for outcome, count in outcome_counts.items()), "yellow")
+    if metrics.write_reports("pipeline", args.metrics_dir) is not None:
+        print_colored(f"Metrics written to '{args.metrics_dir}'.", "cyan")
+    if publisher.first_publish is not None:
+        print_colored(f"First best/ update after {publisher.first_publish:.1f} seconds", "cyan")
+    print_colored(f"Total time: {time.time() - start_time:.2f} seconds", "cyan")
+    print_colored(f"------------------------", "magenta")
+    shutdown.finish()
+
+
+# --- Entry Point ---
+if __name__ == "__main__":
+    if sys.version_info < (3, 7):
+        print_colored("Error: This script requires Python 3.7 or higher.", "red")
+        sys.exit(1)
+    main()
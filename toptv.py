@@ -5,12 +5,32 @@ import shutil
 import time
 import psutil # اگرچه دیگر برای سرعت استفاده نمی‌شود، ممکن است برای کارهای دیگر بماند
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import sys
 import traceback
-import signal
 from urllib.parse import urlparse, urlunparse
 import random # برای انتخاب تصادفی پراکسی
+import threading # Proxy pool lock and background re-checks
+import itertools # First lines of a playlist
+import statistics # Median throughput of sampled streams
+import sqlite3 # Persistent probe-result cache
+import re # Stream IDs of panel URLs
+from urllib.parse import parse_qs, urljoin # Panel credentials, HLS playlist URIs
+import json # Probe metrics report
+import hashlib # Playlist digests in the progress journal
+import argparse # Command line options (probe engine, window, concurrency)
+import asyncio # Event loop for the async stream prober
+from typing import List, Optional, Dict, Any, Tuple, Callable
+import aiohttp # Async HTTP client for the async stream prober
+try:
+    from aiohttp_socks import ProxyConnector # SOCKS proxies for the async prober (in requirements.txt)
+except ImportError:
+    ProxyConnector = None
+import hotrun # Playlist tokenizer and group priorities shared with the downloader
+import metrics # Per-probe stage timings and outcomes
+import dnscache # Up-front resolution of stream hosts; dead names are not probed
+import filters # Filter rule file (its priority tiers weight the stream samples)
+import journal # Progress journal of interrupted runs
 
 # --- نیازمندی پراکسی SOCKS ---
 # pip install requests[socks]
@@ -20,6 +40,50 @@ import random # برای انتخاب تصادفی پراکسی
 input_folder = 'specialiptvs'
 # مسیر پوشه‌ای که فایل‌های معتبر در آن قرار می‌گیرند
 best_folder = 'best'
+# Per-stream probe metrics, written next to the ranked files
+probe_metrics_file = 'probe_metrics.json'
+
+# --- Probe Settings ---
+PROBE_ENGINES = ("async", "thread")
+PROBE_TIMEOUT = 10 # Seconds, whole probe (connect + window)
+PROBE_WINDOW_SEC = 1.0 # Seconds of body to measure after the first byte
+PROBE_MIN_BYTES = 10 * 1024 # A stream must deliver at least this much within the window
+PROBE_CHUNK_SIZE = 16384
+PROBE_CONCURRENCY = 300 # Ceiling of the adaptive probe concurrency (see hotrun.AIMDLimit)
+PROBE_PER_PROXY = 8 # Pooled connections per proxy
+SOCKS_PORTS = (':1080', ':1088', ':9050')
+HLS_CONTENT_TYPES = ('application/vnd.apple.mpegurl', 'application/x-mpegurl', 'audio/mpegurl', 'audio/x-mpegurl')
+HLS_SEGMENTS = 2 # Segments fetched per HLS probe
+HLS_MAX_PLAYLIST_BYTES = 512 * 1024
+HLS_MAX_SEGMENT_BYTES = 8 * 1024 * 1024 # Stop reading oversized segments here
+HLS_MAX_PLAYLIST_DEPTH = 3 # Master -> media playlist hops followed
+
+# --- Proxy Pool Settings ---
+PROXY_SCORES_FILE = os.path.join('.m3ucache', 'proxy_scores.json') # Cached between workflow runs
+PROXY_CHECK_URL = 'http://httpbin.org/ip'
+PROXY_DECAY = 0.3 # Weight of the newest observation in the success/latency averages
+PROXY_SCORE_HALF_LIFE_SEC = 2 * 3600 # Saved scores drift back to neutral with this half-life
+PROXY_FAILURE_THRESHOLD = 3 # Consecutive failures that open a proxy's circuit
+PROXY_COOLDOWN_SEC = 60 # How long an open circuit keeps a proxy out of rotation
+PROXY_RECHECK_INTERVAL_SEC = 15 # Background re-check period for proxies with an open circuit
+PROXY_ATTEMPTS = 3 # Proxies tried per stream when the proxy (not the stream) fails
+PROXY_FAILURES = ('proxy_timeout', 'proxy_error', 'connect_error') # Probe failures blamed on the proxy (before it connected, or refused by it)
+
+# --- Multi-Sample Probing ---
+PROBE_SAMPLES = 1 # Streams sampled per playlist (1: the URL on line 15 only)
+PROBE_SAMPLE_WEIGHTS = (4.0, 2.0, 1.0) # Sampling weight by hotrun.get_group_priority (Iran, sports, other; later tiers count as other)
+PROBE_SAMPLE_READS = 8 # Records read per requested sample at most (skipping non-HTTP and repeated URLs)
+
+# --- Probe Result Cache ---
+PROBE_CACHE_FILE = os.path.join('.m3ucache', 'probes.sqlite') # Cached between workflow runs
+PROBE_SUCCESS_TTL_SEC = 2 * 3600 # A passing stream is trusted this long
+PROBE_FAILURE_TTL_SEC = 20 * 60 # Failures are often transient, re-probe them sooner
+PROBE_REPROBE_FRACTION = 0.1 # Share of fresh cache entries probed again anyway
+PROBE_ACCOUNT_STATUSES = (401, 403) # Failures that condemn the whole panel account, not one channel
+XTREAM_STREAM_ID_RE = re.compile(r'^\d+(\.\w+)?$') # Last segment of a bare /USER/PASS/ID panel URL
+
+# --- Progress Journal ---
+JOURNAL_FILE = os.path.join('.m3ucache', 'toptv.journal') # Left behind by an interrupted run, resumed by the next
 
 # --- لیست اولیه پراکسی های ایرانی ---
 PROXY_LIST = [
@@ -58,12 +122,15 @@ def clean_best_folder():
         print_colored(f"خطا در ایجاد {best_folder}: {e}", "red")
         sys.exit(1)
 
+# --- Proxy Protocol Helper ---
+def get_proxy_protocol(proxy_str: str) -> str:
+    """'socks5h' for the usual SOCKS ports, 'http' otherwise."""
+    return 'socks5h' if any(port in proxy_str for port in SOCKS_PORTS) else 'http'
+
 # --- تابع پیش-بررسی پراکسی (بدون تغییر) ---
 def check_proxy(proxy_str, check_url='http://httpbin.org/ip', timeout=8):
     """Tries to connect to check_url via the proxy. Returns proxy_str if successful, None otherwise."""
-    protocol = 'http'
-    if ':1080' in proxy_str or ':1088' in proxy_str or ':9050' in proxy_str:
-        protocol = 'socks5h'
+    protocol = get_proxy_protocol(proxy_str)
     proxies = {'http': f'{protocol}://{proxy_str}','https': f'{protocol}://{proxy_str}'}
     try:
         response = requests.get(check_url, proxies=proxies, timeout=timeout, headers={'User-Agent': 'ProxyChecker/1.0'})
@@ -84,22 +151,207 @@ def check_proxies_concurrently(proxy_list=PROXY_LIST, check_url='http://httpbin.
     print_colored(f"Found {len(live_proxies)} live proxies out of {len(proxy_list)}.", "green" if live_proxies else "red")
     return live_proxies
 
+# --- Scored Proxy Pool ---
+class ProxyStats:
+    """Health of one proxy: decayed success rate and latency, consecutive failures, circuit state."""
+    __slots__ = ('proxy', 'success', 'latency', 'failures', 'open_until', 'probes', 'updated', 'in_flight')
+
+    def __init__(self, proxy: str) -> None:
+        self.proxy = proxy
+        self.success = 0.5 # Neutral prior
+        self.latency: Optional[float] = None # Seconds to first byte
+        self.failures = 0
+        self.open_until = 0.0 # Epoch seconds; the circuit is open until then
+        self.probes = 0
+        self.updated = time.time()
+        self.in_flight = 0
+
+    def score(self) -> float:
+        latency = self.latency if self.latency is not None else 1.0
+        return self.success / (1.0 + latency) / (1 + self.in_flight)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__ if name not in ('proxy', 'in_flight')}
+
+
+class ProxyPool:
+    """
+    Routes each probe to the best available proxy and learns from the outcome.
+    Success rate and latency are exponentially decayed averages (PROXY_DECAY). After
+    PROXY_FAILURE_THRESHOLD consecutive failures a proxy's circuit opens for
+    PROXY_COOLDOWN_SEC; after that one trial probe is let through (half-open), and a
+    background thread re-checks open proxies against PROXY_CHECK_URL so a recovered
+    proxy comes back without costing a stream. Scores are saved to PROXY_SCORES_FILE so
+    the next run starts warm. Thread-safe; used by both probe engines.
+    """
+
+    def __init__(self, proxies: List[str], scores_path: Optional[str] = PROXY_SCORES_FILE,
+                 check_url: str = PROXY_CHECK_URL) -> None:
+        self.scores_path = scores_path
+        self.check_url = check_url
+        self._lock = threading.Lock()
+        self._stats: Dict[str, ProxyStats] = {proxy: ProxyStats(proxy) for proxy in proxies}
+        self._stop = threading.Event()
+        self._recheck_thread: Optional[threading.Thread] = None
+        self._load()
+
+    def _load(self) -> None:
+        if not self.scores_path:
+            return
+        try:
+            with open(self.scores_path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print_colored(f"Warning: Could not read proxy scores '{self.scores_path}': {e}", "yellow")
+            return
+        now = time.time()
+        for proxy, data in saved.items():
+            stats = self._stats.get(proxy)
+            if stats is None or not isinstance(data, dict):
+                continue
+            # Old observations count for less: blend back towards the neutral prior
+            weight = 0.5 ** (max(0.0, now - data.get('updated', now)) / PROXY_SCORE_HALF_LIFE_SEC)
+            stats.success = 0.5 + (data.get('success', 0.5) - 0.5) * weight
+            stats.latency = data.get('latency')
+            stats.failures = data.get('failures', 0)
+            stats.open_until = data.get('open_until', 0.0)
+            stats.probes = data.get('probes', 0)
+            stats.updated = data.get('updated', now)
+
+    def save(self) -> None:
+        """Writes the scores atomically."""
+        if not self.scores_path:
+            return
+        temp_path = self.scores_path + f".{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.scores_path) or ".", exist_ok=True)
+            with self._lock:
+                data = {proxy: stats.to_dict() for proxy, stats in self._stats.items()}
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=1)
+            os.replace(temp_path, self.scores_path)
+        except OSError as e:
+            print_colored(f"Warning: Could not save proxy scores '{self.scores_path}': {e}", "yellow")
+
+    @property
+    def proxies(self) -> List[str]:
+        return list(self._stats)
+
+    def available(self) -> List[str]:
+        """Proxies whose circuit is closed (or half-open), best first."""
+        now = time.time()
+        with self._lock:
+            ready = [stats for stats in self._stats.values() if stats.open_until <= now]
+            ready.sort(key=lambda stats: -stats.score())
+            return [stats.proxy for stats in ready]
+
+    def acquire(self, allowed: Optional[Any] = None) -> Optional[str]:
+        """
+        Picks the best proxy with a closed circuit (in-flight probes lower a proxy's score, which
+        spreads load across equally good proxies). If every circuit is open, the proxy that
+        reopens first is used rather than failing the probe. allowed optionally filters proxies.
+        Call release() with the outcome.
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [stats for stats in self._stats.values() if allowed is None or allowed(stats.proxy)]
+            if not candidates:
+                return None
+            ready = [stats for stats in candidates if stats.open_until <= now]
+            if ready:
+                best = max(ready, key=lambda stats: (stats.score(), random.random()))
+            else:
+                best = min(candidates, key=lambda stats: stats.open_until)
+            best.in_flight += 1
+            return best.proxy
+
+    def abandon(self, proxy: str) -> None:
+        """Releases proxy without recording an outcome (the probe was cancelled)."""
+        with self._lock:
+            stats = self._stats.get(proxy)
+            if stats is not None:
+                stats.in_flight = max(0, stats.in_flight - 1)
+
+    def release(self, proxy: str, ok: bool, latency: Optional[float] = None) -> None:
+        """Records one outcome for proxy: ok=False only for failures that are the proxy's fault."""
+        with self._lock:
+            stats = self._stats.get(proxy)
+            if stats is None:
+                return
+            stats.in_flight = max(0, stats.in_flight - 1)
+            self._record(stats, ok, latency)
+
+    def _record(self, stats: ProxyStats, ok: bool, latency: Optional[float], open_on_failure: bool = False) -> None:
+        stats.probes += 1
+        stats.updated = time.time()
+        stats.success = (1 - PROXY_DECAY) * stats.success + PROXY_DECAY * (1.0 if ok else 0.0)
+        if ok:
+            stats.failures = 0
+            stats.open_until = 0.0
+            if latency is not None:
+                stats.latency = latency if stats.latency is None else (1 - PROXY_DECAY) * stats.latency + PROXY_DECAY * latency
+        else:
+            stats.failures += 1
+            if stats.failures >= PROXY_FAILURE_THRESHOLD or open_on_failure:
+                if stats.open_until <= stats.updated:
+                    print_colored(f"Proxy {stats.proxy}: circuit open ({stats.failures} consecutive failures).", "yellow")
+                stats.open_until = stats.updated + PROXY_COOLDOWN_SEC
+
+    def record_check(self, proxy: str, ok: bool) -> None:
+        """Records the result of a health check; a failed check opens the circuit straight away."""
+        with self._lock:
+            stats = self._stats.get(proxy)
+            if stats is not None:
+                self._record(stats, ok, None, open_on_failure=True)
+
+    def recheck_open(self, timeout: float = 8) -> None:
+        """Health-checks every proxy whose circuit is currently open."""
+        now = time.time()
+        with self._lock:
+            open_proxies = [stats.proxy for stats in self._stats.values() if stats.open_until > now]
+        for proxy in open_proxies:
+            if self._stop.is_set():
+                return
+            if check_proxy(proxy, self.check_url, timeout) is not None:
+                print_colored(f"Proxy {proxy}: healthy again, circuit closed.", "green")
+                self.record_check(proxy, True)
+
+    def start_background_recheck(self, interval: float = PROXY_RECHECK_INTERVAL_SEC) -> None:
+        """Starts a daemon thread that runs recheck_open every interval seconds until close()."""
+        def loop() -> None:
+            while not self._stop.wait(interval):
+                self.recheck_open()
+        self._recheck_thread = threading.Thread(target=loop, name="proxy-recheck", daemon=True)
+        self._recheck_thread.start()
+
+    def close(self) -> None:
+        """Stops the background re-checks and saves the scores."""
+        self._stop.set()
+        self.save()
+
 # --- تابع تست استریم با معیار جدید (1 ثانیه و 10 کیلوبایت) ---
-def download_stream(url, live_proxies=None, overall_timeout=10): # Default overall timeout 10s
+def download_stream(url, live_proxies=None, overall_timeout=10, proxy_pool=None): # Default overall timeout 10s
     """
-    Tests a stream URL using a randomly chosen live proxy.
+    Tests a stream URL using a randomly chosen live proxy, or the best proxy of proxy_pool
+    (which is then told how the proxy did).
     Success requires downloading at least 10KB within the first second(s).
     """
     # --- تعریف معیارهای جدید ---
     min_duration_sec = 1.0
     min_bytes_downloaded = 10 * 1024 # 10 KB
 
-    if not live_proxies: return False
-    selected_proxy_str = random.choice(live_proxies)
+    if proxy_pool is not None:
+        selected_proxy_str = proxy_pool.acquire()
+        if selected_proxy_str is None: return False
+    elif not live_proxies: return False
+    else:
+        selected_proxy_str = random.choice(live_proxies)
+    proxy_ok = True # False only when the proxy itself failed
+    first_byte_latency = None
 
-    protocol = 'http'
-    if ':1080' in selected_proxy_str or ':1088' in selected_proxy_str or ':9050' in selected_proxy_str:
-        protocol = 'socks5h'
+    protocol = get_proxy_protocol(selected_proxy_str)
     proxies = {'http': f'{protocol}://{selected_proxy_str}','https': f'{protocol}://{selected_proxy_str}'}
 
     start_time = time.time()
@@ -121,6 +373,8 @@ def download_stream(url, live_proxies=None, overall_timeout=10): # Default overa
             if chunk:
                 total_downloaded += len(chunk)
                 elapsed_time = time.time() - start_time
+                if first_byte_latency is None:
+                    first_byte_latency = elapsed_time
 
                 # --- بررسی شرط موفقیت ---
                 if elapsed_time >= min_duration_sec and total_downloaded >= min_bytes_downloaded:
@@ -136,19 +390,41 @@ def download_stream(url, live_proxies=None, overall_timeout=10): # Default overa
         response.close() # بستن اتصال
 
     # --- مدیریت خطاها ---
-    except requests.exceptions.Timeout:
+    except requests.exceptions.ConnectTimeout: # No connection to the proxy
+        proxy_ok = False
+        metrics.set_outcome('proxy_timeout')
+        print_colored(f" Live Proxy {selected_proxy_str} timed out ({overall_timeout}s) for {original_host}. Invalid.", "red")
+    except requests.exceptions.Timeout: # Connected through the proxy, the stream stayed silent
+        metrics.set_outcome('timeout')
         print_colored(f" Timeout ({overall_timeout}s) testing {original_host} via {selected_proxy_str}. Invalid.", "red")
     except requests.exceptions.SSLError as e:
+         metrics.set_outcome('ssl_error')
          print_colored(f" SSL Error testing {original_host} via {selected_proxy_str}. Invalid.", "red")
          # Consider adding verify=False here ONLY IF necessary AND you accept the risk
          # print_colored(" Try using verify=False in requests.get if source is trusted.", "yellow")
-    except (requests.exceptions.ProxyError, requests.exceptions.ConnectionError) as e:
-        print_colored(f" Live Proxy {selected_proxy_str} failed for {original_host}: {type(e).__name__}. Invalid.", "red")
+    except requests.exceptions.ConnectionError as e:
+        if connection_successful and not isinstance(e, requests.exceptions.ProxyError):
+            # The stream dropped (or stalled) after the proxy had connected
+            metrics.set_outcome('disconnected')
+            print_colored(f" Stream {original_host} dropped via {selected_proxy_str}: {type(e).__name__}. Invalid.", "red")
+        else:
+            proxy_ok = False
+            metrics.set_outcome('proxy_error')
+            print_colored(f" Live Proxy {selected_proxy_str} failed for {original_host}: {type(e).__name__}. Invalid.", "red")
     except requests.exceptions.RequestException as e:
         status = getattr(e.response, 'status_code', 'N/A')
+        proxy_ok = status != 407 # Proxy authentication required: the proxy, not the stream
+        metrics.set_outcome(metrics.http_outcome(status))
         print_colored(f" Request Error (Status: {status}) testing {original_host} via {selected_proxy_str}. Invalid.", "red")
     except Exception as e:
+        metrics.set_outcome('error')
         print_colored(f" Unexpected Error testing {original_host} via {selected_proxy_str}: {type(e).__name__}", "red")
+    if first_byte_latency is not None:
+        metrics.add_stage('ttfb', first_byte_latency)
+    metrics.add_bytes(total_downloaded)
+
+    if proxy_pool is not None:
+        proxy_pool.release(selected_proxy_str, proxy_ok, first_byte_latency)
 
     # --- پیام نهایی ---
     if valid:
@@ -156,78 +432,964 @@ def download_stream(url, live_proxies=None, overall_timeout=10): # Default overa
     elif connection_successful: # وصل شد اما شرط را برآورده نکرد
         print_colored(f"Stream Failed Check (>{min_bytes_downloaded/1024:.0f}KB in >{min_duration_sec:.0f}s not met) via {selected_proxy_str}.", "red")
     # else: اتصال برقرار نشد، خطا قبلاً چاپ شده
+    metrics.set_outcome('ok' if valid else 'too_slow', overwrite=False)
 
     return valid
 
 
-# --- تابع پردازش فایل M3U (اصلاح شده برای پاس دادن پراکسی‌های زنده) ---
-def process_m3u_file(file_path, live_proxies):
+# --- خواندن آدرس استریم نمونه از فایل M3U ---
+def get_probe_url(file_path: str) -> Optional[str]:
+    """Returns the stream URL on line index 14 of an M3U file, or None if it has none (reads only the first 15 lines)."""
+    required_line_index = 14
+
     lines = []
     try:
         with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
-            lines = file.readlines()
+            lines = list(itertools.islice(file, required_line_index + 1))
     except Exception: return None # Ignore read errors
 
-    required_line_index = 14
-
     if len(lines) > required_line_index:
         stream_url_line = lines[required_line_index].strip()
         if stream_url_line.startswith(('http://', 'https://')) and '.' in stream_url_line:
-            # Pass live_proxies list to the new download_stream
-            if download_stream(stream_url_line, live_proxies=live_proxies):
-                return file_path
+            return stream_url_line
     return None
 
 
-# --- تابع اصلی (تنظیمات ورکر مثل قبل) ---
-def main():
-    clean_best_folder()
+# --- Weighted Stream Sampling ---
+def get_probe_samples(file_path: str, samples: int = PROBE_SAMPLES,
+                      seed: Optional[int] = None) -> List[str]:
+    """
+    Picks up to `samples` distinct stream URLs from an M3U file, weighted towards the
+    priority groups of hotrun.sort_groups (Iran/Persian, then sports) by PROBE_SAMPLE_WEIGHTS.
+    With samples=1 this is the URL on line 15, as before. Otherwise only the drawn records are
+    read, through hotrun.PlaylistReader and the playlist's index in hotrun.INDEX_DIR (a file
+    without one is scanned once and its index saved for the next run); see draw_probe_samples
+    for the draw.
+    """
+    if samples <= 1:
+        url = get_probe_url(file_path)
+        return [url] if url else []
+    try:
+        reader = hotrun.PlaylistReader(file_path)
+    except OSError: return []
+    with reader:
+        reader.save_index() # Scanned: the next run (the workflow caches .m3ucache) opens it directly
+        groups = list(reader.groups())
 
-    if not os.path.isdir(input_folder):
-         print_colored(f"Error: Input folder '{input_folder}' not found.", "red")
-         sys.exit(1)
+        def read_url(group: int, offset: int) -> Optional[str]:
+            channel = reader.record(groups[group][1] + offset)
+            return channel.url if channel is not None else None
 
-    m3u_files = [f for f in os.listdir(input_folder) if f.lower().endswith('.m3u')]
-    if not m3u_files:
-        print_colored(f"No .m3u files found in '{input_folder}'. Exiting.", "yellow")
+        return draw_probe_samples([(group_title, count) for group_title, _, count in groups], read_url, samples, seed)
+
+
+def select_probe_samples(channels: List[hotrun.Channel], samples: int,
+                         seed: Optional[int] = None) -> List[str]:
+    """
+    The draw of get_probe_samples over the parsed Channel records of a playlist that is still
+    in memory (no re-read from disk). Groups are taken in the order save_parsed_m3u writes them,
+    so the same seed draws the same streams as get_probe_samples over the saved file.
+    """
+    buckets = hotrun.bucket_channels_by_group(channels)
+    ordered = [name for name in hotrun.sort_groups(list(buckets)) if name in buckets]
+    placed = set(ordered)
+    ordered += [name for name in buckets if name not in placed]
+    groups = [buckets[name] for name in ordered]
+    return draw_probe_samples([(name, len(bucket)) for name, bucket in zip(ordered, groups)],
+                              lambda group, offset: groups[group][offset].url, samples, seed)
+
+
+def draw_probe_samples(groups: List[Tuple[str, int]], read_url: Callable[[int, int], Optional[str]],
+                       samples: int, seed: Optional[int] = None) -> List[str]:
+    """
+    Weighted sampling without replacement over the records of a playlist: a group is drawn by
+    weight x records left in it, then a record of that group. Only drawn records are read.
+    With a seed the draws come from random.Random(seed), so runs with the same seed over the
+    same playlist sample the same streams (and can reuse their ProbeCache entries).
+    Args:
+        groups: (group title, record count) of every group, in playlist order.
+        read_url: read_url(group index, record offset in the group) -> stream URL or None.
+        samples: Distinct HTTP(S) URLs wanted.
+        seed: Optional seed of the draw.
+    """
+    rng = random.Random(seed) if seed is not None else random
+    urls: List[str] = []
+    pools = [] # [weight, group index, count, offsets drawn]
+    for index, (group_title, count) in enumerate(groups):
+        priority = hotrun.get_group_priority(group_title)
+        pools.append([PROBE_SAMPLE_WEIGHTS[min(priority, len(PROBE_SAMPLE_WEIGHTS) - 1)], index, count, set()])
+    reads = 0
+    while len(urls) < samples and reads < samples * PROBE_SAMPLE_READS:
+        open_pools = [pool for pool in pools if len(pool[3]) < pool[2]]
+        if not open_pools:
+            break
+        point = rng.random() * sum(weight * (count - len(drawn)) for weight, _, count, drawn in open_pools)
+        for pool in open_pools:
+            point -= pool[0] * (pool[2] - len(pool[3]))
+            if point < 0:
+                break
+        _, index, count, drawn = pool
+        offset = rng.randrange(count)
+        while offset in drawn:
+            offset = rng.randrange(count)
+        drawn.add(offset)
+        reads += 1
+        url = (read_url(index, offset) or "").strip()
+        if url.startswith(('http://', 'https://')) and url not in urls:
+            urls.append(url)
+    return urls
+
+
+# --- تابع پردازش فایل M3U (اصلاح شده برای پاس دادن پراکسی‌های زنده) ---
+def process_m3u_file(file_path, live_proxies, proxy_pool=None, limit=None, dns_cache=None):
+    stream_url_line = get_probe_url(file_path)
+    if not stream_url_line:
+        return None
+    dead_reason = dns_cache.url_dead_reason(stream_url_line) if dns_cache is not None else None
+    if dead_reason is not None:
+        print_colored(f"Stream host {dnscache.get_hostname(stream_url_line)} does not resolve ({dead_reason}). Invalid.", "red")
+        with metrics.trace_url(stream_url_line, 'stream'):
+            metrics.set_outcome('dns_error')
+        return None
+    # Pass live_proxies list to the new download_stream
+    with metrics.trace_url(stream_url_line, 'stream'):
+        with metrics.stage('probe'):
+            valid = download_stream(stream_url_line, live_proxies=live_proxies, proxy_pool=proxy_pool)
+        if limit is not None:
+            limit.record_current_trace() # Outcome and TTFB feed the adaptive concurrency
+    return file_path if valid else None
+
+
+# --- Resuming Interrupted Runs ---
+def get_file_digest(file_path: str) -> Optional[str]:
+    """SHA-1 of a playlist file; a journal entry only stands for the exact file it was probed from."""
+    digest = hashlib.sha1()
+    try:
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def get_resumed_entry(progress: Optional[journal.Journal], file_path: str, digest: Optional[str]) -> Optional[Dict[str, Any]]:
+    """The journal entry of a file an interrupted run already probed, or None if it has to be probed."""
+    if progress is None or digest is None:
+        return None
+    entry = progress.get(file_path)
+    return entry if entry is not None and entry.get('digest') == digest else None
+
+
+# --- Async Stream Prober ---
+class ProbeResult:
+    """
+    Metrics of one stream probe. Times are seconds from the start of the request;
+    connect_time is None when a pooled connection was reused. failure is None on
+    success, otherwise one of: 'no_proxy', 'proxy_timeout', 'proxy_error', 'connect_error',
+    'timeout', 'disconnected', 'ssl_error', 'http_error', 'too_slow', 'hls_error', 'dns_error', 'error'.
+    The proxy_* and connect_error failures happen before a connection through the proxy is up
+    (or are refused by the proxy, e.g. 407); 'timeout' and 'disconnected' come after it. For HLS channels
+    (kind 'hls') bytes_read, window and throughput cover the fetched segments, bitrate is
+    the segments' media bitrate (bits/s) and segment_latency their mean time-to-first-byte.
+    """
+    __slots__ = ('url', 'proxy', 'status', 'connect_time', 'ttfb', 'bytes_read', 'window', 'throughput', 'failure',
+                 'cached', 'kind', 'bitrate', 'segment_latency')
+
+    def __init__(self, url: str, proxy: Optional[str]) -> None:
+        self.url = url
+        self.proxy = proxy
+        self.status: Optional[int] = None
+        self.connect_time: Optional[float] = None
+        self.ttfb: Optional[float] = None
+        self.bytes_read = 0
+        self.window = 0.0 # Seconds measured after the first byte
+        self.throughput = 0.0 # Bytes/s sustained over the window
+        self.failure: Optional[str] = None
+        self.cached = False # True if taken from the ProbeCache instead of probed
+        self.kind = 'raw' # 'raw' byte stream or 'hls'
+        self.bitrate: Optional[float] = None
+        self.segment_latency: Optional[float] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.failure is None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'ProbeResult':
+        """Rebuilds a result from to_dict() output (e.g. a journal entry)."""
+        result = cls(data['url'], data.get('proxy'))
+        for name in cls.__slots__:
+            if name in data:
+                setattr(result, name, data[name])
+        return result
+
+
+class PlaylistProbe:
+    """
+    Quorum verdict over the sampled streams of one playlist. The playlist passes once
+    `quorum` samples pass and fails once that can no longer happen; the remaining samples
+    are then cancelled. Its throughput is the median of the passing samples.
+    """
+    __slots__ = ('file_path', 'samples', 'quorum', 'results', 'cancelled')
+
+    def __init__(self, file_path: str, samples: int, quorum: int) -> None:
+        self.file_path = file_path
+        self.samples = samples
+        self.quorum = max(1, min(quorum, samples))
+        self.results: List[ProbeResult] = []
+        self.cancelled = 0
+
+    @property
+    def passed(self) -> int:
+        return sum(1 for result in self.results if result.ok)
+
+    @property
+    def failed(self) -> int:
+        return len(self.results) - self.passed
+
+    @property
+    def decided(self) -> bool:
+        return self.passed >= self.quorum or self.failed > self.samples - self.quorum
+
+    @property
+    def ok(self) -> bool:
+        return self.samples > 0 and self.passed >= self.quorum
+
+    @property
+    def throughput(self) -> float:
+        passing = [result.throughput for result in self.results if result.ok]
+        return statistics.median(passing) if passing else 0.0
+
+    @property
+    def failure(self) -> Optional[str]:
+        if self.ok:
+            return None
+        return 'no_samples' if not self.samples else 'quorum_failed'
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'samples': self.samples, 'quorum': self.quorum, 'passed': self.passed, 'failed': self.failed,
+                'cancelled': self.cancelled, 'throughput': self.throughput, 'failure': self.failure,
+                'probes': [result.to_dict() for result in self.results]}
+
+    @classmethod
+    def from_dict(cls, file_path: str, data: Dict[str, Any]) -> 'PlaylistProbe':
+        """Rebuilds a verdict from to_dict() output (e.g. a journal entry)."""
+        probe = cls(file_path, data['samples'], data['quorum'])
+        probe.results = [ProbeResult.from_dict(result) for result in data.get('probes', [])]
+        probe.cancelled = data.get('cancelled', 0)
+        return probe
+
+
+# --- Persistent Probe Cache ---
+def normalize_stream_url(url: str) -> str:
+    """Lowercases scheme and host, drops default ports and the fragment."""
+    parsed = urlparse(url.strip())
+    scheme = parsed.scheme.lower()
+    netloc = (parsed.hostname or '').lower()
+    if parsed.port and parsed.port != {'http': 80, 'https': 443}.get(scheme):
+        netloc += f":{parsed.port}"
+    return urlunparse((scheme, netloc, parsed.path, '', parsed.query, ''))
+
+
+def get_panel_credentials(url: str) -> Optional[Tuple[str, str, str]]:
+    """
+    Returns (host:port, username, password) of an Xtream-style panel URL
+    (/live/USER/PASS/ID.ts, /movie/..., /series/..., /timeshift/..., /USER/PASS/ID with a numeric
+    stream ID, or ?username=&password=), or None if the URL does not carry credentials (a CDN
+    path such as /hls/bein1/index.m3u8 is not an account).
+    """
+    parsed = urlparse(url.strip())
+    host = f"{(parsed.hostname or '').lower()}:{parsed.port or (443 if parsed.scheme.lower() == 'https' else 80)}"
+    query = parse_qs(parsed.query)
+    if 'username' in query and 'password' in query:
+        return host, query['username'][0], query['password'][0]
+    segments = [segment for segment in parsed.path.split('/') if segment]
+    if len(segments) >= 4 and segments[0] in ('live', 'movie', 'series', 'timeshift'):
+        return host, segments[1], segments[2]
+    if len(segments) == 3 and XTREAM_STREAM_ID_RE.match(segments[2]):
+        return host, segments[0], segments[1]
+    return None
+
+
+def get_panel_key(url: str) -> Optional[str]:
+    """'host:port|username' of a panel URL, or None."""
+    credentials = get_panel_credentials(url)
+    return f"{credentials[0]}|{credentials[1]}" if credentials else None
+
+
+class ProbeCache:
+    """
+    SQLite store of stream-probe results, keyed by normalized stream URL and by panel
+    host + username. A result is reused while it is fresh (PROBE_SUCCESS_TTL_SEC for passes,
+    PROBE_FAILURE_TTL_SEC for failures) unless it is picked for re-probing: a random
+    reprobe_fraction of fresh entries, plus suspicious ones (a pass below twice the minimum
+    rate, or a stream that flipped between pass and fail). A fresh 401/403 on a panel
+    account also answers for the account's other URLs. Used from the event loop thread only.
+    """
+
+    def __init__(self, path: str = PROBE_CACHE_FILE, success_ttl: float = PROBE_SUCCESS_TTL_SEC,
+                 failure_ttl: float = PROBE_FAILURE_TTL_SEC, reprobe_fraction: float = PROBE_REPROBE_FRACTION,
+                 min_rate: float = PROBE_MIN_BYTES / PROBE_WINDOW_SEC) -> None:
+        self.success_ttl = success_ttl
+        self.failure_ttl = failure_ttl
+        self.reprobe_fraction = reprobe_fraction
+        self.min_rate = min_rate
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS probes (
+            url_key TEXT PRIMARY KEY, panel_key TEXT, ok INTEGER, failure TEXT, status INTEGER,
+            throughput REAL, ttfb REAL, checked_at REAL, flips INTEGER DEFAULT 0)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS probes_panel ON probes (panel_key, checked_at)")
+        self._pending_writes = 0
+
+    def _is_fresh(self, ok: bool, checked_at: float, now: float) -> bool:
+        return now - checked_at < (self.success_ttl if ok else self.failure_ttl)
+
+    def lookup(self, url: str) -> Optional[ProbeResult]:
+        """Returns a cached ProbeResult for url if it can stand in for a probe, None to probe."""
+        now = time.time()
+        row = self._db.execute("SELECT ok, failure, status, throughput, ttfb, checked_at, flips FROM probes "
+                               "WHERE url_key = ?", (normalize_stream_url(url),)).fetchone()
+        if row is None:
+            panel_key = get_panel_key(url)
+            if panel_key is not None:
+                placeholders = ",".join("?" * len(PROBE_ACCOUNT_STATUSES))
+                row = self._db.execute(
+                    f"SELECT ok, failure, status, throughput, ttfb, checked_at, 0 FROM probes WHERE panel_key = ? "
+                    f"AND status IN ({placeholders}) AND checked_at > ? ORDER BY checked_at DESC LIMIT 1",
+                    (panel_key, *PROBE_ACCOUNT_STATUSES, now - self.failure_ttl)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        ok, failure, status, throughput, ttfb, checked_at, flips = row
+        suspicious = flips >= 2 or (ok and throughput < 2 * self.min_rate)
+        if (not self._is_fresh(bool(ok), checked_at, now) or suspicious
+                or random.random() < self.reprobe_fraction):
+            self.misses += 1
+            return None
+        self.hits += 1
+        result = ProbeResult(url, None)
+        result.failure, result.status, result.throughput, result.ttfb = failure, status, throughput, ttfb
+        result.cached = True
+        return result
+
+    def record(self, result: ProbeResult) -> None:
+        """Stores a fresh probe result (flips counts pass/fail changes of the stream)."""
+        url_key = normalize_stream_url(result.url)
+        previous = self._db.execute("SELECT ok, flips FROM probes WHERE url_key = ?", (url_key,)).fetchone()
+        flips = 0
+        if previous is not None:
+            flips = previous[1] + 1 if bool(previous[0]) != result.ok else max(0, previous[1] - 1)
+        self._db.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (url_key, get_panel_key(result.url), int(result.ok), result.failure, result.status,
+                          result.throughput, result.ttfb, time.time(), flips))
+        self._pending_writes += 1
+        if self._pending_writes >= 100:
+            self._db.commit()
+            self._pending_writes = 0
+
+    def close(self) -> None:
+        """Drops entries too old to ever be used again, commits and closes the database."""
+        self._db.execute("DELETE FROM probes WHERE checked_at < ?",
+                         (time.time() - 4 * max(self.success_ttl, self.failure_ttl),))
+        self._db.commit()
+        self._db.close()
+
+
+class ProxySessionPool:
+    """
+    One aiohttp session per proxy, so every probe through a proxy reuses that proxy's
+    pooled connections. HTTP proxies use aiohttp's proxy= support; SOCKS proxies need
+    aiohttp_socks (listed in requirements.txt) and are left out, with a warning, without it.
+    """
+
+    def __init__(self, proxies: List[str], per_proxy: int = PROBE_PER_PROXY, timeout: float = PROBE_TIMEOUT) -> None:
+        self.per_proxy = per_proxy
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.proxies = [p for p in proxies if get_proxy_protocol(p) == 'http' or ProxyConnector is not None]
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._trace_config = aiohttp.TraceConfig()
+        self._trace_config.on_request_start.append(self._on_request_start)
+        self._trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        self._trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        if len(self.proxies) < len(proxies):
+            print_colored(f"Skipping {len(proxies) - len(self.proxies)} SOCKS proxies (pip install aiohttp_socks to use them).", "yellow")
+
+    @staticmethod
+    async def _on_request_start(session, ctx, params) -> None:
+        if ctx.trace_request_ctx is not None:
+            ctx.trace_request_ctx['request_start'] = time.perf_counter()
+
+    @staticmethod
+    async def _on_connection_create_end(session, ctx, params) -> None:
+        probe = ctx.trace_request_ctx
+        if probe is not None and 'request_start' in probe:
+            probe['connect_time'] = time.perf_counter() - probe['request_start']
+            probe['connected'] = True
+
+    @staticmethod
+    async def _on_connection_reuseconn(session, ctx, params) -> None:
+        if ctx.trace_request_ctx is not None:
+            ctx.trace_request_ctx['connected'] = True
+
+    def session_for(self, proxy_str: str) -> Tuple[aiohttp.ClientSession, Optional[str]]:
+        """Returns (session, proxy URL to pass per request or None if the connector handles it)."""
+        session = self._sessions.get(proxy_str)
+        socks = get_proxy_protocol(proxy_str) != 'http'
+        if session is None:
+            if socks:
+                connector = ProxyConnector.from_url(f"socks5://{proxy_str}", rdns=True, limit=self.per_proxy)
+            else:
+                connector = aiohttp.TCPConnector(limit=self.per_proxy)
+            session = aiohttp.ClientSession(connector=connector, timeout=self.timeout,
+                                            trace_configs=[self._trace_config])
+            self._sessions[proxy_str] = session
+        return session, None if socks else f"http://{proxy_str}"
+
+    async def close(self) -> None:
+        await asyncio.gather(*(session.close() for session in self._sessions.values()))
+
+
+# --- HLS Probing ---
+def is_hls_response(url: str, response: aiohttp.ClientResponse) -> bool:
+    """True if the URL or Content-Type says the body is an HLS playlist."""
+    return urlparse(url).path.lower().endswith('.m3u8') or response.content_type.lower() in HLS_CONTENT_TYPES
+
+
+async def read_limited(response: aiohttp.ClientResponse, limit: int, head: bytes = b'') -> bytes:
+    """Reads the rest of a response body (after `head`, already read), at most `limit` bytes."""
+    chunks = [head]
+    size = len(head)
+    async for chunk in response.content.iter_chunked(PROBE_CHUNK_SIZE):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= limit:
+            break
+    return b''.join(chunks)[:limit]
+
+
+def parse_hls_playlist(text: str, base_url: str) -> Tuple[List[str], List[Tuple[float, str]], bool]:
+    """
+    Parses an HLS playlist.
+    Returns:
+        (variant playlist URLs of a master playlist in listed order,
+         [(duration, segment URL)] of a media playlist, True if it has #EXT-X-ENDLIST).
+    """
+    variants: List[str] = []
+    segments: List[Tuple[float, str]] = []
+    pending_variant = False
+    duration: Optional[float] = None
+    ended = False
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            if line.startswith('#EXT-X-STREAM-INF'):
+                pending_variant = True
+            elif line.startswith('#EXTINF:'):
+                try:
+                    duration = float(line[8:].split(',', 1)[0])
+                except ValueError:
+                    duration = 0.0
+            elif line.startswith('#EXT-X-ENDLIST'):
+                ended = True
+            continue
+        if pending_variant:
+            variants.append(urljoin(base_url, line))
+            pending_variant = False
+        elif duration is not None:
+            segments.append((duration, urljoin(base_url, line)))
+            duration = None
+    return variants, segments, ended
+
+
+async def probe_hls_async(result: ProbeResult, session: aiohttp.ClientSession, proxy_url: Optional[str],
+                          playlist_url: str, text: str, min_bytes: int = PROBE_MIN_BYTES) -> None:
+    """
+    Follows an HLS playlist (master -> first listed variant, as players start) and fetches
+    HLS_SEGMENTS segments (the live edge, or the start of a VOD playlist) through the same
+    session and proxy. The channel passes if the segments deliver min_bytes and download
+    faster than they play. Fills in result; HTTP and connection errors propagate.
+    """
+    result.kind = 'hls'
+    segments: List[Tuple[float, str]] = []
+    ended = False
+    for _ in range(HLS_MAX_PLAYLIST_DEPTH):
+        variants, segments, ended = parse_hls_playlist(text, playlist_url)
+        if segments or not variants:
+            break
+        async with session.get(variants[0], proxy=proxy_url) as response:
+            response.raise_for_status()
+            playlist_url = str(response.url)
+            text = (await read_limited(response, HLS_MAX_PLAYLIST_BYTES)).decode('utf-8', 'ignore')
+    if not segments:
+        result.failure = 'hls_error'
         return
 
-    # --- مرحله 1: پیش-بررسی پراکسی‌ها ---
-    live_proxies = check_proxies_concurrently()
-    if not live_proxies:
-        print_colored("No live proxies found. Cannot test streams. Exiting.", "red")
-        sys.exit(1)
-    random.shuffle(live_proxies) # پخش کردن پراکسی‌ها
-    print_colored(f"Proceeding to test streams using {len(live_proxies)} live proxies...", "magenta")
-    # -----------------------------------------
+    picked = segments[:HLS_SEGMENTS] if ended else segments[-HLS_SEGMENTS:]
+    playtime = sum(duration for duration, _ in picked)
+    deadline = time.perf_counter() + playtime if playtime > 0 else None # Slower than real time: stop early
+    media_seconds = 0.0
+    download_seconds = 0.0
+    latencies = []
+    result.bytes_read = 0
+    for duration, segment_url in picked:
+        start = time.perf_counter()
+        async with session.get(segment_url, proxy=proxy_url) as response:
+            response.raise_for_status()
+            segment_bytes = 0
+            async for chunk in response.content.iter_chunked(PROBE_CHUNK_SIZE):
+                if segment_bytes == 0:
+                    latencies.append(time.perf_counter() - start)
+                segment_bytes += len(chunk)
+                if segment_bytes >= HLS_MAX_SEGMENT_BYTES or (deadline and time.perf_counter() > deadline):
+                    break
+        download_seconds += time.perf_counter() - start
+        result.bytes_read += segment_bytes
+        if deadline and time.perf_counter() > deadline:
+            result.failure = 'too_slow'
+            break
+        media_seconds += duration if segment_bytes < HLS_MAX_SEGMENT_BYTES else 0.0
 
-    valid_files = []
-    num_workers = min(max(4, os.cpu_count() * 4 ), 100) # تعداد ورکر برای تست استریم
-    print_colored(f"Using {num_workers} concurrent workers for stream testing.", "cyan")
+    result.window = download_seconds
+    result.throughput = result.bytes_read / max(download_seconds, 1e-3)
+    result.bitrate = result.bytes_read * 8 / media_seconds if media_seconds else None
+    result.segment_latency = statistics.mean(latencies) if latencies else None
+    if result.bytes_read < min_bytes:
+        result.failure = 'too_slow'
 
-    with ThreadPoolExecutor(max_workers=num_workers) as executor:
-        futures = [executor.submit(process_m3u_file, os.path.join(input_folder, filename), live_proxies)
-                   for filename in m3u_files]
 
-        for future in tqdm(as_completed(futures), total=len(m3u_files), desc="Testing Streams", unit="file"):
-            try:
-                result = future.result()
-                if result:
-                    valid_files.append(result)
-            except Exception as e:
-                 print_colored(f"\nError processing a file future: {e}", "red")
+async def probe_stream_async(url: str, pool: ProxySessionPool, proxy_str: Optional[str],
+                             window: float = PROBE_WINDOW_SEC, min_bytes: int = PROBE_MIN_BYTES) -> ProbeResult:
+    """
+    Probes one stream through proxy_str: records connect time, time-to-first-byte and the
+    bytes/s sustained over `window` seconds after the first byte. The stream passes if at
+    least min_bytes arrive within the window (the 1 s / 10 KB rule of download_stream).
+    HLS channels (by URL, Content-Type or an #EXTM3U body) are probed by probe_hls_async instead.
+    """
+    result = ProbeResult(url, proxy_str)
+    if proxy_str is None:
+        result.failure = 'no_proxy'
+        return result
+
+    session, proxy_url = pool.session_for(proxy_str)
+    trace: Dict[str, float] = {}
+    start = time.perf_counter()
+    try:
+        async with session.get(url, proxy=proxy_url, trace_request_ctx=trace) as response:
+            result.status = response.status
+            result.connect_time = trace.get('connect_time')
+            response.raise_for_status()
+            playlist = None
+            first_byte_at = None
+            async for chunk in response.content.iter_chunked(PROBE_CHUNK_SIZE):
+                now = time.perf_counter()
+                if first_byte_at is None:
+                    first_byte_at = now
+                    result.ttfb = now - start
+                    if is_hls_response(url, response) or chunk.lstrip().startswith(b'#EXTM3U'):
+                        playlist = await read_limited(response, HLS_MAX_PLAYLIST_BYTES, chunk)
+                        playlist_url = str(response.url)
+                        break
+                result.bytes_read += len(chunk)
+                if now - first_byte_at >= window:
+                    break
+            if first_byte_at is not None and playlist is None:
+                result.window = time.perf_counter() - first_byte_at
+                result.throughput = result.bytes_read / max(result.window, 1e-3)
+        if playlist is not None:
+            await probe_hls_async(result, session, proxy_url, playlist_url,
+                                  playlist.decode('utf-8', 'ignore'), min_bytes)
+        elif result.bytes_read < min_bytes or result.window < window:
+            result.failure = 'too_slow'
+    except asyncio.TimeoutError:
+        # Connected through the proxy but the stream stayed silent: the stream is dead, not the proxy
+        result.failure = 'timeout' if trace.get('connected') else 'proxy_timeout'
+    except aiohttp.ClientHttpProxyError: # The proxy refused the CONNECT tunnel (407, 5xx)
+        result.failure = 'proxy_error'
+    except aiohttp.ClientResponseError as e:
+        result.failure = 'proxy_error' if e.status == 407 else 'http_error'
+    except aiohttp.ClientProxyConnectionError:
+        result.failure = 'proxy_error'
+    except aiohttp.ClientSSLError:
+        result.failure = 'ssl_error'
+    except (aiohttp.ClientConnectionError, OSError):
+        result.failure = 'disconnected' if trace.get('connected') else 'connect_error'
+    except Exception:
+        result.failure = 'error'
+    return result
+
 
+def get_probe_outcome(result: ProbeResult) -> str:
+    """The metrics outcome of a probe: 'cached', 'ok', 'http_NNN' (same labels as the thread engine) or the failure."""
+    if result.cached:
+        return 'cached'
+    if result.ok:
+        return 'ok'
+    if result.failure == 'http_error':
+        return metrics.http_outcome(result.status)
+    return result.failure
+
+
+def record_probe_metrics(result: ProbeResult, seconds: float) -> None:
+    """Records a finished stream probe (all proxy attempts) as a 'stream' trace; outcome per get_probe_outcome."""
+    trace = metrics.Trace('stream', result.url)
+    trace.bytes = result.bytes_read
+    trace.outcome = get_probe_outcome(result)
+    if not result.cached:
+        for stage, value in (('connect', result.connect_time), ('ttfb', result.ttfb),
+                             ('segment_ttfb', result.segment_latency)):
+            if value is not None:
+                trace.stages[stage] = value
+        trace.stages['probe'] = seconds
+    trace.stages['total'] = seconds
+    metrics.recorder.finish(trace)
+
+
+class PlaylistProber:
+    """
+    Probes the sampled streams of playlists on one event loop, each through the best available
+    proxy of proxy_pool. Probes in flight follow an adaptive limit (default: hotrun.AIMDLimit up
+    to `concurrency`) fed with every proxy attempt, so timeouts, proxy failures and 5xx scale
+    the prober back. When the proxy
+    (not the stream) fails, the probe is retried through the next best proxy, up to
+    PROXY_ATTEMPTS proxies. A playlist's samples run concurrently and stop as soon as
+    `quorum` (default: a majority) have passed or can no longer pass.
+    With a probe_cache, fresh cached verdicts stand in for probes and new verdicts are stored
+    (results blamed on the proxy say nothing about the stream and are not stored).
+    Playlists on the same panel account share probes: the n-th sample of (host, user, pass)
+    in every playlist waits on one probe, which is only cancelled once all its waiters are.
+    Playlists can be submitted while others are still being probed (see pipeline.py).
+    With a dns_cache the stream hosts of a playlist are resolved before its probes start, and
+    streams on names that do not resolve fail with 'dns_error' without a proxy attempt.
+    """
+
+    def __init__(self, proxy_pool: ProxyPool, concurrency: int = PROBE_CONCURRENCY,
+                 window: float = PROBE_WINDOW_SEC, timeout: float = PROBE_TIMEOUT,
+                 quorum: Optional[int] = None, probe_cache: Optional[ProbeCache] = None,
+                 limit: Optional[hotrun.AIMDLimit] = None,
+                 dns_cache: Optional[dnscache.DNSCache] = None) -> None:
+        self.proxy_pool = proxy_pool
+        self.dns_cache = dns_cache
+        self.window = window
+        self.quorum = quorum
+        self.probe_cache = probe_cache
+        self.pool = ProxySessionPool(proxy_pool.proxies, timeout=timeout)
+        self.usable = set(self.pool.proxies)
+        self.limit = limit or hotrun.AIMDLimit("probe", concurrency)
+        self.limiter = hotrun.AsyncAdaptiveLimiter(self.limit)
+        self.results: Dict[str, PlaylistProbe] = {}
+        self.coalesced = 0
+        self._shared: Dict[Tuple[Any, int], asyncio.Task] = {} # (account or URL, sample ordinal) -> probe
+        self._waiters: Dict[Tuple[Any, int], int] = {}
+
+    async def probe_url(self, url: str) -> ProbeResult:
+        """Probes one stream (or answers from the probe cache)."""
+        probe_cache = self.probe_cache
+        cached = probe_cache.lookup(url) if probe_cache is not None else None
+        if cached is not None:
+            record_probe_metrics(cached, 0.0)
+            return cached
+        if self.dns_cache is not None and self.dns_cache.url_dead_reason(url) is not None:
+            result = ProbeResult(url, None)
+            result.failure = 'dns_error'
+            record_probe_metrics(result, 0.0) # Not stored in the probe cache: the DNS cache remembers dead names
+            return result
+        async with self.limiter.slot():
+            start = time.perf_counter()
+            for _ in range(PROXY_ATTEMPTS):
+                proxy_str = self.proxy_pool.acquire(self.usable.__contains__)
+                try:
+                    result = await probe_stream_async(url, self.pool, proxy_str, self.window)
+                except asyncio.CancelledError:
+                    if proxy_str is not None:
+                        self.proxy_pool.abandon(proxy_str)
+                    raise
+                if proxy_str is None:
+                    break
+                self.proxy_pool.release(proxy_str, result.failure not in PROXY_FAILURES, result.ttfb)
+                self.limit.record(hotrun.is_congestion_outcome(get_probe_outcome(result)), result.ttfb)
+                if result.failure not in PROXY_FAILURES:
+                    break
+            record_probe_metrics(result, time.perf_counter() - start)
+        # A silent stream (timeout after the proxy connected) is cached like any stream failure, for failure_ttl
+        if probe_cache is not None and result.failure not in PROXY_FAILURES + ('no_proxy', 'error'):
+            probe_cache.record(result)
+        return result
+
+    async def _probe_shared(self, key: Tuple[Any, int], url: str) -> ProbeResult:
+        """
+        Probes url, or joins the probe of the same (account, ordinal) while it is in flight.
+        A finished probe is no longer shared (reuse across time is the ProbeCache's job).
+        """
+        waiters = self._waiters
+        task = self._shared.get(key)
+        if task is None or task.done() or waiters[key] == 0: # None, finished or being cancelled
+            task = self._shared[key] = asyncio.ensure_future(self.probe_url(url))
+            waiters[key] = 0
+            task.add_done_callback(lambda done, key=key: self._forget_shared(key, done))
+        else:
+            self.coalesced += 1
+        waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done():
+                waiters[key] -= 1
+                if waiters[key] == 0:
+                    task.cancel() # Last requester gone
+            raise
+
+    def _forget_shared(self, key: Tuple[Any, int], task: asyncio.Task) -> None:
+        if self._shared.get(key) is task:
+            del self._shared[key]
+            del self._waiters[key]
+
+    async def probe_file(self, file_path: str, urls: List[str]) -> PlaylistProbe:
+        """Probes a playlist's sample URLs to a quorum verdict, stored in self.results[file_path]."""
+        quorum = self.quorum or len(urls) // 2 + 1
+        probe = PlaylistProbe(file_path, len(urls), quorum)
+        if self.dns_cache is not None:
+            await self.dns_cache.resolve(dnscache.get_hostname(url) for url in urls)
+        ordinals: Dict[Any, int] = {}
+        pending = set()
+        for url in urls:
+            account = get_panel_credentials(url) or normalize_stream_url(url)
+            ordinals[account] = ordinals.get(account, -1) + 1
+            pending.add(asyncio.ensure_future(self._probe_shared((account, ordinals[account]), url)))
+        try:
+            while pending and not probe.decided:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                probe.results.extend(task.result() for task in done)
+        except asyncio.CancelledError:
+            for task in pending:
+                task.cancel() # Releases the shared probes; the last waiter cancels each
+            raise
+        for task in pending:
+            task.cancel()
+        probe.cancelled = len(pending)
+        await asyncio.gather(*pending, return_exceptions=True)
+        self.results[file_path] = probe
+
+        host = urlparse(urls[0]).hostname or "UnknownHost"
+        cached = sum(1 for result in probe.results if result.cached)
+        verdict = f"{probe.passed}/{probe.samples} passed, quorum {probe.quorum}" + (
+            f", {probe.cancelled} cancelled" if probe.cancelled else "") + (f", {cached} cached" if cached else "")
+        if probe.ok:
+            print_colored(f"Stream OK {host[:25]} ({verdict}): {probe.throughput / 1024:.0f} KB/s", "green")
+        else:
+            failures = sorted({result.failure for result in probe.results if not result.ok})
+            print_colored(f"Stream Failed {host[:25]} ({verdict}): {', '.join(failures)}", "red")
+        return probe
+
+    async def close(self) -> None:
+        """Closes the proxy sessions and logs coalescing and cache statistics."""
+        await self.pool.close()
+        if self.coalesced:
+            print_colored(f"Probe coalescing: {self.coalesced} samples shared an in-flight probe of the same panel account.", "cyan")
+        if self.probe_cache is not None:
+            print_colored(f"Probe cache: {self.probe_cache.hits} hits, {self.probe_cache.misses} probed.", "cyan")
+
+
+async def probe_files_async(file_paths: List[str], proxy_pool: ProxyPool,
+                            concurrency: int = PROBE_CONCURRENCY, window: float = PROBE_WINDOW_SEC,
+                            timeout: float = PROBE_TIMEOUT, samples: int = PROBE_SAMPLES,
+                            quorum: Optional[int] = None,
+                            probe_cache: Optional[ProbeCache] = None,
+                            sample_seed: Optional[int] = None,
+                            limit: Optional[hotrun.AIMDLimit] = None,
+                            dns_cache: Optional[dnscache.DNSCache] = None,
+                            shutdown_event: Optional[threading.Event] = None,
+                            progress: Optional[journal.Journal] = None) -> Dict[str, PlaylistProbe]:
+    """
+    Probes `samples` streams of every M3U file (see get_probe_samples) with a PlaylistProber;
+    a sample_seed keeps the sampled streams, and so the probe-cache keys, stable between runs.
+    With a dns_cache all sampled stream hosts are resolved up front, before the first probe.
+    With a progress journal every verdict is recorded as it is reached, and files an interrupted
+    run already probed (unchanged since) take their verdict from the journal instead.
+    Once shutdown_event is set the probes in flight are cancelled; their files get no verdict.
+    Returns:
+        {file_path: PlaylistProbe} for every file that has at least one stream URL.
+    """
+    prober = PlaylistProber(proxy_pool, concurrency, window, timeout, quorum, probe_cache, limit, dns_cache)
+    digests: Dict[str, Optional[str]] = {}
+    pending_paths = []
+    for file_path in file_paths:
+        digests[file_path] = get_file_digest(file_path) if progress is not None else None
+        entry = get_resumed_entry(progress, file_path, digests[file_path])
+        if entry is not None and 'probe' in entry:
+            prober.results[file_path] = PlaylistProbe.from_dict(file_path, entry['probe'])
+        else:
+            pending_paths.append(file_path)
+    if len(pending_paths) < len(file_paths):
+        print_colored(f"Resuming an interrupted run: {len(file_paths) - len(pending_paths)} files already probed, "
+                      f"{len(pending_paths)} to go.", "yellow")
+
+    async def probe_and_record(file_path: str, urls: List[str]) -> None:
+        probe = await prober.probe_file(file_path, urls)
+        if progress is not None:
+            progress.record(file_path, digest=digests[file_path], probe=probe.to_dict())
+
+    async def cancel_on_shutdown(tasks: List[asyncio.Task]) -> None:
+        while not shutdown_event.is_set():
+            await asyncio.sleep(hotrun.CANCEL_POLL_SEC)
+        for task in tasks:
+            task.cancel()
+
+    try:
+        samples_by_file = [(file_path, get_probe_samples(file_path, samples, sample_seed)) for file_path in pending_paths]
+        if dns_cache is not None:
+            hosts = [dnscache.get_hostname(url) for _, urls in samples_by_file for url in urls]
+            dns_start = time.perf_counter()
+            looked_up = await dns_cache.resolve(hosts)
+            hotrun.log_dns_stage(dns_cache, hosts, looked_up, time.perf_counter() - dns_start)
+        tasks = [asyncio.ensure_future(probe_and_record(file_path, urls)) for file_path, urls in samples_by_file if urls]
+        watcher = asyncio.ensure_future(cancel_on_shutdown(tasks)) if shutdown_event is not None else None
+        try:
+            outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+        for outcome in outcomes:
+            if isinstance(outcome, Exception):
+                raise outcome # Cancelled probes are expected, anything else is not
+    finally:
+        await prober.close()
+    return prober.results
 
-    print_colored(f"\nFound {len(valid_files)} valid files (met 1s/10KB criteria). Copying to '{best_folder}'...", "magenta")
+
+def rank_probe_results(results: Dict[str, PlaylistProbe]) -> List[str]:
+    """Returns the files that passed, fastest (median) sustained throughput first."""
+    passed = [(file_path, result) for file_path, result in results.items() if result.ok]
+    passed.sort(key=lambda item: (-item[1].throughput, item[0]))
+    return [file_path for file_path, _ in passed]
+
+
+def save_probe_metrics(results: Dict[str, PlaylistProbe], ranked_files: List[str]) -> None:
+    """Writes every probe's metrics (and the rank of passing files) to best/probe_metrics.json."""
+    ranks = {file_path: rank for rank, file_path in enumerate(ranked_files, start=1)}
+    report = [{'file': os.path.basename(file_path), 'rank': ranks.get(file_path), **result.to_dict()}
+              for file_path, result in sorted(results.items(), key=lambda item: (ranks.get(item[0]) or 1e9, item[0]))]
+    try:
+        with open(os.path.join(best_folder, probe_metrics_file), 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=1)
+    except OSError as e:
+        print_colored(f"Error writing {probe_metrics_file}: {e}", "red")
+
+
+# --- Command Line Arguments ---
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parses command line options."""
+    parser = argparse.ArgumentParser(description="Test the sample stream of every playlist and rank the working ones.")
+    parser.add_argument("--engine", choices=PROBE_ENGINES, default="async",
+                        help="'async': one event loop, pooled connections per proxy, throughput ranking; "
+                             "'thread': the original pass/fail test in a thread pool, ranked by file name.")
+    parser.add_argument("--concurrency", type=int, default=PROBE_CONCURRENCY,
+                        help="Ceiling of the adaptive probe concurrency (both engines).")
+    parser.add_argument("--start-concurrency", type=int, default=hotrun.AIMD_START,
+                        help="Probe concurrency to start from; it grows while latency and errors stay healthy.")
+    parser.add_argument("--window", type=float, default=PROBE_WINDOW_SEC,
+                        help="Seconds of stream measured after the first byte.")
+    parser.add_argument("--timeout", type=float, default=PROBE_TIMEOUT, help="Seconds per probe.")
+    parser.add_argument("--samples", type=int, default=PROBE_SAMPLES,
+                        help="Streams sampled per playlist (async engine), weighted towards Iran and sports groups.")
+    parser.add_argument("--quorum", type=int, default=None,
+                        help="Passing samples needed to accept a playlist (default: a majority of --samples).")
+    parser.add_argument("--proxies", help="Comma-separated host:port list (or a file with one per line) "
+                                          "to use instead of PROXY_LIST, e.g. local stand-in proxies.")
+    parser.add_argument("--proxy-check-url", default=PROXY_CHECK_URL, help="URL fetched to health-check a proxy.")
+    parser.add_argument("--proxy-scores", default=PROXY_SCORES_FILE,
+                        help="File the proxy scores are loaded from and saved to between runs.")
+    parser.add_argument("--probe-cache", default=PROBE_CACHE_FILE,
+                        help="SQLite file of probe results reused between runs (async engine).")
+    parser.add_argument("--no-probe-cache", action="store_true", help="Probe every sampled stream.")
+    parser.add_argument("--dns-cache", default=dnscache.DNS_CACHE_FILE,
+                        help="File of resolved stream hosts (and dead names) reused between runs.")
+    parser.add_argument("--no-dns-cache", action="store_true",
+                        help="Do not resolve stream hosts up front; dead names are probed like any other.")
+    parser.add_argument("--success-ttl", type=float, default=PROBE_SUCCESS_TTL_SEC,
+                        help="Seconds a passing probe result is reused.")
+    parser.add_argument("--failure-ttl", type=float, default=PROBE_FAILURE_TTL_SEC,
+                        help="Seconds a failing probe result is reused.")
+    parser.add_argument("--reprobe-fraction", type=float, default=PROBE_REPROBE_FRACTION,
+                        help="Share of fresh cached results probed again anyway (0-1).")
+    parser.add_argument("--rules", default=filters.FILTER_RULES_FILE,
+                        help="JSON filter rule file whose priority tiers weight the stream samples.")
+    parser.add_argument("--metrics-dir", default=metrics.METRICS_DIR,
+                        help="Directory the per-stage metrics (toptv.json, toptv.prom) are written to.")
+    parser.add_argument("--journal", default=JOURNAL_FILE,
+                        help="Progress journal of this run; an interrupted run leaves it behind and the next run "
+                             "takes the verdicts of unchanged files from it.")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Ignore the journal of an interrupted run and probe every file.")
+    parser.add_argument("--resume-max-age", type=float, default=journal.JOURNAL_MAX_AGE_SEC,
+                        help="Seconds a journal entry stays fresh enough to reuse its verdict.")
+    parser.add_argument("--time-budget", type=float, default=None,
+                        help="Seconds after which the run cancels itself (like Ctrl+C) and keeps its progress; "
+                             "best/ is then left as it was.")
+    return parser.parse_args(argv)
+
+
+def get_proxy_list(proxies_arg: Optional[str]) -> List[str]:
+    """Returns the --proxies list (inline or from a file), or PROXY_LIST."""
+    if not proxies_arg:
+        return list(PROXY_LIST)
+    if os.path.isfile(proxies_arg):
+        with open(proxies_arg, 'r', encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    return [proxy.strip() for proxy in proxies_arg.split(',') if proxy.strip()]
+
+
+def create_proxy_pool(proxy_list: List[str], check_url: str = PROXY_CHECK_URL,
+                      scores_file: str = PROXY_SCORES_FILE) -> Optional[ProxyPool]:
+    """
+    Checks proxy_list and returns a ProxyPool (warm scores from earlier runs) that has
+    recorded the check, or None if no proxy is live.
+    """
+    live_proxies = check_proxies_concurrently(proxy_list, check_url)
+    if not live_proxies:
+        return None
+    proxy_pool = ProxyPool(proxy_list, scores_file, check_url)
+    live_set = set(live_proxies)
+    for proxy_str in proxy_list:
+        proxy_pool.record_check(proxy_str, proxy_str in live_set)
+    print_colored(f"Proceeding to test streams using {len(live_proxies)} live proxies...", "magenta")
+    return proxy_pool
+
+
+# --- Publishing best/ and mvp.m3u ---
+def publish_best_files(valid_files: List[str], published: Optional[Dict[int, str]] = None,
+                       prune: bool = False) -> Tuple[int, bool]:
+    """
+    Copies the ranked files to best/best{rank}.m3u and the 2nd one to mvp.m3u.
+    Args:
+        valid_files: Passing files, best first.
+        published: Optional {rank: source file} of an earlier call; ranks whose source is
+                   unchanged are not copied again, and the dict is updated (incremental publishing).
+        prune: Also remove best{rank}.m3u files ranked beyond valid_files.
+    Returns:
+        (number of files copied, True if mvp.m3u was written)
+    """
     copied_count = 0
     mvp_copied = False
-    valid_files.sort()
     for index, file_path in enumerate(valid_files, start=1):
+        if published is not None and published.get(index) == file_path:
+            continue
         try:
             base_filename = os.path.basename(file_path)
             best_file_path = os.path.join(best_folder, f"best{index}.m3u")
             shutil.copy(file_path, best_file_path)
             copied_count += 1
+            if published is not None:
+                published[index] = file_path
 
             if index == 2:
                 mvp_file_path = os.path.join(os.getcwd(), "mvp.m3u")
@@ -242,15 +1404,180 @@ def main():
         except Exception as copy_e:
              print_colored(f"Error copying file {file_path} to {best_folder}: {copy_e}", "red")
 
+    if prune:
+        index = len(valid_files) + 1
+        while os.path.exists(os.path.join(best_folder, f"best{index}.m3u")):
+            try: os.remove(os.path.join(best_folder, f"best{index}.m3u"))
+            except OSError: break
+            if published is not None:
+                published.pop(index, None)
+            index += 1
+    return copied_count, mvp_copied
+
+
+# --- Thread Engine (pass/fail only) ---
+def run_thread_probes(m3u_files: List[str], proxy_pool: ProxyPool, limit: hotrun.AIMDLimit,
+                      dns_cache: Optional[dnscache.DNSCache] = None,
+                      shutdown_event: Optional[threading.Event] = None,
+                      progress: Optional[journal.Journal] = None) -> List[str]:
+    """
+    Tests every file with download_stream in a thread pool; a file is only submitted once the
+    adaptive limit has a free slot. With a dns_cache the stream hosts are resolved up front and
+    files whose stream host does not resolve fail without a probe.
+    With a progress journal every verdict is recorded as it is reached, and files an interrupted
+    run already tested (unchanged since) take their verdict from the journal instead.
+    Once shutdown_event is set no further file is submitted and the tests in flight are not waited for.
+    Returns the valid files sorted by name.
+    """
+    valid_files = []
+    pending_files = []
+    for filename in m3u_files:
+        file_path = os.path.join(input_folder, filename)
+        digest = get_file_digest(file_path) if progress is not None else None
+        entry = get_resumed_entry(progress, file_path, digest)
+        if entry is None:
+            pending_files.append((file_path, digest))
+        elif entry.get('valid'):
+            valid_files.append(file_path)
+    if len(pending_files) < len(m3u_files):
+        print_colored(f"Resuming an interrupted run: {len(m3u_files) - len(pending_files)} files already tested "
+                      f"({len(valid_files)} valid), {len(pending_files)} to go.", "yellow")
+    limiter = hotrun.AdaptiveLimiter(limit)
+    if dns_cache is not None:
+        hosts = [dnscache.get_hostname(get_probe_url(file_path) or '') for file_path, _ in pending_files]
+        dns_start = time.perf_counter()
+        looked_up = dns_cache.resolve_blocking(hosts)
+        hotrun.log_dns_stage(dns_cache, hosts, looked_up, time.perf_counter() - dns_start)
+    print_colored(f"Stream testing with adaptive concurrency ({limit.current()} to start, at most {limit.maximum}).", "cyan")
+
+    def process_in_slot(file_path: str, digest: Optional[str]) -> Optional[str]:
+        try:
+            result = process_m3u_file(file_path, None, proxy_pool, limit, dns_cache)
+        finally:
+            limiter.release()
+        if progress is not None:
+            progress.record(file_path, digest=digest, valid=result is not None)
+        return result
+
+    executor = ThreadPoolExecutor(max_workers=limit.maximum)
+    pending = set()
+    try:
+        with tqdm(total=len(pending_files), desc="Testing Streams", unit="file") as progress_bar:
+            submitted = iter(pending_files)
+            while True:
+                # Submit while the limit has room, collect whatever finished meanwhile
+                for file_path, digest in submitted:
+                    if not limiter.acquire(shutdown_event):
+                        break
+                    pending.add(executor.submit(process_in_slot, file_path, digest))
+                    if len(pending) >= limit.maximum:
+                        break
+                if not pending or (shutdown_event is not None and shutdown_event.is_set()):
+                    break
+                done, pending = wait(pending, timeout=hotrun.CANCEL_POLL_SEC, return_when=FIRST_COMPLETED)
+                for future in done:
+                    progress_bar.update(1)
+                    try:
+                        result = future.result()
+                        if result:
+                            valid_files.append(result)
+                    except Exception as e:
+                         print_colored(f"\nError processing a file future: {e}", "red")
+    finally:
+        hotrun.shutdown_executor(executor, wait=shutdown_event is None or not shutdown_event.is_set(), futures=pending)
+    valid_files.sort()
+    return valid_files
+
+
+# --- تابع اصلی (تنظیمات ورکر مثل قبل) ---
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    filter_rules = hotrun.load_filter_rules(args.rules)
+
+    if not os.path.isdir(input_folder):
+         print_colored(f"Error: Input folder '{input_folder}' not found.", "red")
+         sys.exit(1)
+
+    m3u_files = [f for f in os.listdir(input_folder) if f.lower().endswith('.m3u')]
+    if not m3u_files:
+        print_colored(f"No .m3u files found in '{input_folder}'. Exiting.", "yellow")
+        return
+
+    # --- مرحله 1: پیش-بررسی پراکسی‌ها ---
+    proxy_pool = create_proxy_pool(get_proxy_list(args.proxies), args.proxy_check_url, args.proxy_scores)
+    if proxy_pool is None:
+        print_colored("No live proxies found. Cannot test streams. Exiting.", "red")
+        sys.exit(1)
+    # -----------------------------------------
+
+    probe_limit = hotrun.AIMDLimit("probe", args.concurrency, args.start_concurrency)
+    dns_cache = None if args.no_dns_cache else dnscache.DNSCache(args.dns_cache)
+    progress = journal.Journal(args.journal, {'tool': 'toptv', 'engine': args.engine, 'samples': args.samples,
+                                              'quorum': args.quorum, 'window': args.window, 'rules': filter_rules.digest},
+                               args.resume_max_age, resume=not args.no_resume)
+    # Ctrl+C, SIGTERM and --time-budget set the shutdown event; verdicts so far stay in the journal
+    shutdown = hotrun.ShutdownControl(args.time_budget).install()
+    shutdown.at_exit(lambda: metrics.write_reports("toptv", args.metrics_dir))
+    probe_results = None
+    proxy_pool.start_background_recheck()
+    try:
+        if args.engine == "async":
+            print_colored(f"Probing streams on one event loop ({probe_limit.current()} to {args.concurrency} in flight, "
+                          f"{args.window:.1f}s window)...", "cyan")
+            probe_cache = sample_seed = None
+            if not args.no_probe_cache:
+                probe_cache = ProbeCache(args.probe_cache, args.success_ttl, args.failure_ttl,
+                                         args.reprobe_fraction, PROBE_MIN_BYTES / args.window)
+                sample_seed = int(time.time() // max(args.success_ttl, 1)) # Same samples until passes expire
+            try:
+                probe_results = asyncio.run(probe_files_async(
+                    [os.path.join(input_folder, filename) for filename in m3u_files], proxy_pool,
+                    args.concurrency, args.window, args.timeout, args.samples, args.quorum, probe_cache,
+                    sample_seed, probe_limit, dns_cache, shutdown.event, progress))
+            finally:
+                if probe_cache is not None:
+                    probe_cache.close()
+            valid_files = rank_probe_results(probe_results) # Fastest first
+        else:
+            if args.samples > 1:
+                print_colored("--samples is only used by the async engine; testing one stream per file.", "yellow")
+            valid_files = run_thread_probes(m3u_files, proxy_pool, probe_limit, dns_cache, shutdown.event, progress)
+    finally:
+        proxy_pool.close()
+        if dns_cache is not None:
+            dns_cache.save()
+    hotrun.prune_playlist_indexes()
+
+    copied_count = 0
+    mvp_copied = False
+    if shutdown.cancelled:
+        # A partial ranking would replace a complete one: best/ keeps the last finished run's files
+        progress.close()
+        print_colored(f"\nRun stopped ({shutdown.reason}) after {len(progress)} of {len(m3u_files)} files; progress kept "
+                      f"in '{progress.path}' for the next run, '{best_folder}' left as it was.", "yellow")
+    else:
+        progress.complete()
+        clean_best_folder()
+        print_colored(f"\nFound {len(valid_files)} valid files (met 1s/10KB criteria). Copying to '{best_folder}'...", "magenta")
+        copied_count, mvp_copied = publish_best_files(valid_files)
+        if probe_results is not None:
+            save_probe_metrics(probe_results, valid_files)
 
     print_colored(f"\n--- Summary ---", "magenta")
     print_colored(f"Total files processed: {len(m3u_files)}", "cyan")
     print_colored(f"Valid streams found (met criteria): {len(valid_files)}", "cyan")
     print_colored(f"Files copied to '{best_folder}': {copied_count}", "green")
+    print_colored(f"Probe concurrency: peak {probe_limit.peak}, final {probe_limit.current()} (ceiling {args.concurrency})", "cyan")
+    outcome_counts = metrics.recorder.outcome_counts('stream')
+    if outcome_counts:
+        print_colored("Probe outcomes: " + ", ".join(f"{outcome} {count}" for outcome, count in outcome_counts.items()), "cyan")
+    if metrics.write_reports("toptv", args.metrics_dir) is not None:
+        print_colored(f"Metrics written to '{args.metrics_dir}'.", "cyan")
     if mvp_copied:
          print_colored(f"MVP file 'mvp.m3u' created.", "green")
-    elif len(valid_files) >= 1 :
+    elif len(valid_files) >= 1 and not shutdown.cancelled:
          print_colored(f"MVP file not created (needed >= 2 valid streams, found {len(valid_files)}).", "yellow")
+    shutdown.finish()
 
 
 # --- Entry Point ---
@@ -259,9 +1586,4 @@ if __name__ == "__main__":
         print_colored("Error: This script requires Python 3.7 or higher.", "red")
         sys.exit(1)
 
-    def signal_handler(sig, frame):
-        print_colored('\nCtrl+C detected. Exiting...', 'yellow')
-        os._exit(1) # Use os._exit for more immediate exit in threaded context
-    signal.signal(signal.SIGINT, signal_handler)
-
     main()